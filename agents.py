@@ -1,391 +1,1063 @@
-from typing import TypedDict, List, Dict
-from langchain.schema import HumanMessage
-import os, random, json
-from langchain_groq import ChatGroq
-import pytz
-from datetime import datetime, timedelta
-import psycopg2
-from dotenv import load_dotenv
-import logging
-from logging import debug
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-
-load_dotenv()
-conn = psycopg2.connect(
-    host="localhost",
-    database="hospital",
-    user="postgres",
-    password="Neeltej@9",
-    port="5432"
-    )
-cursor = conn.cursor()
-queued_patients = []
-
-def get_beds():
-    query = """
-        SELECT DISTINCT type,
-                (SELECT COUNT(*) FROM rooms r1 WHERE r1.type = r.type AND is_occupied = FALSE) available,
-                (SELECT COUNT(*) FROM rooms r1 WHERE r1.type = r.type AND is_occupied = TRUE) blocked 
-        FROM rooms r;
-        """
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    output = {}
-    for data in rows:
-        output[data[0]] = data[1:]
-    return output
-
-def get_doctor_status():
-    debug("Getting doctor status update...")
-    query = "SELECT refresh_data();"
-    cursor.execute(query)
-    conn.commit()
-    query = f"""
-        SELECT
-            d.name doctor_name,
-            d.specialist department,
-            (CASE WHEN d.is_busy=TRUE THEN 'BUSY' ELSE 'AVAILABLE' END) status,
-            (CASE WHEN d.is_busy=TRUE THEN p.patient_name ELSE NULL END) with_patient,
-            (CASE WHEN d.is_busy=TRUE THEN ROUND(EXTRACT(EPOCH FROM (d.busy_till - CURRENT_TIMESTAMP)) / 60,2) ELSE NULL END) time_remaining,
-            (CASE WHEN d.is_busy=TRUE THEN d.busy_till ELSE NULL END) finish_time,
-            (CASE WHEN d.is_busy=TRUE THEN d.busy_from ELSE NULL END) start_time
-        FROM doctors d
-        LEFT JOIN ongoing_cases oc
-        ON d.doctor_id = oc.doctor_id
-        LEFT JOIN patient_info p
-        ON oc.patient_id = p.patient_id;
-    """
-    cursor.execute(query)
-    rows = cursor.fetchall()
-    output = []
-    cols = ["doctor_name","department","status","with_patient","time_remaining","finish_time","start_time"]
-    for i in range(len(rows)):
-        temp_dict = {}
-        for idx, data in enumerate(rows[i]):
-            temp_dict[cols[idx]] = data
-        output.append(temp_dict)
-    return output
-
-def get_block_duration(triage_level):
-    return timedelta(minutes=max(1, triage_level))
-
-def get_current_est_time():
-    est = pytz.timezone('US/Eastern')
-    return datetime.now(est)
-
-def get_current_time_with_ms():
-    return datetime.now(pytz.timezone('US/Eastern')).strftime('%H:%M:%S.%f')[:-3]
-
-class Patient:
-    def __init__(self, name, vitals, email, gender, age, symptoms, symptom_duration):
-        self.name = name
-        self.symptoms = symptoms
-        self.symptom_duration = symptom_duration
-        self.email = email
-        self.phone = None
-        self.age = age
-        self.vitals = vitals
-        self.gender = gender
-        self.mood = None
-        self.triage_level = None
-        self.department = None
-        self.assigned_doctor = None
-        self.assigned_bed = None
-        self.bed_priority = None
-        self.priority_score = 0.0
-        self.entry_time = get_current_est_time()
-        self.treatment_completed = False
-        self.treatment_end_time = None
-
-    def calculate_priority(self):
-        triage_weight = 10
-        triage_score = self.triage_level * triage_weight
-        
-        if self.age >= 50:
-            age_score = 8
-        elif self.age < 15:
-            age_score = 5
-        else:
-            age_score = 0
-            
-        hr = self.vitals.get("heart_rate", 80)
-        bp_sys = self.vitals.get("blood_pressure", {}).get("systolic", 120)
-        bp_dia = self.vitals.get("blood_pressure", {}).get("diastolic", 80)
-        
-        hr_dev = max(hr - 100, 60 - hr, 0)
-        bp_sys_dev = abs(bp_sys - 120) if bp_sys > 140 or bp_sys < 90 else 0
-        bp_dia_dev = abs(bp_dia - 80) if bp_dia > 90 or bp_dia < 60 else 0
-        vital_score = (hr_dev + bp_sys_dev + bp_dia_dev) * 0.7
-        
-        duration_score = self.symptom_duration * 0.2
-        
-        self.priority_score = round(triage_score + age_score + vital_score + duration_score, 1)
-
-    def to_dict(self):
-        self.calculate_priority()
-        return {
-            "name": self.name,
-            "symptoms": self.symptoms,
-            "symptom_duration": self.symptom_duration,
-            "contact_number": self.phone,
-            "age": self.age,
-            "email": self.email,
-            "gender": self.gender,
-            "mood": self.mood,
-            "triage_level": self.triage_level,
-            "department": self.department,
-            "assigned_doctor": self.assigned_doctor,
-            "assigned_bed": self.assigned_bed,
-            "priority_score": self.priority_score,
-            "treatment_completed": self.treatment_completed,
-            "treatment_end_time": self.treatment_end_time.strftime('%H:%M:%S.%f')[:-3] if self.treatment_end_time else None,
-            "entry_time": self.entry_time.strftime('%H:%M:%S.%f')[:-3]
-        }
-
-class AgentState(TypedDict):
-    patient: Patient
-    logs: List[str]
-    status: dict
-    cache: dict
-
-def adjust_mood_based_on_vitals(patient, detected_mood):
-    symptoms_str = " ".join(patient.symptoms).lower()
-    if patient.vitals["heart_rate"] > 120 or patient.vitals["blood_pressure"].get("diastolic",80) < 80:
-        detected_mood = "panicked"
-    elif "cardiac arrest" in symptoms_str:
-        detected_mood = "panicked"
-    elif "mild cough" in symptoms_str and patient.vitals["heart_rate"] < 100:
-        detected_mood = "calm"
-    return detected_mood
-
-class MentalHealthAnalyzerAgent:
-    def __init__(self):
-        self._GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-        self.llm = ChatGroq(api_key=self._GROQ_API_KEY, model_name="deepseek-r1-distill-llama-70b")
-
-    def __call__(self, state: AgentState) -> AgentState:
-        debug(f"Entering {self.__class__.__name__} call...")
-        patient = state["patient"]
-        patient = state["patient"]
-        blood_pressure = patient.vitals.get("blood_pressure", {})
-        systolic = blood_pressure.get("systolic", 120)
-        diastolic = blood_pressure.get("diastolic", 80)
-        
-        query = f"""
-            INSERT INTO patient_info(patient_name, email, phone, gender, symptoms, symptoms_duration, vitals)
-            VALUES ('{patient.name}', '{patient.email}', NULL, '{patient.gender}',
-            '{", ".join(patient.symptoms)}','{patient.symptom_duration}','{str(patient.vitals).replace("'","\"")}');
-            """
-        print(query)
-        cursor.execute(query)
-        conn.commit()
-        debug("Patient information inserted successfully...")
-        prompt = f"""Analyze patient's emotional state based on:
-        - Vitals: BP {systolic}/{diastolic}, HR {patient.vitals.get("heart_rate", 80)}
-        - Symptoms: {patient.symptoms}
-        - Duration: {patient.symptom_duration} hours
-        - Age: {patient.age}
-        Return JSON: {{ "mood": "chosen_mood" }}"""
-        
-        response = self.llm.invoke([HumanMessage(content=prompt)])
-        debug("Got mood estimate from LLM...")
-        try:
-            if '{' in response.content:
-                mood_info = json.loads(response.content[response.content.find('{'):response.content.rfind('}')+1])
-                if "mood" in mood_info:
-                    detected_mood = adjust_mood_based_on_vitals(patient, mood_info["mood"])
-                    patient.mood = detected_mood
-                    debug("Successfully completed task. Updating status...")
-                    mood_emoji = {"calm":"😌", "frustrated":"😖","anxious":"😥","stressed":"😧","confused":"😵‍💫","panicked":"🫨"}
-                    state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : Detected Mood is {patient.mood} {mood_emoji[patient.mood]}")
-                    state["status"]["MoodAnalyzer"] = "Success"
-                    debug(f"Exiting {self.__class__.__name__} call...")
-        except Exception as e:
-            debug(f"Error estimating the mood...\n{e}")
-            state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : {str(e)}")
-            state["status"]["MoodAnalyzer"] = "Failed"
-        return state
-
-class EmergencyTriageAgent:
-    def __init__(self):
-        self._GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-        self.llm = ChatGroq(api_key=self._GROQ_API_KEY, model_name="deepseek-r1-distill-llama-70b")
-    
-    def __call__(self, state: AgentState) -> AgentState:
-        debug(f"Entering {self.__class__.__name__} call...")
-        patient = state["patient"]
-        bp = patient.vitals.get("blood_pressure", {})
-        hr = patient.vitals.get("heart_rate", 80)
-        prompt = f"""Assign triage_level (1-5) and department based on:
-        - Symptoms: {patient.symptoms}
-        - BP: {bp.get('systolic', 120)}/{bp.get('diastolic', 80)}
-        - HR: {hr}
-        - Mood: {patient.mood}
-        - Age: {patient.age}
-        - Duration: {patient.symptom_duration}h
-        Return JSON: {{"triage_level": number, "department": "string"}}
-        return value of department should be in ["Cardiology","Pediatrics","Neurology","Dentist"]"""
-        
-        llm = ChatGroq(api_key=self._GROQ_API_KEY, model_name="deepseek-r1-distill-llama-70b")
-        response = llm.invoke([HumanMessage(content=prompt)])
-        debug("Got triage level from the LLM...")
-        try:
-            if '{' in response.content:
-                triage_info = json.loads(response.content[response.content.find('{'):response.content.rfind('}')+1])
-                if "triage_level" in triage_info and "department" in triage_info:
-                    patient.triage_level = triage_info["triage_level"]
-                    patient.department = triage_info["department"]
-                    debug(f"triage level : {triage_info["triage_level"]}, department : {triage_info["department"]}")
-                    debug("Successfully completed task. Updating status...")
-                    state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : Level {patient.triage_level} -> {patient.department}")
-                    state["status"]["EmergencyTriage"] = "Success"
-                    debug(f"Exiting {self.__class__.__name__} call...")
-        except Exception as e:
-            debug(f"Error estimating the triage...\n{e}")
-            state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : Error estimating the traige : {str(e)}")
-            state["status"]["EmergencyTriage"] = "Failed"
-        return state
-
-class DoctorSchedulerAgent:
-    def __call__(self, state: AgentState) -> AgentState:
-        debug(f"Entering {self.__class__.__name__} call...")
-        patient = state["patient"]
-        dept = patient.department
-        now = datetime.now(pytz.timezone('US/Eastern'))
-        formatted_time = now.strftime("%I:%M %p")
-        debug("fAttempting to fetch available {dept} specialist doctors...")
-        query = f"SELECT * FROM get_available_doctors('{dept}');"
-        cursor.execute(query)
-        available = cursor.fetchall()
-        debug("Fetched the available doctors...")
-        print(f"available = {available}")
-        if available:
-            assigned_doctor_details = random.choice(available)
-            patient.assigned_doctor = assigned_doctor_details[1]
-            state["cache"]["doctor_assigned"] = assigned_doctor_details
-            block_duration = get_block_duration(patient.triage_level)
-            blocked_until = now + block_duration
-            print(f"block_until = {blocked_until}")
-            state["cache"]["doctor_blocked_from"] = now
-            state["cache"]["doctor_blocked_until"] = blocked_until
-            debug("Attempting to allocate doctor...")
-            cursor.execute(f"""
-                UPDATE doctors SET is_busy = TRUE,
-                                   busy_from = '{now}', 
-                                   busy_till = '{blocked_until}'
-                                   WHERE doctor_id = {assigned_doctor_details[0]};
-            """)
-            conn.commit()
-            debug("Successfully alloted doctor...")
-            state["status"]["DoctorScheduler"] = "Success"
-            state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : Assigned {patient.assigned_doctor} to {patient.name}")
-            debug(f"Exiting {self.__class__.__name__} call...")
-        else:
-            debug("No doctors available...")
-            state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : No {dept} doctor availble.")
-            state["status"]["DoctorScheduler"] = "Failed"
-        debug(f"Exiting {self.__class__.__name__} call...")
-        return state
-
-class BedManagerAgent:
-    def __call__(self, state: AgentState) -> AgentState:
-        debug(f"Entering {self.__class__.__name__} call...")
-        patient = state["patient"]
-        level = patient.triage_level
-        if level == 5:
-            self.bed_priority = ["ICU", "Emergency"]
-        elif level in [3, 4]:
-            self.bed_priority = ["Ward", "Emergency"]
-        else:
-            self.bed_priority = ["Normal", "Ward", "Emergency"]
-        
-        for bed_type in self.bed_priority:
-            debug("Attempting to find available bed...")
-            cursor.execute(f"SELECT * FROM get_available_rooms('{bed_type}')")
-            available_bed_details = cursor.fetchall()
-            debug(f"Checking bed type {bed_type}...")
-            if available_bed_details:
-                debug(f"Found a bed that matches requirements in {bed_type}...")
-                patient.assigned_bed = available_bed_details[0][0]
-                state["cache"]["bed_assigned"] = available_bed_details
-                query = f"""
-                    UPDATE rooms SET is_occupied = TRUE WHERE room_number = {available_bed_details[0][0]};
-                """
-                print(query)
-                cursor.execute(query)
-                conn.commit()
-                debug("Successfully allocated a bed...")
-                state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : {patient.name} assigned to {bed_type} bed {patient.assigned_bed} (triage {level})")
-                # state["logs"].append(
-                #      f"BedManager: {patient.name} assigned to {bed_type} bed {patient.assigned_bed} (triage {level})")
-                state["status"]["BedManager"] = "Success"
-                debug(f"Exiting {self.__class__.__name__} call...")
-                return state        
-        debug("No beds found...")
-        state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : No beds available for {patient.name}")
-        state["status"]["BedManager"] = "Failed"
-        debug(f"Exiting {self.__class__.__name__} call...")
-        return state
-    
-class ConflictResolverAgent:
-    def __call__(self, state: AgentState) -> AgentState:
-        debug(f"Entering {self.__class__.__name__} call...")
-        patient = state["patient"]
-        bed_status = state["status"]["BedManager"]
-        doctor_status = state["status"]["DoctorScheduler"]
-        debug("Checking for conflicts in decision making...")
-        patient.calculate_priority()
-        debug(f"Calculated priority score : {patient.priority_score}")
-        state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : Calculated priority score : {patient.priority_score}")
-        if bed_status == "Success" and doctor_status == "Success":
-            debug("No conflicts found. Attempting to create a case...")
-            cursor.execute(f"""
-                    INSERT INTO ongoing_cases(patient_id, doctor_id, room_number)
-                    VALUES ((SELECT patient_id FROM patient_info WHERE email = '{patient.email}'),
-                    '{state["cache"]["doctor_assigned"][0]}',
-                    '{state["cache"]["bed_assigned"][0][0]}');""")
-            state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : Assigning available doctor and bed to {patient.name}")
-            state["status"]["ConflictResolver"] = "Success"
-            print(f"State print from CONFLICT :\n\n{state}")
-        elif bed_status == "Success" and doctor_status == "Failed":
-            debug("There's a conflict!! Doctor not available at this moment. Queuing the admission form...")
-            # Release the bed that was alloted
-            query = f"""
-                UPDATE rooms SET is_occupied=FALSE WHERE room_number = {patient.assigned_bed};
-            """
-            cursor.execute(query)
-            conn.commit()
-            debug("Reverted the allocated bed...")
-            state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : No doctors available at this moment. Queuing the application.")
-            state["status"]["ConflictResolver"] = "Queued"
-        elif bed_status == "Failed" and doctor_status == "Success":
-            debug("There's a conflict!! Bed not available at this moment. Queuing the admission form...")
-            # Release the doctor that was alloted
-            query = f""""
-                UPDATE doctors SET is_busy=FALSE, busy_from=NULL, busy_until=NULL WHERE doctor_id = {state["cache"]["doctor_assigned"][0]};
-            """
-            cursor.execute(query)
-            conn.commit()
-            debug("Reverted the allocated doctor...")
-            state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : No beds available at this moment. Queuing the application.")
-            state["status"]["ConflictResolver"] = "Queued"
-        else:
-            debug("There's a conflict!! No bed or doctor available at this moment. Please try at nearby hospitals...")
-            state["logs"].append(f"[{get_current_time_with_ms()}] {self.__class__.__name__} : No beds and doctors available at this moment. Please try at nearby hospitals.")
-            state["logs"].append(f"ConflictResolver: ")
-            state["status"]["ConflictResolver"] = "Failed"
-        
-        if state["status"]["ConflictResolver"] == "Queued":
-            query = f"""
-                INSERT INTO queue VALUES (
-                    (SELECT patient_id FROM patient_info WHERE email='{patient.email}'),
-                    {patient.priority_score},
-                    '{patient.bed_priority[0] if bed_status=="Failed" else state["cache"]["bed_assigned"][1][1]}'
-                );
-            """
-            cursor.execute(query)
-            conn.commit()
-            debug("Application queued...")
-            state["status"]["ConflictResolver"] = "Success"
-        debug(f"Exiting {self.__class__.__name__} call...")
-        return state
\ No newline at end of file
+from typing import TypedDict, List, Dict, Annotated
+import operator
+import os, json, time, zlib, asyncio
+from datetime import datetime, timedelta
+from db import db_cursor, async_db_cursor
+from metrics import inc
+from llm_gateway import get_llm_gateway, human_message, llm_streaming_enabled, LLMUnavailableError
+from llm_stream import read_answer
+from llm_cache import get_llm_cache, llm_cache_enabled, make_cache_key
+from triage_rules import (DEPARTMENTS, assess_with_rules, fast_path_enabled, fast_path_threshold, mood_override,
+                          rule_stats)
+from journal import EASTERN, Event
+from speculation import (speculation_enabled, start_hold, finish_hold, aplace_hold, afinish_hold, release_holds,
+                         arelease_holds, take, record_used, record_saved, RELEASE_QUERY as RELEASE_HOLDS_QUERY)
+from federation import get_federation_router
+from allocator import allocator_enabled, get_allocator, ready_allocator
+from logging import debug
+
+queued_patients = []
+
+LLM_MODEL = "deepseek-r1-distill-llama-70b"
+# Bump these whenever a prompt changes so cached answers from the old prompt are ignored.
+MOOD_PROMPT_VERSION = "mood-v1"
+TRIAGE_PROMPT_VERSION = "triage-v1"
+ASSESSMENT_PROMPT_VERSION = "assessment-v1"
+
+# resource_counters is kept current by triggers on rooms and doctors, so the
+# census is a few rows no matter how many beds or doctors there are.
+RESOURCE_COUNTERS_QUERY = """
+    SELECT category, available, occupied
+    FROM resource_counters
+    WHERE kind = %s AND available + occupied > 0
+    ORDER BY category;
+    """
+
+def get_resource_counts(kind):
+    with db_cursor() as cursor:
+        cursor.execute(RESOURCE_COUNTERS_QUERY, (kind,))
+        rows = cursor.fetchall()
+    output = {}
+    for data in rows:
+        output[data[0]] = data[1:]
+    return output
+
+def get_beds():
+    return get_resource_counts("room")
+
+def get_doctor_counts():
+    return get_resource_counts("doctor")
+
+def check_resource_counters():
+    # Recounts from the base tables and repairs the counters; returns the rows that had drifted.
+    with db_cursor() as cursor:
+        cursor.execute("SELECT * FROM rebuild_resource_counters();")
+        rows = cursor.fetchall()
+    cols = ["kind","category","stored_available","stored_occupied","counted_available","counted_occupied"]
+    drift = [dict(zip(cols, row)) for row in rows]
+    if drift:
+        debug(f"Resource counters had drifted, rebuilt...\n{drift}")
+    return drift
+
+def get_doctor_status():
+    debug("Getting doctor status update...")
+    query = f"""
+        SELECT
+            d.name doctor_name,
+            d.specialist department,
+            (CASE WHEN d.is_busy=TRUE THEN 'BUSY' ELSE 'AVAILABLE' END) status,
+            (CASE WHEN d.is_busy=TRUE THEN p.patient_name ELSE NULL END) with_patient,
+            (CASE WHEN d.is_busy=TRUE THEN ROUND(EXTRACT(EPOCH FROM (d.busy_till - CURRENT_TIMESTAMP)) / 60,2) ELSE NULL END) time_remaining,
+            (CASE WHEN d.is_busy=TRUE THEN d.busy_till ELSE NULL END) finish_time,
+            (CASE WHEN d.is_busy=TRUE THEN d.busy_from ELSE NULL END) start_time
+        FROM doctors d
+        LEFT JOIN ongoing_cases oc
+        ON d.doctor_id = oc.doctor_id
+        LEFT JOIN patient_info p
+        ON oc.patient_id = p.patient_id;
+    """
+    # A pure read: expired doctors are released by the background worker in expiry.py.
+    with db_cursor() as cursor:
+        cursor.execute(query)
+        rows = cursor.fetchall()
+    output = []
+    cols = ["doctor_name","department","status","with_patient","time_remaining","finish_time","start_time"]
+    for i in range(len(rows)):
+        temp_dict = {}
+        for idx, data in enumerate(rows[i]):
+            temp_dict[cols[idx]] = data
+        output.append(temp_dict)
+    return output
+
+def get_block_duration(triage_level):
+    return timedelta(minutes=max(1, triage_level))
+
+def get_bed_priority(triage_level):
+    if triage_level == 5:
+        return ["ICU", "Emergency"]
+    elif triage_level in [3, 4]:
+        return ["Ward", "Emergency"]
+    return ["Normal", "Ward", "Emergency"]
+
+def get_current_est_time():
+    return datetime.now(EASTERN)
+
+class Patient:
+    def __init__(self, name, vitals, email, gender, age, symptoms, symptom_duration):
+        self.name = name
+        self.symptoms = symptoms
+        self.symptom_duration = symptom_duration
+        self.email = email
+        self.phone = None
+        self.age = age
+        self.vitals = vitals
+        self.gender = gender
+        self.mood = None
+        self.triage_level = None
+        self.department = None
+        self.assigned_doctor = None
+        self.assigned_bed = None
+        self.bed_priority = None
+        self.priority_score = 0.0
+        self.entry_time = get_current_est_time()
+        self.treatment_completed = False
+        self.treatment_end_time = None
+
+    def calculate_priority(self):
+        triage_weight = 10
+        triage_score = self.triage_level * triage_weight
+        
+        if self.age >= 50:
+            age_score = 8
+        elif self.age < 15:
+            age_score = 5
+        else:
+            age_score = 0
+            
+        hr = self.vitals.get("heart_rate", 80)
+        bp_sys = self.vitals.get("blood_pressure", {}).get("systolic", 120)
+        bp_dia = self.vitals.get("blood_pressure", {}).get("diastolic", 80)
+        
+        hr_dev = max(hr - 100, 60 - hr, 0)
+        bp_sys_dev = abs(bp_sys - 120) if bp_sys > 140 or bp_sys < 90 else 0
+        bp_dia_dev = abs(bp_dia - 80) if bp_dia > 90 or bp_dia < 60 else 0
+        vital_score = (hr_dev + bp_sys_dev + bp_dia_dev) * 0.7
+        
+        duration_score = self.symptom_duration * 0.2
+        
+        self.priority_score = round(triage_score + age_score + vital_score + duration_score, 1)
+
+    def to_dict(self):
+        # A patient whose triage failed never got a score, and there is nothing to score them on.
+        if self.triage_level is not None:
+            self.calculate_priority()
+        return {
+            "name": self.name,
+            "symptoms": self.symptoms,
+            "symptom_duration": self.symptom_duration,
+            "contact_number": self.phone,
+            "age": self.age,
+            "email": self.email,
+            "gender": self.gender,
+            "mood": self.mood,
+            "triage_level": self.triage_level,
+            "department": self.department,
+            "assigned_doctor": self.assigned_doctor,
+            "assigned_bed": self.assigned_bed,
+            "priority_score": self.priority_score,
+            "treatment_completed": self.treatment_completed,
+            "treatment_end_time": self.treatment_end_time.strftime('%H:%M:%S.%f')[:-3] if self.treatment_end_time else None,
+            "entry_time": self.entry_time.strftime('%H:%M:%S.%f')[:-3]
+        }
+
+def merge_dicts(left, right):
+    return {**left, **right}
+
+# logs/status/cache have reducers so parallel branches (doctor and bed) can both
+# write to them in the same step; agents return only what they changed.
+class AgentState(TypedDict):
+    patient: Patient
+    logs: Annotated[List[Event], operator.add]
+    status: Annotated[dict, merge_dicts]
+    cache: Annotated[dict, merge_dicts]
+
+def apply_update(state, update):
+    # Same merge rules as the AgentState reducers, for running agents outside the graph.
+    state["logs"] = state["logs"] + update.get("logs", [])
+    state["status"] = merge_dicts(state["status"], update.get("status", {}))
+    state["cache"] = merge_dicts(state["cache"], update.get("cache", {}))
+    if "patient" in update:
+        state["patient"] = update["patient"]
+    return state
+
+def new_update(patient=None):
+    update = {"logs": [], "status": {}, "cache": {}}
+    if patient is not None:
+        update["patient"] = patient
+    return update
+
+MOOD_EMOJI = {"calm":"😌", "frustrated":"😖","anxious":"😥","stressed":"😧","confused":"😵‍💫","panicked":"🫨"}
+
+def log_event(agent, state, update, kind, outcome=None, **payload):
+    # Just the values; journal.render_event() turns them into a log line when one is displayed.
+    patient_id = update["cache"].get("patient_id") or state["cache"].get("patient_id")
+    update["logs"].append(Event(time.monotonic_ns(), agent.__class__.__name__, patient_id, outcome, kind, payload))
+
+def record_outcomes(update):
+    # ConflictResolver reports queued admissions as Success; the cache flag keeps them apart here.
+    for agent, outcome in update.get("status", {}).items():
+        if agent == "ConflictResolver" and update.get("cache", {}).get("queued"):
+            outcome = "Queued"
+        inc("shmas_agent_outcomes_total", agent=agent, outcome=outcome)
+
+PATIENT_INSERT_QUERY = """
+    INSERT INTO patient_info(patient_name, email, phone, gender, symptoms, symptoms_duration, vitals)
+    VALUES %s
+    RETURNING patient_id, email;
+    """
+# Batch intake: a returning patient keeps their patient_id and gets today's details.
+PATIENT_UPSERT_QUERY = """
+    INSERT INTO patient_info(patient_name, email, phone, gender, symptoms, symptoms_duration, vitals)
+    VALUES %s
+    ON CONFLICT (email) DO UPDATE
+        SET patient_name = EXCLUDED.patient_name, phone = EXCLUDED.phone, gender = EXCLUDED.gender,
+            symptoms = EXCLUDED.symptoms, symptoms_duration = EXCLUDED.symptoms_duration, vitals = EXCLUDED.vitals
+    RETURNING patient_id, email;
+    """
+PATIENT_ROW_TEMPLATE = "(%s, %s, %s, %s, %s, %s, %s)"
+
+def patient_insert_row(patient):
+    return (patient.name, patient.email, None, patient.gender, ", ".join(patient.symptoms),
+            str(patient.symptom_duration), json.dumps(patient.vitals))
+
+def register_patient(state, update):
+    # Batch admissions register patients up front in one multi-row insert.
+    if "patient_id" not in state["cache"]:
+        with db_cursor() as cursor:
+            cursor.execute(PATIENT_INSERT_QUERY % "(%s, %s, %s, %s, %s, %s, %s)", patient_insert_row(state["patient"]))
+            update["cache"]["patient_id"] = cursor.fetchone()[0]
+        debug("Patient information inserted successfully...")
+
+async def aregister_patient(state, update):
+    if "patient_id" not in state["cache"]:
+        async with async_db_cursor() as cursor:
+            await cursor.execute(PATIENT_INSERT_QUERY % "(%s, %s, %s, %s, %s, %s, %s)",
+                                 patient_insert_row(state["patient"]))
+            update["cache"]["patient_id"] = (await cursor.fetchone())[0]
+        debug("Patient information inserted successfully...")
+
+def priority_inputs(patient):
+    # Stored with the queue entry so rescoring.py can recompute calculate_priority() while the patient waits.
+    return patient.triage_level, patient.age, float(patient.symptom_duration)
+
+def adjust_mood_based_on_vitals(patient, detected_mood):
+    return mood_override(patient) or detected_mood
+
+def strict_answers_enabled():
+    # Strict mode takes only answers whose values are usable (known mood, level 1-5, a real
+    # department) and fails the agent otherwise, instead of trusting whatever the keys hold.
+    return os.getenv("SHMAS_LLM_STRICT", "0") == "1"
+
+def is_mood_answer(answer):
+    if "mood" not in answer:
+        return False
+    return not strict_answers_enabled() or answer["mood"] in MOOD_EMOJI
+
+def is_triage_answer(answer):
+    if "triage_level" not in answer or "department" not in answer:
+        return False
+    if not strict_answers_enabled():
+        return True
+    level = answer["triage_level"]
+    return type(level) is int and 1 <= level <= 5 and answer["department"] in DEPARTMENTS
+
+def is_assessment_answer(answer):
+    return is_mood_answer(answer) and is_triage_answer(answer)
+
+def assessment_arm(patient, share=None):
+    # Hashing the email keeps a patient in the same arm if the admission is submitted again.
+    if share is None:
+        share = float(os.getenv("SHMAS_ASSESSMENT_COMBINED_SHARE", "0.5"))
+    return "combined" if zlib.crc32(patient.email.encode()) % 1000 < share * 1000 else "split"
+
+def parse_answer(content, accepts):
+    if strict_answers_enabled():
+        # The first acceptable object after the reasoning, rather than the span between the outermost braces.
+        answer = read_answer([content], accepts).answer
+        if answer is None:
+            raise ValueError("No valid answer in the LLM reply")
+        return answer
+    return json.loads(content[content.find('{'):content.rfind('}')+1])
+
+def ask_llm(llm, prompt, accepts):
+    # Streaming stops the generation as soon as an acceptable JSON object has arrived.
+    if llm_streaming_enabled():
+        return llm.stream_answer([human_message(prompt)], accepts).content
+    return llm.invoke([human_message(prompt)]).content
+
+async def aask_llm(llm, prompt, accepts):
+    if llm_streaming_enabled():
+        return (await llm.astream_answer([human_message(prompt)], accepts)).content
+    return (await llm.ainvoke([human_message(prompt)])).content
+
+def _speculate(state):
+    # Batch admissions allocate sickest first after everyone is triaged, so they don't hold early.
+    # In-memory claims take microseconds, so there is nothing for a hold to hide.
+    return (speculation_enabled() and not allocator_enabled() and "patient_id" in state["cache"]
+            and state["cache"].get("speculate", True))
+
+def begin_speculation(state, rules):
+    """Holds the doctor and bed the rules predict, in the background, while the caller asks the LLM."""
+    if not _speculate(state):
+        return None
+    return start_hold(state["cache"]["patient_id"], rules.department, get_bed_priority(rules.triage_level)[0])
+
+def abegin_speculation(state, rules):
+    if not _speculate(state):
+        return None
+    return asyncio.ensure_future(aplace_hold(state["cache"]["patient_id"], rules.department,
+                                             get_bed_priority(rules.triage_level)[0]))
+
+def end_speculation(update, pending):
+    # The hold goes to the doctor and bed agents with the triage result, or back if triage failed.
+    hold = finish_hold(pending) if pending is not None else None
+    if hold is None:
+        return
+    if update["status"].get("EmergencyTriage") == "Success":
+        update["cache"]["speculation"] = hold
+    else:
+        release_holds(hold.patient_id)
+
+async def aend_speculation(update, pending):
+    hold = await afinish_hold(pending) if pending is not None else None
+    if hold is None:
+        return
+    if update["status"].get("EmergencyTriage") == "Success":
+        update["cache"]["speculation"] = hold
+    else:
+        await arelease_holds(hold.patient_id)
+
+def cached_llm_answer(key):
+    if not llm_cache_enabled():
+        return None
+    answer = get_llm_cache().get(key)
+    if answer is not None:
+        debug("LLM cache hit, skipping model call...")
+    return answer
+
+def remember_llm_answer(key, answer):
+    # The object that was accepted, not the reply's text: that may quote other objects while thinking.
+    if answer is not None and llm_cache_enabled():
+        get_llm_cache().put(key, json.dumps(answer))
+
+class MentalHealthAnalyzerAgent:
+    @property
+    def llm(self):
+        return get_llm_gateway()
+
+    def _build_prompt(self, patient):
+        blood_pressure = patient.vitals.get("blood_pressure", {})
+        systolic = blood_pressure.get("systolic", 120)
+        diastolic = blood_pressure.get("diastolic", 80)
+        return f"""Analyze patient's emotional state based on:
+        - Vitals: BP {systolic}/{diastolic}, HR {patient.vitals.get("heart_rate", 80)}
+        - Symptoms: {patient.symptoms}
+        - Duration: {patient.symptom_duration} hours
+        - Age: {patient.age}
+        Return JSON: {{ "mood": "chosen_mood" }}"""
+
+    def _apply_response(self, state, update, content):
+        self._accept(state, update, content)
+        return update
+
+    def _accept(self, state, update, content):
+        # Applies the mood in the reply; returns the answer taken from it, or None.
+        patient = state["patient"]
+        debug("Got mood estimate from LLM...")
+        try:
+            if '{' in content:
+                mood_info = parse_answer(content, is_mood_answer)
+                if is_mood_answer(mood_info):
+                    detected_mood = adjust_mood_based_on_vitals(patient, mood_info["mood"])
+                    patient.mood = detected_mood
+                    debug("Successfully completed task. Updating status...")
+                    log_event(self, state, update, "mood", "Success", mood=patient.mood, emoji=MOOD_EMOJI[patient.mood])
+                    update["status"]["MoodAnalyzer"] = "Success"
+                    debug(f"Exiting {self.__class__.__name__} call...")
+                    return mood_info
+                elif strict_answers_enabled():
+                    raise ValueError(f"Rejected mood answer {mood_info}")
+        except Exception as e:
+            self._record_failure(state, update, e)
+        return None
+
+    def _record_failure(self, state, update, e):
+        debug(f"Error estimating the mood...\n{e}")
+        log_event(self, state, update, "mood_error", "Error", error=str(e))
+        update["status"]["MoodAnalyzer"] = "Failed"
+        return update
+
+    def _cache_key(self, patient):
+        return make_cache_key("mood", patient, MOOD_PROMPT_VERSION, LLM_MODEL)
+
+    def _answer_locally(self, state, update):
+        patient = state["patient"]
+        rules = assess_with_rules(patient)
+        if fast_path_enabled() and rules.mood_confidence >= fast_path_threshold():
+            debug(f"Rule engine decided the mood ({', '.join(rules.reasons)}), skipping LLM...")
+            rule_stats.record_fast_path("mood")
+            return rules, self._apply_response(state, update, json.dumps({"mood": rules.mood}))
+        cached = cached_llm_answer(self._cache_key(patient))
+        if cached is not None:
+            self._apply_response(state, update, cached)
+            self._record_fallback(state, update, rules)
+            return rules, update
+        return rules, None
+
+    def _record_fallback(self, state, update, rules):
+        succeeded = update["status"].get("MoodAnalyzer") == "Success"
+        rule_stats.record_fallback("mood", rules.mood, state["patient"].mood if succeeded else None)
+        return succeeded
+
+    def _apply_llm_response(self, state, update, rules, content):
+        answer = self._accept(state, update, content)
+        self._record_fallback(state, update, rules)
+        remember_llm_answer(self._cache_key(state["patient"]), answer)
+        return update
+
+    def __call__(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} call...")
+        patient = state["patient"]
+        update = new_update(patient)
+        register_patient(state, update)
+        rules, answered = self._answer_locally(state, update)
+        if answered is not None:
+            return answered
+        try:
+            content = ask_llm(self.llm, self._build_prompt(patient), is_mood_answer)
+        except LLMUnavailableError as e:
+            return self._record_failure(state, update, e)
+        return self._apply_llm_response(state, update, rules, content)
+
+    async def acall(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} async call...")
+        patient = state["patient"]
+        update = new_update(patient)
+        await aregister_patient(state, update)
+        rules, answered = self._answer_locally(state, update)
+        if answered is not None:
+            return answered
+        try:
+            content = await aask_llm(self.llm, self._build_prompt(patient), is_mood_answer)
+        except LLMUnavailableError as e:
+            return self._record_failure(state, update, e)
+        return self._apply_llm_response(state, update, rules, content)
+
+class EmergencyTriageAgent:
+    @property
+    def llm(self):
+        return get_llm_gateway()
+
+    def _cache_key(self, patient):
+        # The triage prompt includes the detected mood, so it is part of the key.
+        return make_cache_key("triage", patient, TRIAGE_PROMPT_VERSION, LLM_MODEL, extra=[patient.mood])
+
+    def _fast_path(self, state, update):
+        rules = assess_with_rules(state["patient"])
+        if fast_path_enabled() and rules.triage_confidence >= fast_path_threshold():
+            debug(f"Rule engine decided the triage ({', '.join(rules.reasons)}), skipping LLM...")
+            rule_stats.record_fast_path("triage")
+            answer = {"triage_level": rules.triage_level, "department": rules.department}
+            return rules, self._apply_response(state, update, json.dumps(answer))
+        return rules, None
+
+    def _answer_locally(self, state, update):
+        rules, answered = self._fast_path(state, update)
+        if answered is not None:
+            return rules, answered
+        cached = cached_llm_answer(self._cache_key(state["patient"]))
+        if cached is not None:
+            self._apply_response(state, update, cached)
+            self._record_fallback(state, update, rules)
+            return rules, update
+        return rules, None
+
+    def _record_fallback(self, state, update, rules):
+        patient = state["patient"]
+        succeeded = update["status"].get("EmergencyTriage") == "Success"
+        rule_stats.record_fallback("triage", (rules.triage_level, rules.department),
+                                   (patient.triage_level, patient.department) if succeeded else None)
+        return succeeded
+
+    def _apply_llm_response(self, state, update, rules, content):
+        answer = self._accept(state, update, content)
+        self._record_fallback(state, update, rules)
+        remember_llm_answer(self._cache_key(state["patient"]), answer)
+        return update
+
+    def _build_prompt(self, patient):
+        bp = patient.vitals.get("blood_pressure", {})
+        hr = patient.vitals.get("heart_rate", 80)
+        return f"""Assign triage_level (1-5) and department based on:
+        - Symptoms: {patient.symptoms}
+        - BP: {bp.get('systolic', 120)}/{bp.get('diastolic', 80)}
+        - HR: {hr}
+        - Mood: {patient.mood}
+        - Age: {patient.age}
+        - Duration: {patient.symptom_duration}h
+        Return JSON: {{"triage_level": number, "department": "string"}}
+        return value of department should be in ["Cardiology","Pediatrics","Neurology","Dentist"]"""
+
+    def _apply_response(self, state, update, content):
+        self._accept(state, update, content)
+        return update
+
+    def _accept(self, state, update, content):
+        # Applies the triage in the reply; returns the answer taken from it, or None.
+        patient = state["patient"]
+        debug("Got triage level from the LLM...")
+        try:
+            if '{' in content:
+                triage_info = parse_answer(content, is_triage_answer)
+                if is_triage_answer(triage_info):
+                    patient.triage_level = triage_info["triage_level"]
+                    patient.department = triage_info["department"]
+                    debug(f"triage level : {triage_info['triage_level']}, department : {triage_info['department']}")
+                    debug("Successfully completed task. Updating status...")
+                    log_event(self, state, update, "triage", "Success", triage_level=patient.triage_level, department=patient.department)
+                    update["status"]["EmergencyTriage"] = "Success"
+                    debug(f"Exiting {self.__class__.__name__} call...")
+                    return triage_info
+                elif strict_answers_enabled():
+                    raise ValueError(f"Rejected triage answer {triage_info}")
+        except Exception as e:
+            self._record_failure(state, update, e)
+        return None
+
+    def _record_failure(self, state, update, e):
+        debug(f"Error estimating the triage...\n{e}")
+        log_event(self, state, update, "triage_error", "Error", error=str(e))
+        update["status"]["EmergencyTriage"] = "Failed"
+        return update
+
+    def __call__(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} call...")
+        update = new_update(state["patient"])
+        rules, answered = self._answer_locally(state, update)
+        if answered is not None:
+            return answered
+        prompt = self._build_prompt(state["patient"])
+        pending = begin_speculation(state, rules)
+        try:
+            content = ask_llm(self.llm, prompt, is_triage_answer)
+        except LLMUnavailableError as e:
+            self._record_failure(state, update, e)
+        else:
+            self._apply_llm_response(state, update, rules, content)
+        end_speculation(update, pending)
+        return update
+
+    async def acall(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} async call...")
+        update = new_update(state["patient"])
+        rules, answered = self._answer_locally(state, update)
+        if answered is not None:
+            return answered
+        prompt = self._build_prompt(state["patient"])
+        pending = abegin_speculation(state, rules)
+        try:
+            content = await aask_llm(self.llm, prompt, is_triage_answer)
+        except LLMUnavailableError as e:
+            self._record_failure(state, update, e)
+        else:
+            self._apply_llm_response(state, update, rules, content)
+        await aend_speculation(update, pending)
+        return update
+
+class PatientAssessmentAgent:
+    """Mood, triage level and department from one LLM call instead of two.
+
+    Takes the place of the mood and triage nodes. The rule fast path and the
+    mood cache are tried first, as in the two-call path, and if the mood is
+    settled without the model only the triage agent's own call is left. The
+    combined answer is applied by the mood and triage agents, so
+    adjust_mood_based_on_vitals, strict validation and the log events are the
+    same on both paths. With mode="ab" each patient goes down the combined or
+    the two-call path according to assessment_arm().
+    """
+
+    def __init__(self, mood_agent=None, triage_agent=None, mode="combined"):
+        self.mood = mood_agent or MentalHealthAnalyzerAgent()
+        self.triage = triage_agent or EmergencyTriageAgent()
+        self.mode = mode
+
+    @property
+    def llm(self):
+        return get_llm_gateway()
+
+    def _arm(self, patient):
+        return assessment_arm(patient) if self.mode == "ab" else self.mode
+
+    def _cache_key(self, patient):
+        return make_cache_key("assessment", patient, ASSESSMENT_PROMPT_VERSION, LLM_MODEL)
+
+    def _build_prompt(self, patient):
+        bp = patient.vitals.get("blood_pressure", {})
+        return f"""Analyze patient's emotional state, then assign triage_level (1-5) and department based on:
+        - Symptoms: {patient.symptoms}
+        - BP: {bp.get('systolic', 120)}/{bp.get('diastolic', 80)}
+        - HR: {patient.vitals.get("heart_rate", 80)}
+        - Age: {patient.age}
+        - Duration: {patient.symptom_duration}h
+        Return JSON: {{"mood": "chosen_mood", "triage_level": number, "department": "string"}}
+        return value of department should be in {json.dumps(DEPARTMENTS, separators=(",", ":"))}"""
+
+    def _record_failure(self, state, update, e):
+        self.mood._record_failure(state, update, e)
+        return self.triage._record_failure(state, update, e)
+
+    def _apply_answer(self, state, update, mood_rules, content, cached):
+        mood_answer = self.mood._accept(state, update, content)
+        self.mood._record_fallback(state, update, mood_rules)
+        # A confident triage rule still wins over the model, as it does on the two-call path. The
+        # triage agent's cache is not consulted: its answers came from a different prompt.
+        triage_rules, answered = self.triage._fast_path(state, update)
+        triage_answer = None
+        if answered is None:
+            triage_answer = self.triage._accept(state, update, content)
+            self.triage._record_fallback(state, update, triage_rules)
+        # Only an answer taken wholly from the model is cached.
+        if not cached and mood_answer is not None and triage_answer is not None:
+            remember_llm_answer(self._cache_key(state["patient"]), {**mood_answer, **triage_answer})
+        return update
+
+    def _split(self, state):
+        update = self.mood(state)
+        return apply_update(update, self.triage(dict(state, cache=merge_dicts(state["cache"], update["cache"]))))
+
+    async def _asplit(self, state):
+        update = await self.mood.acall(state)
+        return apply_update(update, await self.triage.acall(dict(state, cache=merge_dicts(state["cache"], update["cache"]))))
+
+    def _record_arm(self, state, update, arm):
+        inc("shmas_assessments_total", arm=arm)
+        update["cache"]["assessment"] = arm
+        return dict(state, cache=merge_dicts(state["cache"], update["cache"]))
+
+    def __call__(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} call...")
+        patient = state["patient"]
+        if self._arm(patient) == "split":
+            update = self._split(state)
+            self._record_arm(state, update, "split")
+            return update
+        update = new_update(patient)
+        register_patient(state, update)
+        state = self._record_arm(state, update, "combined")
+        mood_rules, answered = self.mood._answer_locally(state, update)
+        if answered is not None:
+            # Only the triage is left for the model, which is the triage agent's usual call.
+            return apply_update(update, self.triage(state))
+        content = cached_llm_answer(self._cache_key(patient))
+        cached = content is not None
+        if not cached:
+            pending = begin_speculation(state, mood_rules)
+            try:
+                content = ask_llm(self.llm, self._build_prompt(patient), is_assessment_answer)
+            except LLMUnavailableError as e:
+                self._record_failure(state, update, e)
+            else:
+                self._apply_answer(state, update, mood_rules, content, cached)
+            end_speculation(update, pending)
+            return update
+        return self._apply_answer(state, update, mood_rules, content, cached)
+
+    async def acall(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} async call...")
+        patient = state["patient"]
+        if self._arm(patient) == "split":
+            update = await self._asplit(state)
+            self._record_arm(state, update, "split")
+            return update
+        update = new_update(patient)
+        await aregister_patient(state, update)
+        state = self._record_arm(state, update, "combined")
+        mood_rules, answered = self.mood._answer_locally(state, update)
+        if answered is not None:
+            return apply_update(update, await self.triage.acall(state))
+        content = cached_llm_answer(self._cache_key(patient))
+        cached = content is not None
+        if not cached:
+            pending = abegin_speculation(state, mood_rules)
+            try:
+                content = await aask_llm(self.llm, self._build_prompt(patient), is_assessment_answer)
+            except LLMUnavailableError as e:
+                self._record_failure(state, update, e)
+            else:
+                self._apply_answer(state, update, mood_rules, content, cached)
+            await aend_speculation(update, pending)
+            return update
+        return self._apply_answer(state, update, mood_rules, content, cached)
+
+class DoctorSchedulerAgent:
+    CLAIM_QUERY = "SELECT * FROM claim_doctor(%s::varchar, %s::interval);"
+
+    def _claim_params(self, patient):
+        return (patient.department, get_block_duration(patient.triage_level))
+
+    def _held(self, state, update):
+        # A speculative hold on a doctor of the right department stands in for the claim.
+        hold = state["cache"].get("speculation")
+        doctor = take(hold, "doctor", state["patient"].department)
+        if doctor is None:
+            return None
+        update["cache"]["held_doctor"] = True
+        doctor_id, name, specialist, held_from = doctor
+        # resolve_case() starts the block in the database; this is the same instant, give or take.
+        busy_from = held_from + timedelta(seconds=time.monotonic() - hold.started)
+        return (doctor_id, name, specialist, True, busy_from,
+                busy_from + get_block_duration(state["patient"].triage_level))
+
+    def _claim_in_memory(self, allocator, state, update):
+        update["cache"]["doctor_in_memory"] = True
+        return allocator.claim_doctor(*self._claim_params(state["patient"]), state["cache"].get("patient_id"))
+
+    def _finish(self, state, update, claimed):
+        patient = state["patient"]
+        if claimed:
+            patient.assigned_doctor = claimed[1]
+            update["cache"]["doctor_assigned"] = claimed
+            update["cache"]["doctor_blocked_from"] = claimed[4]
+            update["cache"]["doctor_blocked_until"] = claimed[5]
+            debug(f"Successfully alloted doctor until {claimed[5]}...")
+            update["status"]["DoctorScheduler"] = "Success"
+            log_event(self, state, update, "doctor_assigned", "Success", doctor=patient.assigned_doctor, patient=patient.name)
+        else:
+            debug("No doctors available...")
+            log_event(self, state, update, "no_doctor", "Failed", department=patient.department)
+            update["status"]["DoctorScheduler"] = "Failed"
+        debug(f"Exiting {self.__class__.__name__} call...")
+        return update
+
+    def __call__(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} call...")
+        patient = state["patient"]
+        update = new_update()
+        held = self._held(state, update)
+        if held:
+            return self._finish(state, update, held)
+        debug(f"Attempting to claim an available {patient.department} specialist doctor...")
+        allocator = ready_allocator()
+        if allocator is not None:
+            return self._finish(state, update, self._claim_in_memory(allocator, state, update))
+        with db_cursor() as cursor:
+            cursor.execute(self.CLAIM_QUERY, self._claim_params(patient))
+            claimed = cursor.fetchone()
+        return self._finish(state, update, claimed)
+
+    async def acall(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} async call...")
+        patient = state["patient"]
+        update = new_update()
+        held = self._held(state, update)
+        if held:
+            return self._finish(state, update, held)
+        debug(f"Attempting to claim an available {patient.department} specialist doctor...")
+        allocator = ready_allocator()
+        if allocator is not None:
+            return self._finish(state, update, self._claim_in_memory(allocator, state, update))
+        async with async_db_cursor() as cursor:
+            await cursor.execute(self.CLAIM_QUERY, self._claim_params(patient))
+            claimed = await cursor.fetchone()
+        return self._finish(state, update, claimed)
+
+class BedManagerAgent:
+    # Tries each bed type in priority order and claims the first free bed, in one call.
+    CLAIM_QUERY = "SELECT * FROM claim_room(%s::room_type[]);"
+
+    def _assign(self, state, update, bed_type, available_bed_details):
+        patient = state["patient"]
+        debug(f"Found a bed that matches requirements in {bed_type}...")
+        patient.assigned_bed = available_bed_details[0][0]
+        update["cache"]["bed_assigned"] = available_bed_details
+        debug("Successfully allocated a bed...")
+        log_event(self, state, update, "bed_assigned", "Success", patient=patient.name, bed_type=bed_type,
+                  bed=patient.assigned_bed, triage_level=patient.triage_level)
+        update["status"]["BedManager"] = "Success"
+        debug(f"Exiting {self.__class__.__name__} call...")
+        return update
+
+    def _no_beds(self, state, update):
+        debug("No beds found...")
+        log_event(self, state, update, "no_bed", "Failed", patient=state['patient'].name)
+        update["status"]["BedManager"] = "Failed"
+        debug(f"Exiting {self.__class__.__name__} call...")
+        return update
+
+    def _finish(self, state, update, claimed):
+        if claimed:
+            return self._assign(state, update, claimed[1], [claimed])
+        return self._no_beds(state, update)
+
+    def _held(self, state, update):
+        # Only a held bed of the preferred type counts; otherwise claim_room() picks the best one free.
+        room = take(state["cache"].get("speculation"), "room", state["patient"].bed_priority[0])
+        if room is None:
+            return None
+        update["cache"]["held_room"] = True
+        return (room[0], room[1], True)
+
+    def _claim_in_memory(self, allocator, state, update):
+        update["cache"]["bed_in_memory"] = True
+        return allocator.claim_room(state["patient"].bed_priority, state["cache"].get("patient_id"))
+
+    def __call__(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} call...")
+        patient = state["patient"]
+        patient.bed_priority = get_bed_priority(patient.triage_level)
+        update = new_update()
+        held = self._held(state, update)
+        if held:
+            return self._finish(state, update, held)
+        debug(f"Attempting to claim a bed from {patient.bed_priority}...")
+        allocator = ready_allocator()
+        if allocator is not None:
+            return self._finish(state, update, self._claim_in_memory(allocator, state, update))
+        with db_cursor() as cursor:
+            cursor.execute(self.CLAIM_QUERY, (patient.bed_priority,))
+            claimed = cursor.fetchone()
+        return self._finish(state, update, claimed)
+
+    async def acall(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} async call...")
+        patient = state["patient"]
+        patient.bed_priority = get_bed_priority(patient.triage_level)
+        update = new_update()
+        held = self._held(state, update)
+        if held:
+            return self._finish(state, update, held)
+        debug(f"Attempting to claim a bed from {patient.bed_priority}...")
+        allocator = ready_allocator()
+        if allocator is not None:
+            return self._finish(state, update, self._claim_in_memory(allocator, state, update))
+        async with async_db_cursor() as cursor:
+            await cursor.execute(self.CLAIM_QUERY, (patient.bed_priority,))
+            claimed = await cursor.fetchone()
+        return self._finish(state, update, claimed)
+    
+def referral_request(state, update):
+    """(router, route() arguments) when a diverted or queued admission should look at nearby sites, else None."""
+    router = get_federation_router()
+    if router is None:
+        return None
+    diverted = update["status"].get("ConflictResolver") == "Failed"
+    if not diverted and not update["cache"].get("queued"):
+        return None
+    patient = state["patient"]
+    # A diverted patient can't stay; a queued one is only referred if another site beats the wait here.
+    exclude = [router.local] if diverted and router.local else []
+    return router, (patient.department, patient.bed_priority, patient.priority_score,
+                    get_block_duration(patient.triage_level).total_seconds(), exclude)
+
+def apply_referral(agent, state, update, router, referral):
+    diverted = update["status"].get("ConflictResolver") == "Failed"
+    if referral is None or referral.site == router.local:
+        if diverted:
+            log_event(agent, state, update, "no_referral", patient=state["patient"].name)
+        return
+    # The patient stays queued here (if they were) until they leave; the receiving site admits them on arrival.
+    update["cache"]["referral"] = referral
+    inc("shmas_referrals_total", outcome="diverted" if diverted else "queued", source=referral.source)
+    log_event(agent, state, update, "referred", "Referred", site=referral.site,
+              wait_minutes=round(referral.projected_wait / 60, 1))
+
+class ConflictResolverAgent:
+    RESOLVE_QUERY = ("SELECT resolve_case(%s::bigint, %s::int, %s::int, %s::room_type, %s::numeric, "
+                     "%s::varchar, %s::room_type[], %s::interval, %s::smallint, %s::smallint, %s::float8);")
+
+    def _resolve(self, state, update):
+        patient = state["patient"]
+        bed_status = state["status"]["BedManager"]
+        doctor_status = state["status"]["DoctorScheduler"]
+        debug("Checking for conflicts in decision making...")
+        patient.calculate_priority()
+        debug(f"Calculated priority score : {patient.priority_score}")
+        log_event(self, state, update, "priority", score=patient.priority_score)
+        hold = state["cache"].get("speculation")
+        if hold is not None:
+            record_saved(hold, state["cache"].get("held_doctor"), state["cache"].get("held_room"))
+        if bed_status == "Success" and doctor_status == "Success":
+            debug("No conflicts found. Attempting to create a case...")
+            log_event(self, state, update, "admitting", "Success", patient=patient.name)
+            update["status"]["ConflictResolver"] = "Success"
+        elif bed_status == "Success" and doctor_status == "Failed":
+            # resolve_case releases the bed that was alloted
+            debug("There's a conflict!! Doctor not available at this moment. Queuing the admission form...")
+            log_event(self, state, update, "no_doctor_queued", "Queued")
+            update["status"]["ConflictResolver"] = "Queued"
+        elif bed_status == "Failed" and doctor_status == "Success":
+            # resolve_case releases the doctor that was alloted
+            debug("There's a conflict!! Bed not available at this moment. Queuing the admission form...")
+            log_event(self, state, update, "no_bed_queued", "Queued")
+            update["status"]["ConflictResolver"] = "Queued"
+        else:
+            debug("There's a conflict!! No bed or doctor available at this moment. Please try at nearby hospitals...")
+            log_event(self, state, update, "diverted", "Failed")
+            update["status"]["ConflictResolver"] = "Failed"
+            # Nothing to resolve, but a hold that wasn't taken is handed back now rather than at its expiry.
+            return (RELEASE_HOLDS_QUERY, (state["cache"]["patient_id"],)) if hold is not None else None
+
+        if update["status"]["ConflictResolver"] == "Queued":
+            debug("Application queued...")
+            update["status"]["ConflictResolver"] = "Success"
+            update["cache"]["queued"] = True
+        doctor = state["cache"].get("doctor_assigned") if doctor_status == "Success" else None
+        bed = state["cache"].get("bed_assigned") if bed_status == "Success" else None
+        params = (state["cache"]["patient_id"],
+                  doctor[0] if doctor else None,
+                  bed[0][0] if bed else None,
+                  bed[0][1] if bed else patient.bed_priority[0],
+                  patient.priority_score,
+                  patient.department,
+                  patient.bed_priority,
+                  get_block_duration(patient.triage_level),
+                  *priority_inputs(patient))
+        return self.RESOLVE_QUERY, params
+
+    def _allocator(self, state):
+        # Not ready_allocator(): a claim made in memory is confirmed even while the allocator reloads.
+        if state["cache"].get("doctor_in_memory") or state["cache"].get("bed_in_memory"):
+            return get_allocator()
+        return None
+
+    def _confirm(self, allocator, cursor, state, update):
+        # A claim lost to another writer before the write-behind got to it counts as not made, so the
+        # patient is admitted, queued or diverted on what is really held. resolve_case() then hands
+        # back an unused half in the database, and the allocator hears of it on the change feed.
+        cache, status, patient = state["cache"], dict(state["status"]), state["patient"]
+        doctor = bed = None
+        if cache.get("doctor_in_memory") and status["DoctorScheduler"] == "Success":
+            doctor = cache.get("doctor_assigned")
+        if cache.get("bed_in_memory") and status["BedManager"] == "Success":
+            bed = cache.get("bed_assigned")
+        doctor_held, room_held = allocator.confirm(cursor, cache["patient_id"], doctor[0] if doctor else None,
+                                                   bed[0][0] if bed else None)
+        if doctor_held is False:
+            log_event(self, state, update, "doctor_lost", "Failed", doctor=patient.assigned_doctor)
+            patient.assigned_doctor = None
+            status["DoctorScheduler"] = update["status"]["DoctorScheduler"] = "Failed"
+        if room_held is False:
+            log_event(self, state, update, "bed_lost", "Failed", bed=patient.assigned_bed)
+            patient.assigned_bed = None
+            status["BedManager"] = update["status"]["BedManager"] = "Failed"
+        return dict(state, status=status)
+
+    def _resolve_in_memory(self, allocator, state, update):
+        try:
+            with db_cursor() as cursor:
+                statement = self._resolve(self._confirm(allocator, cursor, state, update), update)
+                if statement:
+                    cursor.execute(*statement)
+        except Exception:
+            # What confirm() wrote went with the transaction; the database is the truth again.
+            allocator.load()
+            raise
+
+    def _refer(self, state, update):
+        request = referral_request(state, update)
+        if request is not None:
+            router, args = request
+            apply_referral(self, state, update, router, router.route(*args))
+        return update
+
+    async def _arefer(self, state, update):
+        request = referral_request(state, update)
+        if request is not None:
+            # The site reads are threads with their own deadline; keep them off the event loop.
+            router, args = request
+            apply_referral(self, state, update, router, await asyncio.to_thread(router.route, *args))
+        return update
+
+    def __call__(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} call...")
+        update = new_update()
+        allocator = self._allocator(state)
+        if allocator is not None:
+            self._resolve_in_memory(allocator, state, update)
+        else:
+            statement = self._resolve(state, update)
+            if statement:
+                with db_cursor() as cursor:
+                    cursor.execute(*statement)
+        self._refer(state, update)
+        debug(f"Exiting {self.__class__.__name__} call...")
+        return update
+
+    async def acall(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} async call...")
+        update = new_update()
+        allocator = self._allocator(state)
+        if allocator is not None:
+            # confirm() writes through the allocator's own (sync) pool.
+            await asyncio.to_thread(self._resolve_in_memory, allocator, state, update)
+        else:
+            statement = self._resolve(state, update)
+            if statement:
+                async with async_db_cursor() as cursor:
+                    await cursor.execute(*statement)
+        await self._arefer(state, update)
+        debug(f"Exiting {self.__class__.__name__} call...")
+        return update
+
+class CaseAllocatorAgent:
+    """Doctor, bed and case/queue decision in a single allocate_case() call.
+
+    Produces the same statuses and logs as the doctor -> bed -> checker
+    agents, but the whole allocation is one atomic statement.
+    """
+    ALLOCATE_QUERY = ("SELECT * FROM allocate_case(%s::bigint, %s::varchar, %s::room_type[], %s::interval, %s::numeric, "
+                      "%s::smallint, %s::smallint, %s::float8);")
+
+    def __init__(self):
+        self.doctor = DoctorSchedulerAgent()
+        self.bed = BedManagerAgent()
+        self.checker = ConflictResolverAgent()
+
+    def _params(self, state):
+        patient = state["patient"]
+        patient.bed_priority = get_bed_priority(patient.triage_level)
+        patient.calculate_priority()
+        return (state["cache"]["patient_id"], patient.department, patient.bed_priority,
+                get_block_duration(patient.triage_level), patient.priority_score, *priority_inputs(patient))
+
+    def _apply(self, state, row):
+        patient = state["patient"]
+        outcome, doctor_id, doctor_name, room_number, room_kind, busy_from, busy_till = row
+        doctor = (doctor_id, doctor_name, patient.department, True, busy_from, busy_till) if doctor_id else None
+        bed = (room_number, room_kind, True) if room_number else None
+        update = new_update()
+        hold = state["cache"].get("speculation")
+        if hold is not None:
+            # allocate_case() used whichever holds fit; the ids it returns say which.
+            update["cache"]["held_doctor"] = record_used(hold, "doctor", doctor_id)
+            update["cache"]["held_room"] = record_used(hold, "room", room_number)
+        update = self.doctor._finish(state, update, doctor)
+        apply_update(update, self.bed._finish(state, new_update(), bed))
+        # allocate_case already wrote the case/queue row; the checker only records the outcome.
+        checker_update = new_update()
+        self.checker._resolve(apply_update(dict(state), update), checker_update)
+        return apply_update(update, checker_update)
+
+    def __call__(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} call...")
+        with db_cursor() as cursor:
+            cursor.execute(self.ALLOCATE_QUERY, self._params(state))
+            row = cursor.fetchone()
+        return self.checker._refer(state, self._apply(state, row))
+
+    async def acall(self, state: AgentState) -> dict:
+        debug(f"Entering {self.__class__.__name__} async call...")
+        async with async_db_cursor() as cursor:
+            await cursor.execute(self.ALLOCATE_QUERY, self._params(state))
+            row = await cursor.fetchone()
+        return await self.checker._arefer(state, self._apply(state, row))
@@ -0,0 +1,605 @@
+"""In-process doctor and bed allocation, written behind to Postgres.
+
+With SHMAS_ALLOCATOR=memory, the doctor and bed agents and the queue
+dispatcher claim from memory instead of calling claim_doctor() and
+claim_room():
+
+- a set of free doctors per department;
+- a bitmap of free beds per room type;
+- a hashed timing wheel that frees each doctor at busy_till.
+
+A claim or release is a few dict and bit operations under one lock. The
+allocator thread writes the resulting doctors/rooms state to the database
+every SHMAS_ALLOCATOR_FLUSH_INTERVAL seconds, one UPDATE per table per
+batch. Each row is written only if the database still has the state the
+allocator last knew, or has the resource free, so replaying a batch changes
+nothing.
+
+The state is loaded from the database when the listener connects (and again
+on every reconnect). After that, changes made by anyone else, such as
+discharges, the expiry worker, resolve_case() handing back half a claim, or
+other processes, arrive through the dashboard change feed. The allocator's
+own writes come back on the same feed and are recognised as echoes. A claim
+made outside the allocator in the moment before its notification arrives
+can collide with one made here. The write then finds the row taken, and the
+allocator counts a conflict and adopts the database's state.
+
+A claim is only half the admission: the case is created by a statement of
+its own, which must not name a doctor or bed that was lost that way. So
+admissions (ConflictResolverAgent, and the dispatcher) call confirm() in
+the case's transaction first. It writes the claim right there if the
+write-behind hasn't yet, and reports a lost claim, which the admission
+treats as no claim at all (queueing or diverting the patient).
+
+One allocator per database, in the process that admits patients (the
+dashboard, with start_dispatcher()), is the supported deployment. Other
+writers stay correct, since every case is confirmed, but each of them
+claims rows the allocator thinks are free, so claims are lost and
+patients queued who needn't be:
+
+- a standalone dispatcher (``python -m dispatcher``); it refuses to start
+  with SHMAS_ALLOCATOR=memory, since it would run a second allocator;
+- another process in the atomic or parallel mode without the allocator;
+- a second process with SHMAS_ALLOCATOR=memory.
+
+The conflicts and lost counters in stats() show how often that happens.
+"""
+import os, time, atexit, threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+from logging import debug
+from psycopg2.extras import execute_values
+from db import db_cursor
+from listener import get_listener
+from metrics import span, inc
+
+DASHBOARD_CHANNEL = "shmas_dashboard"
+LOAD_QUERIES = {
+    "now": "SELECT LOCALTIMESTAMP;",
+    "doctors": "SELECT doctor_id, name, specialist, is_busy, busy_from, busy_till FROM doctors;",
+    "rooms": "SELECT room_number, type, is_occupied FROM rooms ORDER BY room_number;",
+    "cases": "SELECT doctor_id, patient_id FROM ongoing_cases WHERE doctor_id IS NOT NULL;",
+}
+# A row is written only if it is still as the allocator last saw it, or free.
+WRITE_DOCTORS_QUERY = """
+    UPDATE doctors d SET is_busy = v.is_busy, busy_from = v.busy_from, busy_till = v.busy_till
+    FROM (VALUES %s) AS v(doctor_id, is_busy, busy_from, busy_till, seen_busy, seen_till)
+    WHERE d.doctor_id = v.doctor_id
+      AND (d.is_busy = FALSE OR (d.is_busy = v.seen_busy AND d.busy_till IS NOT DISTINCT FROM v.seen_till))
+    RETURNING d.doctor_id;
+    """
+WRITE_DOCTORS_TEMPLATE = "(%s::int, %s::boolean, %s::timestamp, %s::timestamp, %s::boolean, %s::timestamp)"
+WRITE_ROOMS_QUERY = """
+    UPDATE rooms r SET is_occupied = v.is_occupied
+    FROM (VALUES %s) AS v(room_number, is_occupied, seen_occupied)
+    WHERE r.room_number = v.room_number AND (r.is_occupied = FALSE OR r.is_occupied = v.seen_occupied)
+    RETURNING r.room_number;
+    """
+WRITE_ROOMS_TEMPLATE = "(%s::int, %s::boolean, %s::boolean)"
+# Same as expire_doctors(): a doctor whose block ended is detached from that case.
+DETACH_QUERY = """
+    UPDATE ongoing_cases oc SET doctor_id = NULL
+    FROM (VALUES %s) AS v(doctor_id, patient_id)
+    WHERE oc.doctor_id = v.doctor_id AND oc.patient_id = v.patient_id;
+    """
+DETACH_TEMPLATE = "(%s::int, %s::bigint)"
+READ_DOCTORS_QUERY = "SELECT doctor_id, is_busy, busy_from, busy_till FROM doctors WHERE doctor_id = ANY(%s);"
+READ_ROOMS_QUERY = "SELECT room_number, is_occupied FROM rooms WHERE room_number = ANY(%s);"
+
+# busy_from/busy_till are on the database clock; seq changes on every claim or release.
+Doctor = namedtuple("Doctor", ["name", "specialist", "busy", "busy_from", "busy_till", "patient_id", "seq"])
+
+def allocator_enabled():
+    return os.getenv("SHMAS_ALLOCATOR", "db") == "memory"
+
+def _timestamp(value):
+    # Rows from notifications are JSON, so timestamps arrive as ISO strings.
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+class TimingWheel:
+    """Hashed timing wheel: O(1) to add, and each tick looks at one slot.
+
+    Entries further out than one turn of the wheel stay in their slot until
+    a later turn reaches their deadline.
+    """
+
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._cursor = int(time.monotonic() / tick)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, deadline, item):
+        # The slot after the deadline's: by the time the cursor reaches it, the deadline has passed.
+        index = max(int(deadline / self.tick) + 1, self._cursor + 1)
+        self._slots[index % len(self._slots)].append((deadline, item))
+        self._size += 1
+
+    def advance(self, now):
+        """Removes and returns the items whose deadline is at or before ``now``."""
+        due = []
+        target = int(now / self.tick)
+        # After a long stall one turn is enough: every slot gets looked at once.
+        for index in range(self._cursor + 1, min(target, self._cursor + len(self._slots)) + 1):
+            slot = index % len(self._slots)
+            keep = []
+            for entry in self._slots[slot]:
+                (due if entry[0] <= now else keep).append(entry)
+            self._slots[slot] = keep
+        self._cursor = max(self._cursor, target)
+        self._size -= len(due)
+        return [item for _, item in due]
+
+class ResourceAllocator:
+    def __init__(self, listener=None, flush_interval=None, tick=None, slots=None):
+        self.listener = listener or get_listener()
+        self.flush_interval = flush_interval or float(os.getenv("SHMAS_ALLOCATOR_FLUSH_INTERVAL", "0.02"))
+        self._wheel = TimingWheel(tick or float(os.getenv("SHMAS_ALLOCATOR_TICK", "0.25")),
+                                  slots or int(os.getenv("SHMAS_ALLOCATOR_WHEEL_SLOTS", "1024")))
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._seq = 0
+        self._doctors = {}
+        self._free_doctors = {}
+        # Bed i of a room type is free when bit i of its bitmap is set.
+        self._room_numbers = {}
+        self._room_slot = {}
+        self._free_rooms = {}
+        # The patient each bed claimed here is for, until it is released or lost.
+        self._room_patients = {}
+        # What the database last had, as far as the allocator knows; writes are conditional on it.
+        self._seen_doctors = {}
+        self._seen_rooms = {}
+        self._pending_doctors = set()
+        self._pending_rooms = set()
+        self._pending_detach = []
+        self._echoes = {}
+        self._mono_epoch = time.monotonic()
+        self._db_epoch = datetime.now()
+        self._stats = {"loads": 0, "doctor_claims": 0, "room_claims": 0, "misses": 0, "releases": 0,
+                       "expired": 0, "flushes": 0, "rows_written": 0, "conflicts": 0, "external": 0,
+                       "echoes": 0, "errors": 0, "confirms": 0, "lost": 0}
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def db_now(self):
+        return self._db_epoch + timedelta(seconds=time.monotonic() - self._mono_epoch)
+
+    def _monotonic(self, db_time):
+        return self._mono_epoch + (db_time - self._db_epoch).total_seconds()
+
+    # Memory state. Everything below that starts with _set runs under self._lock.
+
+    def _set_doctor(self, doctor_id, doctor):
+        previous = self._doctors.get(doctor_id)
+        if previous is not None and not previous.busy:
+            self._free_doctors.get(previous.specialist, set()).discard(doctor_id)
+        self._seq += 1
+        doctor = doctor._replace(seq=self._seq)
+        self._doctors[doctor_id] = doctor
+        if not doctor.busy:
+            self._free_doctors.setdefault(doctor.specialist, set()).add(doctor_id)
+        elif doctor.busy_till is not None:
+            self._wheel.add(self._monotonic(doctor.busy_till), (doctor_id, doctor.seq))
+        return doctor
+
+    def _set_room(self, room_number, kind, occupied):
+        slot = self._room_slot.get(room_number)
+        if slot is None or slot[0] != kind:
+            # A bed that is new, or changed type, gets the next bit of its type's bitmap.
+            if slot is not None:
+                self._free_rooms[slot[0]] &= ~(1 << slot[1])
+            numbers = self._room_numbers.setdefault(kind, [])
+            slot = self._room_slot[room_number] = (kind, len(numbers))
+            numbers.append(room_number)
+            self._free_rooms.setdefault(kind, 0)
+        if occupied:
+            self._free_rooms[kind] &= ~(1 << slot[1])
+        else:
+            self._free_rooms[kind] |= 1 << slot[1]
+
+    def _room_occupied(self, room_number):
+        kind, bit = self._room_slot[room_number]
+        return not (self._free_rooms[kind] >> bit) & 1
+
+    def load(self):
+        """Rebuilds the state from the database; the listener runs this on every (re)connect."""
+        # No batch may land between reading the rows and installing them, or what it wrote would be forgotten.
+        with self._flush_lock:
+            with self._lock:
+                # Echoes of writes made before a reconnect were lost with the old connection.
+                self._echoes.clear()
+            self._flush()
+            rows = {}
+            with db_cursor() as cursor:
+                for name, query in LOAD_QUERIES.items():
+                    cursor.execute(query)
+                    rows[name] = cursor.fetchall()
+            cases = dict(rows["cases"])
+            with self._lock:
+                # Anything claimed or released since the flush above is still pending, and still stands.
+                kept_doctors = {doctor_id: self._doctors[doctor_id] for doctor_id in self._pending_doctors
+                                if doctor_id in self._doctors}
+                kept_rooms = {room_number: self._room_occupied(room_number) for room_number in self._pending_rooms
+                              if room_number in self._room_slot}
+                previous_doctors, room_patients = self._doctors, self._room_patients
+                self._mono_epoch, self._db_epoch = time.monotonic(), rows["now"][0][0]
+                self._doctors, self._free_doctors, self._seen_doctors = {}, {}, {}
+                self._room_numbers, self._room_slot, self._free_rooms, self._seen_rooms = {}, {}, {}, {}
+                self._room_patients = {}
+                self._wheel = TimingWheel(self._wheel.tick, len(self._wheel._slots))
+                for doctor_id, name, specialist, is_busy, busy_from, busy_till in rows["doctors"]:
+                    # A claim written here but not yet part of a case is still that patient's.
+                    previous = previous_doctors.get(doctor_id)
+                    patient_id = cases.get(doctor_id) or (previous.patient_id if previous and is_busy
+                                                          and previous.busy_till == busy_till else None)
+                    doctor = Doctor(name, specialist, bool(is_busy), busy_from, busy_till, patient_id, 0)
+                    self._set_doctor(doctor_id, kept_doctors.get(doctor_id, doctor))
+                    self._seen_doctors[doctor_id] = (bool(is_busy), busy_till)
+                for room_number, kind, is_occupied in rows["rooms"]:
+                    self._set_room(room_number, kind, kept_rooms.get(room_number, bool(is_occupied)))
+                    self._seen_rooms[room_number] = bool(is_occupied)
+                    if self._room_occupied(room_number) and room_number in room_patients:
+                        self._room_patients[room_number] = room_patients[room_number]
+                self._pending_doctors.intersection_update(self._doctors)
+                self._pending_rooms.intersection_update(self._room_slot)
+                self._stats["loads"] += 1
+        self._ready.set()
+        debug(f"Allocator loaded {len(rows['doctors'])} doctors and {len(rows['rooms'])} rooms...")
+
+    # Claims and releases
+
+    def claim_doctor(self, department, block_duration, patient_id=None):
+        """A free ``department`` doctor, busy for ``block_duration``, as a claim_doctor() row; None if none is free."""
+        with self._lock:
+            free = self._free_doctors.get(department)
+            if not free:
+                self._stats["misses"] += 1
+                inc("shmas_allocator_claims_total", kind="doctor", result="none")
+                return None
+            doctor_id = free.pop()
+            busy_from = self.db_now()
+            doctor = self._set_doctor(doctor_id, self._doctors[doctor_id]._replace(
+                busy=True, busy_from=busy_from, busy_till=busy_from + block_duration, patient_id=patient_id))
+            self._pending_doctors.add(doctor_id)
+            self._stats["doctor_claims"] += 1
+        inc("shmas_allocator_claims_total", kind="doctor", result="claimed")
+        self._wake.set()
+        return (doctor_id, doctor.name, doctor.specialist, True, doctor.busy_from, doctor.busy_till)
+
+    def claim_room(self, bed_priority, patient_id=None):
+        """The first free bed in ``bed_priority`` order, as a claim_room() row; None if none is free."""
+        with self._lock:
+            for kind in bed_priority:
+                free = self._free_rooms.get(kind, 0)
+                if free:
+                    bit = (free & -free).bit_length() - 1
+                    room_number = self._room_numbers[kind][bit]
+                    self._free_rooms[kind] = free & ~(1 << bit)
+                    self._room_patients[room_number] = patient_id
+                    self._pending_rooms.add(room_number)
+                    self._stats["room_claims"] += 1
+                    break
+            else:
+                self._stats["misses"] += 1
+                inc("shmas_allocator_claims_total", kind="room", result="none")
+                return None
+        inc("shmas_allocator_claims_total", kind="room", result="claimed")
+        self._wake.set()
+        return (room_number, kind, True)
+
+    def _free_doctor(self, doctor_id, detach):
+        doctor = self._doctors.get(doctor_id)
+        if doctor is None or not doctor.busy:
+            return False
+        if detach and doctor.patient_id is not None:
+            self._pending_detach.append((doctor_id, doctor.patient_id))
+        self._set_doctor(doctor_id, doctor._replace(busy=False, busy_from=None, busy_till=None, patient_id=None))
+        self._pending_doctors.add(doctor_id)
+        return True
+
+    def release_doctor(self, doctor_id):
+        with self._lock:
+            released = self._free_doctor(doctor_id, detach=False)
+            self._stats["releases"] += released
+        self._wake.set()
+        return released
+
+    def release_room(self, room_number):
+        with self._lock:
+            if room_number not in self._room_slot or not self._room_occupied(room_number):
+                return False
+            self._set_room(room_number, self._room_slot[room_number][0], False)
+            self._room_patients.pop(room_number, None)
+            self._pending_rooms.add(room_number)
+            self._stats["releases"] += 1
+        self._wake.set()
+        return True
+
+    def expire(self, now=None):
+        """Frees the doctors whose block has ended; returns their ids."""
+        expired = []
+        with self._lock:
+            for doctor_id, seq in self._wheel.advance(now or time.monotonic()):
+                doctor = self._doctors.get(doctor_id)
+                # A doctor released or claimed again since then has a newer seq, and a newer entry.
+                if doctor is not None and doctor.seq == seq and self._free_doctor(doctor_id, detach=True):
+                    expired.append(doctor_id)
+            self._stats["expired"] += len(expired)
+        return expired
+
+    # Change feed
+
+    def apply(self, channel, payload):
+        table = payload.get("table")
+        if table not in ("doctors", "rooms"):
+            return
+        row = payload["new"] or payload["old"]
+        key_column = "doctor_id" if table == "doctors" else "room_number"
+        key = (table, row[key_column])
+        with self._lock:
+            if self._echoes.get(key):
+                self._echoes[key] -= 1
+                self._stats["echoes"] += 1
+                return
+            if key[1] in (self._pending_doctors if table == "doctors" else self._pending_rooms):
+                # Decided here after this change was made; the pending write is checked against it.
+                return
+            self._stats["external"] += 1
+            new = payload["new"]
+            if table == "doctors":
+                if new is None:
+                    doctor = self._doctors.pop(key[1], None)
+                    if doctor is not None and not doctor.busy:
+                        self._free_doctors[doctor.specialist].discard(key[1])
+                    return
+                busy, busy_till = bool(new["is_busy"]), _timestamp(new["busy_till"])
+                previous = self._doctors.get(key[1])
+                self._set_doctor(key[1], Doctor(new["name"], new["specialist"], busy, _timestamp(new["busy_from"]),
+                                                busy_till, previous.patient_id if previous and busy else None, 0))
+                self._seen_doctors[key[1]] = (busy, busy_till)
+            elif new is None:
+                # A deleted bed is just never free again.
+                self._room_patients.pop(key[1], None)
+                if key[1] in self._room_slot:
+                    self._set_room(key[1], self._room_slot[key[1]][0], True)
+            else:
+                # Changed by someone else, so no longer a claim made here.
+                self._room_patients.pop(key[1], None)
+                self._set_room(key[1], new["type"], bool(new["is_occupied"]))
+                self._seen_rooms[key[1]] = bool(new["is_occupied"])
+
+    # Write-behind
+
+    def _doctor_rows(self, doctors):
+        rows = []
+        for doctor_id in doctors:
+            doctor = self._doctors.get(doctor_id)
+            seen = self._seen_doctors.get(doctor_id, (False, None))
+            # A claim released before it was written has nothing left to write.
+            if doctor is not None and (doctor.busy, doctor.busy_till) != seen:
+                rows.append((doctor_id, doctor.busy, doctor.busy_from, doctor.busy_till) + seen)
+        return rows
+
+    def _room_rows(self, rooms):
+        rows = []
+        for room_number in rooms:
+            occupied = self._room_occupied(room_number)
+            seen = self._seen_rooms.get(room_number, False)
+            if occupied != seen:
+                rows.append((room_number, occupied, seen))
+        return rows
+
+    def _take_pending(self):
+        with self._lock:
+            doctors, self._pending_doctors = self._pending_doctors, set()
+            rooms, self._pending_rooms = self._pending_rooms, set()
+            detach, self._pending_detach = self._pending_detach, []
+            return self._doctor_rows(doctors), self._room_rows(rooms), detach
+
+    def _written(self, table, rows, written, seen):
+        # Runs before commit, so the echoes are counted before the listener can deliver them.
+        with self._lock:
+            for row in rows:
+                if row[0] in written:
+                    seen[row[0]] = row[1] if table == "rooms" else (row[1], row[3])
+                    self._echoes[(table, row[0])] = self._echoes.get((table, row[0]), 0) + 1
+
+    def _reconcile(self, doctor_rows, room_rows, doctors, rooms):
+        # Rows the database refused: someone else holds them. A claim that lost is a conflict.
+        # Whatever was decided here about the row since then built on the lost write, so it is
+        # dropped too, and confirm() reports the claim as lost to whoever made it.
+        conflicts = 0
+        with self._lock:
+            for doctor_id, busy, busy_from, busy_till in doctors:
+                wanted = next(row for row in doctor_rows if row[0] == doctor_id)
+                self._seen_doctors[doctor_id] = (busy, busy_till)
+                conflicts += wanted[1]
+                self._pending_doctors.discard(doctor_id)
+                if doctor_id in self._doctors:
+                    self._set_doctor(doctor_id, self._doctors[doctor_id]._replace(
+                        busy=busy, busy_from=busy_from, busy_till=busy_till, patient_id=None))
+            for room_number, occupied in rooms:
+                wanted = next(row for row in room_rows if row[0] == room_number)
+                self._seen_rooms[room_number] = occupied
+                conflicts += wanted[1]
+                self._pending_rooms.discard(room_number)
+                self._room_patients.pop(room_number, None)
+                self._set_room(room_number, self._room_slot[room_number][0], occupied)
+            self._stats["conflicts"] += conflicts
+        if conflicts:
+            inc("shmas_allocator_conflicts_total", conflicts)
+            debug(f"Allocator lost {conflicts} claims to writers outside it, doctors {[row[0] for row in doctors]}, "
+                  f"rooms {[row[0] for row in rooms]}...")
+
+    def _write(self, cursor, doctor_rows, room_rows):
+        # Returns the database's rows for the ones it refused.
+        refused_doctors = refused_rooms = []
+        # Doctors before rooms, the order everything else locks them in.
+        if doctor_rows:
+            written = {row[0] for row in execute_values(
+                cursor, WRITE_DOCTORS_QUERY, doctor_rows, template=WRITE_DOCTORS_TEMPLATE, fetch=True)}
+            self._written("doctors", doctor_rows, written, self._seen_doctors)
+            refused = [row[0] for row in doctor_rows if row[0] not in written]
+            if refused:
+                cursor.execute(READ_DOCTORS_QUERY, (refused,))
+                refused_doctors = cursor.fetchall()
+        if room_rows:
+            written = {row[0] for row in execute_values(
+                cursor, WRITE_ROOMS_QUERY, room_rows, template=WRITE_ROOMS_TEMPLATE, fetch=True)}
+            self._written("rooms", room_rows, written, self._seen_rooms)
+            refused = [row[0] for row in room_rows if row[0] not in written]
+            if refused:
+                cursor.execute(READ_ROOMS_QUERY, (refused,))
+                refused_rooms = cursor.fetchall()
+        return refused_doctors, refused_rooms
+
+    def _flush(self):
+        doctor_rows, room_rows, detach = self._take_pending()
+        if not doctor_rows and not room_rows and not detach:
+            return 0
+        with span("allocator", "flush") as fields, db_cursor() as cursor:
+            if detach:
+                execute_values(cursor, DETACH_QUERY, detach, template=DETACH_TEMPLATE)
+            refused_doctors, refused_rooms = self._write(cursor, doctor_rows, room_rows)
+            fields.update(doctors=len(doctor_rows), rooms=len(room_rows))
+        if refused_doctors or refused_rooms:
+            self._reconcile(doctor_rows, room_rows, refused_doctors, refused_rooms)
+        count = len(doctor_rows) + len(room_rows)
+        with self._lock:
+            self._stats["flushes"] += 1
+            self._stats["rows_written"] += count
+        return count
+
+    def flush(self):
+        """Writes pending claims and releases; returns the number of rows written."""
+        with self._flush_lock:
+            return self._flush()
+
+    def confirm(self, cursor, patient_id, doctor_id=None, room_number=None):
+        """Makes ``patient_id``'s claims on this doctor and bed durable in ``cursor``'s transaction.
+
+        Called by an admission just before it creates the case, so the case
+        only ever names rows the database has as taken for this patient. A
+        claim the write-behind hasn't written yet is written here instead.
+        Returns (doctor_held, room_held); None for an id not passed, False for
+        a claim lost to a writer outside the allocator. If the transaction
+        fails after this, call load().
+        """
+        # Holding the flush lock means no batch is in flight, so each claim is pending, written or lost.
+        with self._flush_lock:
+            with self._lock:
+                doctor = self._doctors.get(doctor_id)
+                doctor_held = doctor is not None and doctor.busy and doctor.patient_id == patient_id
+                room_held = (room_number in self._room_slot and self._room_occupied(room_number)
+                             and self._room_patients.get(room_number) == patient_id)
+                doctors = [doctor_id] if doctor_held and doctor_id in self._pending_doctors else []
+                rooms = [room_number] if room_held and room_number in self._pending_rooms else []
+                self._pending_doctors.difference_update(doctors)
+                self._pending_rooms.difference_update(rooms)
+                doctor_rows, room_rows = self._doctor_rows(doctors), self._room_rows(rooms)
+            refused_doctors, refused_rooms = self._write(cursor, doctor_rows, room_rows)
+        if refused_doctors or refused_rooms:
+            self._reconcile(doctor_rows, room_rows, refused_doctors, refused_rooms)
+        doctor_held = doctor_held and not refused_doctors
+        room_held = room_held and not refused_rooms
+        lost = (doctor_id is not None and not doctor_held) + (room_number is not None and not room_held)
+        with self._lock:
+            self._stats["confirms"] += 1
+            self._stats["lost"] += lost
+        if lost:
+            inc("shmas_allocator_lost_claims_total", lost)
+        return (None if doctor_id is None else doctor_held, None if room_number is None else room_held)
+
+    def run(self):
+        debug("Allocator write-behind started...")
+        while not self._stop.is_set():
+            self._wake.wait(min(self.flush_interval, self._wheel.tick))
+            self._wake.clear()
+            try:
+                if self.ready:
+                    self.expire()
+                # Claims arriving meanwhile join this batch.
+                self._stop.wait(self.flush_interval)
+                self.flush()
+            except Exception as e:
+                with self._lock:
+                    self._stats["errors"] += 1
+                debug(f"Allocator write-behind failed, reloading...\n{e}")
+                # What was taken for the failed batch is lost, so the database is the truth again.
+                self._ready.clear()
+                try:
+                    self.load()
+                except Exception as e:
+                    debug(f"Allocator reload failed...\n{e}")
+                    self._stop.wait(5.0)
+        debug("Allocator write-behind stopped...")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name="shmas-allocator", daemon=True)
+            self._thread.start()
+            self.listener.subscribe([DASHBOARD_CHANNEL], self.apply, on_connect=self.load)
+        return self
+
+    def stop(self, timeout=None):
+        self.listener.unsubscribe(self.apply, on_connect=self.load)
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        # Nothing decided here is left unwritten.
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending_doctors) + len(self._pending_rooms) + len(self._pending_detach)
+            stats["free_doctors"] = {dept: len(ids) for dept, ids in sorted(self._free_doctors.items())}
+            stats["free_rooms"] = {kind: bin(bits).count("1") for kind, bits in sorted(self._free_rooms.items())}
+            stats["timers"] = len(self._wheel)
+        stats["ready"] = self.ready
+        return stats
+
+_allocator = None
+_allocator_started = False
+_allocator_lock = threading.Lock()
+
+def get_allocator():
+    """The process-wide allocator, started and loaded on first use; None unless SHMAS_ALLOCATOR=memory."""
+    global _allocator, _allocator_started
+    if not _allocator_started:
+        with _allocator_lock:
+            if not _allocator_started:
+                if allocator_enabled():
+                    _allocator = ResourceAllocator().start()
+                    atexit.register(_allocator.stop, 5)
+                    _allocator.wait_ready(float(os.getenv("SHMAS_ALLOCATOR_READY_TIMEOUT", "10")))
+                _allocator_started = True
+    return _allocator
+
+def ready_allocator():
+    # Until the first load has finished (database down at startup), claims go to the database as before.
+    allocator = get_allocator()
+    return allocator if allocator is not None and allocator.ready else None
+
+def stop_allocator():
+    global _allocator, _allocator_started
+    with _allocator_lock:
+        if _allocator is not None:
+            atexit.unregister(_allocator.stop)
+            _allocator.stop()
+        _allocator, _allocator_started = None, False
@@ -0,0 +1,166 @@
+"""In-process allocator (allocator.py) against claim_doctor()/claim_room().
+
+Builds a throwaway database seeded like census_bench (10k rooms and 1k
+doctors by default) and reports:
+
+- the time to rebuild the allocator's state from the database, which is
+  what every process start and listener reconnect costs;
+- claim latency: one claim_doctor() or claim_room() round trip against one
+  in-memory claim;
+- --claims random claims and releases against the running allocator,
+  with how many rows each write-behind batch carried;
+- the consistency check afterwards: every doctor and bed in the database
+  must match the allocator's view, and resource_counters must agree with
+  the tables.
+
+    python benchmarks/allocator_bench.py --rooms 10000 --doctors 1000 --claims 20000
+"""
+import os, sys, json, time, random, argparse, statistics
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from census_bench import SEED, create_database, drop_database
+from load_bench import percentiles
+
+DEPARTMENTS = ["Cardiology", "Pediatrics", "Neurology", "Dentist"]
+BED_PRIORITIES = [["ICU", "Emergency"], ["Ward", "Emergency"], ["Normal", "Ward", "Emergency"]]
+
+def db_claims(cursor, rng, repeat):
+    doctor_timings, room_timings = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cursor.execute("SELECT * FROM claim_doctor(%s::varchar, %s::interval);",
+                       (rng.choice(DEPARTMENTS), timedelta(minutes=5)))
+        doctor = cursor.fetchone()
+        doctor_timings.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        cursor.execute("SELECT * FROM claim_room(%s::room_type[]);", (rng.choice(BED_PRIORITIES),))
+        room = cursor.fetchone()
+        room_timings.append(time.perf_counter() - started)
+        # Handed straight back, so the free pool stays the same size throughout.
+        if doctor and doctor[0] is not None:
+            cursor.execute("UPDATE doctors SET is_busy = FALSE, busy_from = NULL, busy_till = NULL WHERE doctor_id = %s;",
+                           (doctor[0],))
+        if room and room[0] is not None:
+            cursor.execute("UPDATE rooms SET is_occupied = FALSE WHERE room_number = %s;", (room[0],))
+    return {"claim_doctor": percentiles(doctor_timings), "claim_room": percentiles(room_timings)}
+
+def memory_claims(allocator, rng, repeat):
+    doctor_timings, room_timings = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        doctor = allocator.claim_doctor(rng.choice(DEPARTMENTS), timedelta(minutes=5))
+        doctor_timings.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        room = allocator.claim_room(rng.choice(BED_PRIORITIES))
+        room_timings.append(time.perf_counter() - started)
+        if doctor:
+            allocator.release_doctor(doctor[0])
+        if room:
+            allocator.release_room(room[0])
+    return {"claim_doctor": percentiles(doctor_timings), "claim_room": percentiles(room_timings)}
+
+def churn(allocator, rng, claims):
+    # A random mix: claim (held until a later release) or release something held.
+    doctors, rooms = [], []
+    started = time.perf_counter()
+    for _ in range(claims):
+        if rng.random() < 0.5 or not (doctors or rooms):
+            doctor = allocator.claim_doctor(rng.choice(DEPARTMENTS), timedelta(minutes=rng.randint(1, 5)))
+            room = allocator.claim_room(rng.choice(BED_PRIORITIES))
+            doctors += [doctor[0]] if doctor else []
+            rooms += [room[0]] if room else []
+        else:
+            if doctors:
+                allocator.release_doctor(doctors.pop(rng.randrange(len(doctors))))
+            if rooms:
+                allocator.release_room(rooms.pop(rng.randrange(len(rooms))))
+    return time.perf_counter() - started
+
+def mismatches(allocator, cursor):
+    cursor.execute("SELECT doctor_id, is_busy, busy_till FROM doctors;")
+    doctors = cursor.fetchall()
+    cursor.execute("SELECT room_number, is_occupied FROM rooms;")
+    rooms = cursor.fetchall()
+    with allocator._lock:
+        found = [("doctor", doctor_id) for doctor_id, busy, busy_till in doctors
+                 if (allocator._doctors[doctor_id].busy, allocator._doctors[doctor_id].busy_till) != (busy, busy_till)]
+        found += [("room", room_number) for room_number, occupied in rooms
+                  if allocator._room_occupied(room_number) != occupied]
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=10000)
+    parser.add_argument("--doctors", type=int, default=1000)
+    parser.add_argument("--occupied", type=float, default=0.7, help="fraction of rooms/doctors in use")
+    parser.add_argument("--queued", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=500, help="claims timed on each path")
+    parser.add_argument("--rebuilds", type=int, default=5)
+    parser.add_argument("--claims", type=int, default=20000, help="claims and releases in the churn phase")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database", default="hospital_alloc_bench")
+    parser.add_argument("--keep", action="store_true", help="leave the database behind")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SHMAS_LOG_LEVEL", "WARNING")
+    # Everything below, the allocator's pool and listener included, talks to the throwaway database.
+    os.environ["SHMAS_DB_DATABASE"] = args.database
+    conn = create_database(args.database)
+    with conn.cursor() as cur:
+        cur.execute(SEED, {"rooms": args.rooms, "doctors": args.doctors, "occupied": args.occupied,
+                           "patients": int(args.rooms * args.occupied) + args.queued, "queued": args.queued})
+    conn.commit()
+    conn.close()
+
+    from config import configure_logging
+    from db import db_cursor, init_pool
+    from allocator import ResourceAllocator
+    from agents import check_resource_counters
+    from listener import get_listener
+    configure_logging()
+    rng = random.Random(args.seed)
+    pool = init_pool()
+    allocator = ResourceAllocator()
+    try:
+        rebuilds = []
+        for _ in range(args.rebuilds):
+            started = time.perf_counter()
+            allocator.load()
+            rebuilds.append((time.perf_counter() - started) * 1000)
+        with db_cursor() as cursor:
+            db_latency = db_claims(cursor, rng, args.repeat)
+
+        allocator.start()
+        allocator.wait_ready(30)
+        memory_latency = memory_claims(allocator, rng, args.repeat)
+        churn_seconds = churn(allocator, rng, args.claims)
+        allocator.stop(timeout=30)
+        # Every echo has been delivered once the listener has nothing left to send.
+        time.sleep(0.5)
+        with db_cursor() as cursor:
+            found = mismatches(allocator, cursor)
+        stats = allocator.stats()
+        results = {
+            "rebuild_ms": {"median": round(statistics.median(rebuilds), 2), "min": round(min(rebuilds), 2)},
+            "db_claims": db_latency,
+            "memory_claims": memory_latency,
+            "churn": {"operations": args.claims, "seconds": round(churn_seconds, 3),
+                      "per_second": round(args.claims / churn_seconds),
+                      "rows_per_flush": round(stats["rows_written"] / stats["flushes"], 1) if stats["flushes"] else None},
+            "mismatches": len(found),
+            "mismatch_sample": found[:10],
+            "counter_drift": check_resource_counters(),
+            "stats": stats,
+        }
+    finally:
+        get_listener().stop(timeout=5)
+        pool.close()
+        if not args.keep:
+            drop_database(args.database)
+
+    print(json.dumps({"config": vars(args), "results": results}, indent=2, default=str))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Combined mood+triage assessment against the two-call path.
+
+Runs the same synthetic patients through the mood and triage agents one
+after the other (split) and through PatientAssessmentAgent's single call
+(combined), --concurrency at a time, and reports per-patient latency, LLM
+calls and output tokens for each path, plus how often the two paths agree
+on mood, triage level and department. The rule fast path and the LLM cache
+are off so every patient reaches the model, and patients are never written
+to the database.
+
+By default the LLM is whatever the gateway is configured with
+(SHMAS_LLM_BACKEND, GROQ_API_KEY), which is what agreement is meant to be
+measured against. With --stub it is load_bench's thinking-model stub, which
+answers from a hash of the patient's symptoms and age: latency and call
+counts are meaningful, agreement only checks the plumbing.
+
+    python benchmarks/assessment_bench.py --patients 200 --concurrency 8 --stub
+"""
+import os, re, sys, json, time, random, zlib, argparse
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from load_bench import DEPARTMENTS, MOODS, LoadStubBackend, make_patient, percentiles
+
+class PatientStubBackend(LoadStubBackend):
+    """LoadStubBackend whose answers depend on the patient, so both paths give the same one."""
+
+    def _answer(self, prompt):
+        patient = " ".join(re.findall(r"- (?:Symptoms|Age): (.*)", prompt))
+        rng = random.Random(zlib.crc32(patient.encode()))
+        mood, triage_level, department = rng.choice(MOODS), rng.randint(1, 5), rng.choice(DEPARTMENTS)
+        answer = {}
+        if '"mood"' in prompt:
+            answer["mood"] = mood
+        if '"triage_level"' in prompt:
+            answer.update(triage_level=triage_level, department=department)
+        return answer
+
+def run_path(agent, patients, concurrency):
+    from smart_hospital import initial_state
+    from llm_gateway import get_llm_gateway
+    states = [initial_state(**patient) for patient in patients]
+    for idx, state in enumerate(states):
+        state["cache"]["patient_id"] = idx + 1
+    timings = [None] * len(states)
+    updates = [None] * len(states)
+
+    def assess(idx):
+        started = time.perf_counter()
+        updates[idx] = agent(states[idx])
+        timings[idx] = time.perf_counter() - started
+
+    before = get_llm_gateway().stats()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(assess, range(len(states))))
+    elapsed = time.perf_counter() - started
+    after = get_llm_gateway().stats()
+    answers = []
+    for state, update in zip(states, updates):
+        status = update["status"]
+        ok = status.get("MoodAnalyzer") == "Success" and status.get("EmergencyTriage") == "Success"
+        patient = state["patient"]
+        answers.append((patient.mood, patient.triage_level, patient.department) if ok else None)
+    summary = {
+        "elapsed_s": round(elapsed, 3),
+        "latency": percentiles(timings),
+        "llm_calls_per_patient": round((after["calls"] - before["calls"]) / len(states), 3),
+        "output_tokens_per_patient": round((after["output_tokens"] - before["output_tokens"]) / len(states), 1),
+        "failed": sum(answer is None for answer in answers),
+    }
+    return summary, answers
+
+def agreement(split, combined):
+    pairs = [(a, b) for a, b in zip(split, combined) if a is not None and b is not None]
+    if not pairs:
+        return {"compared": 0}
+    share = lambda match: round(sum(map(match, pairs)) / len(pairs), 4)
+    return {
+        "compared": len(pairs),
+        "mood": share(lambda p: p[0][0] == p[1][0]),
+        "triage_level": share(lambda p: p[0][1] == p[1][1]),
+        "triage_level_within_1": share(lambda p: abs(p[0][1] - p[1][1]) <= 1),
+        "department": share(lambda p: p[0][2] == p[1][2]),
+        "all": share(lambda p: p[0] == p[1]),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stub", action="store_true", help="use the thinking-model stub instead of the real LLM")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="stub time-to-first-token (s)")
+    parser.add_argument("--think-tokens", type=int, default=400, help="stub median <think> length")
+    parser.add_argument("--tokens-per-sec", type=float, default=250.0)
+    parser.add_argument("--stream", action="store_true", help="stream LLM replies and stop at the answer")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SHMAS_LOG_LEVEL", "WARNING")
+    os.environ["SHMAS_LLM_CACHE"] = "0"
+    os.environ["SHMAS_RULES_FASTPATH"] = "0"
+    os.environ["SHMAS_LLM_STREAM"] = "1" if args.stream else "0"
+    from config import configure_logging
+    from llm_gateway import configure_llm_gateway
+    from agents import PatientAssessmentAgent
+    configure_logging()
+    if args.stub:
+        configure_llm_gateway(backend=PatientStubBackend("thinking", args.llm_latency, 0.6, args.think_tokens,
+                                                         args.tokens_per_sec, args.seed),
+                              max_concurrency=args.concurrency)
+
+    rng = random.Random(args.seed)
+    patients = [make_patient(rng, "assess", i) for i in range(args.patients)]
+    split, split_answers = run_path(PatientAssessmentAgent(mode="split"), patients, args.concurrency)
+    combined, combined_answers = run_path(PatientAssessmentAgent(mode="combined"), patients, args.concurrency)
+    report = {"config": vars(args), "split": split, "combined": combined,
+              "agreement": agreement(split_answers, combined_answers)}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
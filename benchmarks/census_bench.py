@@ -0,0 +1,151 @@
+"""Plans and timings for the census/claim hot paths at hospital scale.
+
+Builds a throwaway database from hospitals_db.sql, seeds it (10k rooms and 1k
+doctors by default), then runs every query twice: once with the hot-path
+indexes from migrations/001_hot_path_indexes.sql dropped inside a rolled-back
+transaction, once with them in place. The legacy correlated census query is
+measured alongside the single-pass GROUP BY one and the
+trigger-maintained resource_counters read.
+
+    python benchmarks/census_bench.py --rooms 10000 --doctors 1000
+"""
+import os, re, sys, time, json, argparse, statistics
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from db import db_config
+
+LEGACY_CENSUS_QUERY = """
+    SELECT DISTINCT type,
+            (SELECT COUNT(*) FROM rooms r1 WHERE r1.type = r.type AND is_occupied = FALSE) available,
+            (SELECT COUNT(*) FROM rooms r1 WHERE r1.type = r.type AND is_occupied = TRUE) blocked
+    FROM rooms r;
+    """
+
+BED_CENSUS_QUERY = """
+    SELECT type,
+           COUNT(*) FILTER (WHERE is_occupied = FALSE) available,
+           COUNT(*) FILTER (WHERE is_occupied = TRUE) blocked
+    FROM rooms
+    GROUP BY type;
+    """
+
+QUERIES = {
+    "census_legacy": LEGACY_CENSUS_QUERY,
+    "census_group_by": BED_CENSUS_QUERY,
+    "census_counters": "SELECT category, available, occupied FROM resource_counters WHERE kind = 'room';",
+    "free_doctor": "SELECT doctor_id FROM doctors WHERE specialist = 'Neurology' AND is_busy = FALSE LIMIT 1;",
+    "free_room": "SELECT room_number FROM rooms WHERE type = 'ICU' AND is_occupied = FALSE LIMIT 1;",
+    "expired_doctors": "SELECT doctor_id FROM doctors WHERE is_busy = TRUE AND busy_till < CURRENT_TIMESTAMP;",
+    "case_by_doctor": "SELECT * FROM ongoing_cases WHERE doctor_id = 42;",
+    "queue_head": "SELECT patient_id FROM queue WHERE type_of_room = 'ICU' ORDER BY priority_score DESC LIMIT 1;",
+}
+
+SEED = """
+INSERT INTO rooms
+    SELECT g, (ARRAY['Emergency','ICU','Ward','Normal'])[1 + g %% 4]::room_type, random() < %(occupied)s
+    FROM generate_series(1, %(rooms)s) g;
+INSERT INTO doctors(name, specialist, is_busy, busy_from, busy_till)
+    SELECT 'Dr ' || g, (ARRAY['Cardiology','Pediatrics','Neurology','Dentist'])[1 + g %% 4], b,
+           CASE WHEN b THEN now() END, CASE WHEN b THEN now() + (random() * 20 - 2) * interval '1 minute' END
+    FROM (SELECT g, random() < %(occupied)s b FROM generate_series(1, %(doctors)s) g) s;
+INSERT INTO patient_info(patient_name, email)
+    SELECT 'Patient ' || g, 'patient' || g || '@bench.local' FROM generate_series(1, %(patients)s) g;
+INSERT INTO ongoing_cases
+    SELECT p.patient_id, d.doctor_id, r.room_number
+    FROM (SELECT doctor_id, row_number() OVER () n FROM doctors WHERE is_busy) d
+    JOIN (SELECT room_number, row_number() OVER () n FROM rooms WHERE is_occupied) r USING (n)
+    JOIN (SELECT patient_id, row_number() OVER () n FROM patient_info) p USING (n);
+INSERT INTO queue
+    SELECT patient_id, round((random() * 100)::numeric, 1), (ARRAY['Emergency','ICU','Ward','Normal'])[1 + patient_id %% 4]::room_type
+    FROM patient_info ORDER BY patient_id DESC LIMIT %(queued)s;
+ANALYZE;
+"""
+
+def hot_path_indexes():
+    with open(os.path.join(ROOT, "migrations", "001_hot_path_indexes.sql")) as f:
+        return re.findall(r"IF NOT EXISTS (\w+)", f.read())
+
+def create_database(name):
+    admin = psycopg2.connect(**dict(db_config(), database="postgres"))
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {name};")
+        cur.execute(f"CREATE DATABASE {name};")
+    admin.close()
+    conn = psycopg2.connect(**dict(db_config(), database=name))
+    with open(os.path.join(ROOT, "hospitals_db.sql")) as f, conn.cursor() as cur:
+        cur.execute(f.read())
+    conn.commit()
+    return conn
+
+def drop_database(name):
+    admin = psycopg2.connect(**dict(db_config(), database="postgres"))
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS {name};")
+    admin.close()
+
+def measure(cur, query, repeat, budget):
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, COSTS OFF) " + query)
+    plan = "\n".join(row[0] for row in cur.fetchall())
+    timings = []
+    # The legacy census is quadratic in rooms, so stop repeating once the budget is spent.
+    while len(timings) < repeat and sum(timings) < budget * 1000:
+        started = time.perf_counter()
+        cur.execute(query)
+        cur.fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    return plan, {"median_ms": round(statistics.median(timings), 3), "min_ms": round(min(timings), 3)}
+
+def run(conn, repeat, budget, indexed):
+    results = {}
+    with conn.cursor() as cur:
+        if not indexed:
+            for index in hot_path_indexes():
+                cur.execute(f"DROP INDEX IF EXISTS {index};")
+        for name, query in QUERIES.items():
+            results[name] = measure(cur, query, repeat, budget)
+    # Dropping the indexes was only for this measurement.
+    conn.rollback()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=10000)
+    parser.add_argument("--doctors", type=int, default=1000)
+    parser.add_argument("--occupied", type=float, default=0.7, help="fraction of rooms/doctors in use")
+    parser.add_argument("--queued", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--budget", type=float, default=5.0, help="seconds of repeats per query")
+    parser.add_argument("--database", default="hospital_bench")
+    parser.add_argument("--plans", action="store_true", help="print EXPLAIN ANALYZE output")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    conn = create_database(args.database)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SEED, {"rooms": args.rooms, "doctors": args.doctors, "occupied": args.occupied,
+                               "patients": args.rooms + args.queued, "queued": args.queued})
+        conn.commit()
+        before = run(conn, args.repeat, args.budget, indexed=False)
+        after = run(conn, args.repeat, args.budget, indexed=True)
+    finally:
+        conn.close()
+        drop_database(args.database)
+
+    if args.json:
+        print(json.dumps({name: {"without_indexes": before[name][1], "with_indexes": after[name][1]}
+                          for name in QUERIES}, indent=2))
+        return
+    print(f"{'query':<18}{'no index (ms)':>16}{'indexed (ms)':>16}")
+    for name in QUERIES:
+        print(f"{name:<18}{before[name][1]['median_ms']:>16}{after[name][1]['median_ms']:>16}")
+    if args.plans:
+        for name in QUERIES:
+            print(f"\n== {name} (no index) ==\n{before[name][0]}\n== {name} (indexed) ==\n{after[name][0]}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Federation routing across several local hospital databases.
+
+Builds --sites throwaway databases from hospitals_db.sql, each seeded with its
+own load (a different share of busy doctors and beds, a different queue) and
+a random travel time. --stalled of them have their doctors table locked for
+the whole run, so their capacity reads hang until the statement timeout.
+--down more point at a port nothing listens on. Every read waits --rtt
+milliseconds first, standing in for the network between sites, which local
+databases don't have. The benchmark then reports:
+
+- the time to read every healthy site one after the other, against
+  FederationRouter.refresh() reading them in parallel;
+- route() latency over --routes random patients, which has to stay within
+  the deadline however many sites are stalled or down;
+- how often route() picked the same site as a brute-force ranking of every
+  site's capacity (the two can differ when --candidates is below --sites).
+
+    python benchmarks/federation_bench.py --sites 24 --stalled 2 --down 2
+"""
+import os, sys, json, time, random, argparse, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from census_bench import create_database, drop_database
+from load_bench import percentiles
+
+SEED = """
+SELECT setseed(%(seed)s);
+INSERT INTO rooms
+    SELECT g, (ARRAY['Emergency','ICU','Ward','Normal'])[1 + g %% 4]::room_type, random() < %(occupied)s
+    FROM generate_series(1, %(rooms)s) g;
+INSERT INTO doctors(name, specialist, is_busy, busy_from, busy_till)
+    SELECT 'Dr ' || g, (ARRAY['Cardiology','Pediatrics','Neurology','Dentist'])[1 + g %% 4], b,
+           CASE WHEN b THEN now() END, CASE WHEN b THEN now() + random() * interval '30 minutes' END
+    FROM (SELECT g, random() < %(occupied)s b FROM generate_series(1, %(doctors)s) g) s;
+INSERT INTO patient_info(patient_name, email)
+    SELECT 'Patient ' || g, 'patient' || g || '@bench.local' FROM generate_series(1, %(rooms)s + %(queued)s) g;
+INSERT INTO ongoing_cases
+    SELECT p.patient_id, d.doctor_id, r.room_number
+    FROM (SELECT doctor_id, row_number() OVER () n FROM doctors WHERE is_busy) d
+    JOIN (SELECT room_number, row_number() OVER () n FROM rooms WHERE is_occupied) r USING (n)
+    JOIN (SELECT patient_id, row_number() OVER () n FROM patient_info) p USING (n);
+INSERT INTO queue(patient_id, priority_score, type_of_room, department, bed_priority)
+    SELECT patient_id, round((random() * 100)::numeric, 1),
+           (ARRAY['Emergency','ICU','Ward','Normal'])[1 + patient_id %% 4]::room_type,
+           (ARRAY['Cardiology','Pediatrics','Neurology','Dentist'])[1 + patient_id %% 3],
+           ARRAY[(ARRAY['Emergency','ICU','Ward','Normal'])[1 + patient_id %% 4]]::room_type[]
+    FROM patient_info ORDER BY patient_id DESC LIMIT %(queued)s;
+ANALYZE;
+"""
+
+def remote_router(rtt, **kwargs):
+    from federation import FederationRouter
+
+    class RemoteRouter(FederationRouter):
+        def read_site(self, site):
+            time.sleep(rtt / 1000)
+            return super().read_site(site)
+    return RemoteRouter(**kwargs)
+
+def build_sites(args, rng):
+    from db import db_config
+    entries, stall_conns = [], []
+    for idx in range(args.sites):
+        name = f"{args.prefix}_{idx}"
+        conn = create_database(name)
+        with conn.cursor() as cur:
+            cur.execute(SEED, {"seed": rng.uniform(-1, 1), "occupied": rng.uniform(0.3, 1.0), "rooms": args.rooms,
+                               "doctors": args.doctors, "queued": rng.randint(0, args.queued)})
+        conn.commit()
+        if idx < args.stalled:
+            # Held open until the end, so every read of this site blocks behind the lock.
+            with conn.cursor() as cur:
+                cur.execute("LOCK TABLE doctors IN ACCESS EXCLUSIVE MODE;")
+            stall_conns.append(conn)
+        else:
+            conn.close()
+        entries.append({"name": name, "database": name, "travel_minutes": rng.choice((0, 5, 10, 20, 30))})
+    for idx in range(args.down):
+        entries.append({"name": f"{args.prefix}_down_{idx}", "database": "hospital", "port": "1",
+                        "host": db_config()["host"], "travel_minutes": 0})
+    return entries, stall_conns
+
+def random_patient(rng):
+    from agents import get_bed_priority, get_block_duration
+    from triage_rules import DEPARTMENTS
+    triage_level = rng.randint(1, 5)
+    return (rng.choice(DEPARTMENTS), get_bed_priority(triage_level), round(rng.uniform(0, 100), 1),
+            get_block_duration(triage_level).total_seconds())
+
+def brute_force(router, names, patient):
+    from federation import projected_wait
+    ranked = []
+    for name in names:
+        capacity = router.snapshot(name)
+        wait_seconds = capacity and projected_wait(capacity, *patient)
+        if wait_seconds is not None:
+            ranked.append((wait_seconds, name))
+    return min(ranked)[1] if ranked else None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sites", type=int, default=12)
+    parser.add_argument("--stalled", type=int, default=1, help="sites whose capacity read hangs")
+    parser.add_argument("--down", type=int, default=1, help="extra sites that refuse connections")
+    parser.add_argument("--rooms", type=int, default=400)
+    parser.add_argument("--doctors", type=int, default=60)
+    parser.add_argument("--queued", type=int, default=100)
+    parser.add_argument("--routes", type=int, default=200)
+    parser.add_argument("--candidates", type=int, default=8)
+    parser.add_argument("--deadline", type=float, default=0.5)
+    parser.add_argument("--statement-timeout", type=float, default=2.0)
+    parser.add_argument("--rtt", type=float, default=20.0, help="simulated network round trip per read (ms)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--prefix", default="hospital_fed")
+    parser.add_argument("--keep", action="store_true", help="leave the databases behind")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SHMAS_LOG_LEVEL", "WARNING")
+    from config import configure_logging
+    from federation import federation_sites
+    configure_logging()
+    rng = random.Random(args.seed)
+    entries, stall_conns = build_sites(args, rng)
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(entries, f)
+    router = remote_router(args.rtt, sites=federation_sites(f.name), candidates=args.candidates,
+                           deadline=args.deadline, statement_timeout=args.statement_timeout)
+    healthy = [entry["name"] for entry in entries[args.stalled:args.sites]]
+    try:
+        # Connections are opened here, so neither timing below includes them.
+        router.refresh(healthy)
+        started = time.perf_counter()
+        for name in healthy:
+            router.read_site(router.sites[name])
+        serial_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        router.refresh(healthy)
+        parallel_ms = (time.perf_counter() - started) * 1000
+        # Every site, stalled and down ones included, as the background refresher would.
+        router.refresh(deadline=args.statement_timeout * 2)
+
+        timings, agree, unroutable = [], 0, 0
+        for _ in range(args.routes):
+            patient = random_patient(rng)
+            started = time.perf_counter()
+            referral = router.route(*patient)
+            timings.append(time.perf_counter() - started)
+            expected = brute_force(router, healthy, patient)
+            unroutable += referral is None
+            agree += (referral.site if referral else None) == expected
+        results = {
+            "read_all_serial_ms": round(serial_ms, 2),
+            "read_all_parallel_ms": round(parallel_ms, 2),
+            "route_latency": percentiles(timings),
+            "route_max_ms": round(max(timings) * 1000, 2),
+            "best_site_agreement": round(agree / args.routes, 4),
+            "unroutable": unroutable,
+            "stats": router.stats(),
+        }
+    finally:
+        router.stop()
+        for conn in stall_conns:
+            conn.close()
+        os.unlink(f.name)
+        if not args.keep:
+            for idx in range(args.sites):
+                drop_database(f"{args.prefix}_{idx}")
+
+    print(json.dumps({"config": vars(args), "results": results}, indent=2, default=str))
+
+if __name__ == "__main__":
+    main()
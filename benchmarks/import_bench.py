@@ -0,0 +1,78 @@
+"""Cold-import time and import side effects of the application modules.
+
+Every sample imports a module in a fresh interpreter, so nothing is shared
+through sys.modules or the OS page cache beyond what a real worker restart
+would see. Besides the wall time, each child reports what the import left
+behind: a database pool, LLM gateway, compiled graph, root log handlers, or
+heavyweight packages (langgraph, langchain_groq) that should only load on
+first use. The run fails (exit status 1) when a median exceeds the budget or
+any side effect shows up, so it can gate CI.
+
+    python benchmarks/import_bench.py --repeat 10 --budget 0.5
+"""
+import os, sys, json, argparse, statistics, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ["agents", "smart_hospital"]
+HEAVY_PACKAGES = ["langgraph", "langchain_groq", "langchain", "langchain_core.messages"]
+
+PROBE = """
+import sys, time, json, logging
+started = time.perf_counter()
+module = __import__(sys.argv[1])
+elapsed = time.perf_counter() - started
+import db, llm_gateway
+effects = []
+if db._pool is not None:
+    effects.append("db pool created")
+if llm_gateway._gateway is not None:
+    effects.append("LLM gateway created")
+if getattr(sys.modules.get("smart_hospital"), "_hospital_graph", None) is not None:
+    effects.append("hospital graph compiled")
+if logging.getLogger().handlers:
+    effects.append("root logging configured")
+effects += [f"{name} imported" for name in json.loads(sys.argv[2]) if name in sys.modules]
+print(json.dumps({"seconds": elapsed, "side_effects": effects}))
+"""
+
+def sample(module):
+    result = subprocess.run([sys.executable, "-c", PROBE, module, json.dumps(HEAVY_PACKAGES)],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def measure(module, repeat):
+    samples = [sample(module) for _ in range(repeat)]
+    times = sorted(s["seconds"] * 1000 for s in samples)
+    return {
+        "median_ms": round(statistics.median(times), 1),
+        "min_ms": round(times[0], 1),
+        "max_ms": round(times[-1], 1),
+        "side_effects": sorted({effect for s in samples for effect in s["side_effects"]}),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=float(os.getenv("SHMAS_IMPORT_BUDGET", "0.5")),
+                        help="seconds allowed for the median import of each module")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = {module: measure(module, args.repeat) for module in args.modules}
+    failed = [module for module, result in results.items()
+              if result["median_ms"] > args.budget * 1000 or result["side_effects"]]
+
+    if args.json:
+        print(json.dumps({"budget_ms": args.budget * 1000, "results": results, "failed": failed}, indent=2))
+    else:
+        print(f"{'module':<18}{'median (ms)':>14}{'min (ms)':>12}{'max (ms)':>12}  side effects")
+        for module, result in results.items():
+            print(f"{module:<18}{result['median_ms']:>14}{result['min_ms']:>12}{result['max_ms']:>12}  "
+                  f"{', '.join(result['side_effects']) or '-'}")
+        if failed:
+            print(f"\nOver the {args.budget}s budget or not side-effect free: {', '.join(failed)}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+"""Admission throughput and tail latency under Poisson arrivals.
+
+Builds a throwaway database from hospitals_db.sql with the requested number
+of doctors and rooms, points SHMAS at it, and swaps the LLM for a local stub
+whose latency follows a configurable distribution ("thinking" mimics
+deepseek-r1: a time-to-first-token plus a long, log-normally sized <think>
+block streamed at a fixed token rate, and some chatter after the answer).
+With --stream the agents read the stub's token stream and stop at the
+answer (SHMAS_LLM_STREAM=1). Patients arrive as a Poisson process
+and each arrival runs run_patient_flow on a worker thread, with the expiry
+worker and queue dispatcher running as they would in the dashboard.
+
+Every --rate is a separate step on a freshly reseeded database, so a sweep
+shows where admissions saturate. Reported per step: end-to-end and per-agent
+p50/p95/p99, SQL and LLM latency, throughput, outcomes (admitted, queued
+because only one of doctor/bed was free, failed), and contention (backends
+seen waiting on a lock, deadlocks, pool checkout waits).
+
+    python benchmarks/load_bench.py --rate 2 5 10 20 --duration 30 --output load.json
+"""
+import os, sys, json, time, random, argparse, threading
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from census_bench import create_database, drop_database
+from db import db_config
+
+DEPARTMENTS = ["Cardiology", "Pediatrics", "Neurology", "Dentist"]
+MOODS = ["calm", "frustrated", "anxious", "stressed", "confused", "panicked"]
+SYMPTOMS = [["chest pain"], ["headache"], ["fever", "cough"], ["toothache"], ["seizure"],
+            ["shortness of breath"], ["abdominal pain"], ["fracture"]]
+
+RESET = """
+TRUNCATE ongoing_cases, queue, patient_info, doctors, rooms, agent_events, resource_holds RESTART IDENTITY CASCADE;
+INSERT INTO rooms
+    SELECT g, (ARRAY['Emergency','ICU','Ward','Normal'])[1 + g %% 4]::room_type, FALSE
+    FROM generate_series(1, %(rooms)s) g;
+INSERT INTO doctors(name, specialist, is_busy)
+    SELECT 'Dr ' || g, (ARRAY['Cardiology','Pediatrics','Neurology','Dentist'])[1 + g %% 4], FALSE
+    FROM generate_series(1, %(doctors)s) g;
+SELECT count(*) FROM rebuild_resource_counters();
+ANALYZE;
+"""
+LOCK_WAITERS_QUERY = """
+    SELECT count(*) FROM pg_stat_activity
+    WHERE datname = current_database() AND wait_event_type = 'Lock';
+    """
+DEADLOCKS_QUERY = "SELECT deadlocks FROM pg_stat_database WHERE datname = current_database();"
+
+def percentiles(samples, points=(50, 95, 99)):
+    if not samples:
+        return {f"p{p}_ms": None for p in points}
+    ordered = sorted(samples)
+    return {f"p{p}_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 2)
+            for p in points}
+
+class LoadStubBackend:
+    """Stub chat model with a latency profile and randomised (but valid) answers."""
+
+    def __init__(self, profile, latency, sigma, think_tokens, tokens_per_sec, seed, tail_tokens=0):
+        self.profile = profile
+        self.latency = latency
+        self.sigma = sigma
+        self.think_tokens = think_tokens
+        self.tokens_per_sec = tokens_per_sec
+        self.tail_tokens = tail_tokens
+        self.model_name = f"stub-{profile}"
+        self.rng = random.Random(seed)
+
+    def _sample(self):
+        if self.profile == "fixed":
+            return self.latency, 0
+        if self.profile == "lognormal":
+            return self.rng.lognormvariate(0, self.sigma) * self.latency, 0
+        tokens = int(self.rng.lognormvariate(0, self.sigma) * self.think_tokens)
+        return self.latency + tokens / self.tokens_per_sec, tokens
+
+    def _answer(self, prompt):
+        # The keys the prompt's JSON template asks for; the combined assessment asks for all three.
+        answer = {}
+        if '"mood"' in prompt:
+            answer["mood"] = self.rng.choice(MOODS)
+        if '"triage_level"' in prompt:
+            answer.update(triage_level=self.rng.randint(1, 5), department=self.rng.choice(DEPARTMENTS))
+        return answer
+
+    def _tokens(self, prompt):
+        # (time to first token, seconds per token, the reply one token per piece, usage of the whole reply)
+        delay, think = self._sample()
+        answer = self._answer(prompt)
+        tail = self.tail_tokens if self.profile == "thinking" else 0
+        tokens = (["<think>"] + ["hmm "] * think + ["</think>"] + [json.dumps(answer)]
+                  + [" Explanation:"] + [" because"] * tail)
+        # Only the thinking profile models generation time; the others spend their whole delay up front.
+        token_time = 1 / self.tokens_per_sec if self.profile == "thinking" else 0.0
+        usage = {"input_tokens": len(prompt.split()), "output_tokens": think + tail + 12,
+                 "total_tokens": len(prompt.split()) + think + tail + 12}
+        return delay - think * token_time, token_time, tokens, usage
+
+    def _reply(self, prompt):
+        from langchain_core.messages import AIMessage
+        ttft, token_time, tokens, usage = self._tokens(prompt)
+        return ttft + len(tokens) * token_time, AIMessage(content="".join(tokens), usage_metadata=usage)
+
+    def _chunks(self, prompt):
+        from langchain_core.messages import AIMessageChunk
+        ttft, token_time, tokens, usage = self._tokens(prompt)
+        yield ttft, None
+        for i, token in enumerate(tokens):
+            last = i == len(tokens) - 1
+            # Sleeping per token would mostly measure the scheduler; the rate is kept in steps of 8.
+            pause = 8 * token_time if i % 8 == 7 else 0.0
+            yield pause, AIMessageChunk(content=token, usage_metadata=usage if last else None)
+
+    def invoke(self, messages):
+        delay, message = self._reply(messages[-1].content)
+        time.sleep(delay)
+        return message
+
+    async def ainvoke(self, messages):
+        import asyncio
+        delay, message = self._reply(messages[-1].content)
+        await asyncio.sleep(delay)
+        return message
+
+    def stream(self, messages):
+        for pause, chunk in self._chunks(messages[-1].content):
+            time.sleep(pause)
+            if chunk is not None:
+                yield chunk
+
+    async def astream(self, messages):
+        import asyncio
+        for pause, chunk in self._chunks(messages[-1].content):
+            await asyncio.sleep(pause)
+            if chunk is not None:
+                yield chunk
+
+class LockSampler:
+    """Polls pg_stat_activity for backends waiting on a heavyweight lock."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="load-lock-sampler", daemon=True)
+
+    def run(self):
+        conn = psycopg2.connect(**db_config())
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            while not self._stop.wait(self.interval):
+                cur.execute(LOCK_WAITERS_QUERY)
+                self.samples.append(cur.fetchone()[0])
+        conn.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def summary(self):
+        waiting = [s for s in self.samples if s]
+        return {"samples": len(self.samples), "samples_with_waiters": len(waiting),
+                "max_waiters": max(self.samples, default=0),
+                "mean_waiters": round(sum(self.samples) / len(self.samples), 3) if self.samples else 0.0}
+
+def make_patient(rng, step, i):
+    return dict(name=f"Load {step}-{i}", email=f"load{step}-{i}@bench.local",
+                symptoms=rng.choice(SYMPTOMS), symptom_duration=rng.randint(1, 72),
+                age=rng.randint(1, 90), gender=rng.choice(["Male", "Female"]),
+                vitals={"heart_rate": rng.randint(55, 150),
+                        "blood_pressure": {"systolic": rng.randint(90, 190), "diastolic": rng.randint(55, 120)}})
+
+def reset(args):
+    with psycopg2.connect(**db_config()) as conn, conn.cursor() as cur:
+        cur.execute(RESET, {"rooms": args.rooms, "doctors": args.doctors})
+    conn.close()
+
+def deadlocks():
+    with psycopg2.connect(**db_config()) as conn, conn.cursor() as cur:
+        cur.execute(DEADLOCKS_QUERY)
+        count = cur.fetchone()[0]
+    conn.close()
+    return count
+
+def run_step(step, rate, args, workers):
+    from smart_hospital import run_patient_flow, get_hospital_graph
+    from metrics import add_span_listener, remove_span_listener
+    from db import pool_stats
+    from llm_gateway import get_llm_gateway
+    from speculation import speculation_stats
+
+    reset(args)
+    speculation_stats.reset()
+    for worker in workers:
+        worker.resync()
+    get_hospital_graph()
+    pool_before = pool_stats()
+    llm_before = get_llm_gateway().stats()
+
+    spans, spans_lock = {}, threading.Lock()
+
+    def on_span(kind, name, outcome, seconds):
+        with spans_lock:
+            spans.setdefault(kind, {}).setdefault(name, []).append(seconds)
+
+    rng = random.Random(args.seed + step)
+    records = []
+
+    def admit(patient, scheduled):
+        started = time.perf_counter()
+        record = {"scheduled": scheduled, "started": started}
+        try:
+            result = run_patient_flow(**patient)
+            status = result["status"].get("ConflictResolver")
+            record["outcome"] = "queued" if result["cache"].get("queued") else \
+                                "admitted" if status == "Success" else "failed"
+        except Exception as e:
+            record["outcome"] = "error"
+            record["error"] = str(e)
+        record["finished"] = time.perf_counter()
+        records.append(record)
+
+    deadlocks_before = deadlocks()
+    add_span_listener(on_span)
+    executor = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="load")
+    try:
+        with LockSampler(args.lock_sample_interval) as sampler:
+            began = time.perf_counter()
+            next_arrival, i = began, 0
+            while next_arrival - began < args.duration and (not args.patients or i < args.patients):
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                # Patients come from the arrival thread, so a seed always produces the same arrivals.
+                executor.submit(admit, make_patient(rng, step, i), next_arrival)
+                i += 1
+                next_arrival += rng.expovariate(rate)
+            executor.shutdown(wait=True)
+            ended = time.perf_counter()
+    finally:
+        executor.shutdown(wait=True)
+        remove_span_listener(on_span)
+
+    outcomes = {}
+    for record in records:
+        outcomes[record["outcome"]] = outcomes.get(record["outcome"], 0) + 1
+    elapsed = ended - began
+    pool = pool_stats()
+    return {
+        "offered_rate": rate,
+        "arrivals": len(records),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(len(records) / elapsed, 3),
+        "admissions_per_s": round(outcomes.get("admitted", 0) / elapsed, 3),
+        "outcomes": outcomes,
+        "latency": {
+            "end_to_end": percentiles([r["finished"] - r["scheduled"] for r in records]),
+            "waiting_for_worker": percentiles([r["started"] - r["scheduled"] for r in records]),
+            "agents": {name: percentiles(samples) for name, samples in sorted(spans.get("node", {}).items())},
+            "sql": {name: percentiles(samples) for name, samples in sorted(spans.get("sql", {}).items())},
+            "llm": {name: percentiles(samples) for name, samples in sorted(spans.get("llm", {}).items())},
+        },
+        "contention": {
+            # Both count as allocation conflicts: only one of doctor/bed could be claimed, or neither.
+            "allocation_conflicts": outcomes.get("queued", 0) + outcomes.get("failed", 0),
+            "lock_waits": sampler.summary(),
+            "deadlocks": deadlocks() - deadlocks_before,
+            "pool_waits": pool["waits"] - pool_before["waits"],
+            "pool_timeouts": pool["timeouts"] - pool_before["timeouts"],
+        },
+        "llm_gateway": {key: value - llm_before[key] if isinstance(value, int) else value
+                        for key, value in get_llm_gateway().stats().items()},
+        "speculation": speculation_stats.snapshot() if args.speculate else None,
+        "errors": sorted({r["error"] for r in records if "error" in r})[:5],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, nargs="+", default=[5.0], help="arrivals per second, one step each")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of arrivals per step")
+    parser.add_argument("--patients", type=int, default=0, help="stop a step after this many arrivals")
+    parser.add_argument("--doctors", type=int, default=40)
+    parser.add_argument("--rooms", type=int, default=80)
+    parser.add_argument("--concurrency", type=int, default=32, help="admissions in flight at once")
+    parser.add_argument("--pool-size", type=int, default=20, help="database connections")
+    parser.add_argument("--mode", choices=["parallel", "atomic"], default="parallel")
+    parser.add_argument("--assessment", choices=["split", "combined", "ab"], default="split",
+                        help="mood and triage as two LLM calls, one combined call, or per patient")
+    parser.add_argument("--llm-profile", choices=["fixed", "lognormal", "thinking"], default="thinking")
+    parser.add_argument("--llm-latency", type=float, default=0.3,
+                        help="fixed latency, lognormal median, or thinking time-to-first-token (s)")
+    parser.add_argument("--llm-sigma", type=float, default=0.6, help="log-normal shape")
+    parser.add_argument("--think-tokens", type=int, default=400, help="median <think> length")
+    parser.add_argument("--tokens-per-sec", type=float, default=250.0)
+    parser.add_argument("--tail-tokens", type=int, default=60, help="tokens the thinking model writes after the answer")
+    parser.add_argument("--stream", action="store_true", help="stream LLM replies and stop at the answer")
+    parser.add_argument("--strict", action="store_true", help="validate LLM answers (SHMAS_LLM_STRICT=1)")
+    parser.add_argument("--speculate", action="store_true", help="hold a doctor and bed while triage runs")
+    parser.add_argument("--llm-concurrency", type=int, default=16)
+    parser.add_argument("--use-cache", action="store_true",
+                        help="keep the LLM cache and rules fast path on (off by default so every patient hits the LLM)")
+    parser.add_argument("--no-workers", action="store_true", help="don't run the expiry worker and dispatcher")
+    parser.add_argument("--lock-sample-interval", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database", default="hospital_load")
+    parser.add_argument("--keep", action="store_true", help="leave the database behind")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    # Everything below reads its settings when first used, so this points the whole app at the bench database.
+    os.environ["SHMAS_DB_DATABASE"] = args.database
+    os.environ["SHMAS_ALLOCATION_MODE"] = args.mode
+    os.environ["SHMAS_ASSESSMENT_MODE"] = args.assessment
+    os.environ.setdefault("SHMAS_LOG_LEVEL", "WARNING")
+    if not args.use_cache:
+        os.environ["SHMAS_LLM_CACHE"] = "0"
+        os.environ["SHMAS_RULES_FASTPATH"] = "0"
+    os.environ["SHMAS_LLM_STREAM"] = "1" if args.stream else "0"
+    os.environ["SHMAS_SPECULATION"] = "1" if args.speculate else "0"
+    if args.strict:
+        os.environ["SHMAS_LLM_STRICT"] = "1"
+    from config import configure_logging
+    from llm_gateway import configure_llm_gateway
+    configure_logging()
+    configure_llm_gateway(backend=LoadStubBackend(args.llm_profile, args.llm_latency, args.llm_sigma,
+                                                  args.think_tokens, args.tokens_per_sec, args.seed,
+                                                  args.tail_tokens),
+                          max_concurrency=args.llm_concurrency)
+
+    from db import init_pool
+    from expiry import start_expiry_worker, stop_expiry_worker
+    from dispatcher import start_dispatcher, stop_dispatcher
+    from listener import get_listener
+
+    create_database(args.database).close()
+    pool = init_pool(maxconn=args.pool_size)
+    workers = []
+    try:
+        if not args.no_workers:
+            workers = [start_expiry_worker(), start_dispatcher()]
+        steps = [run_step(step, rate, args, workers) for step, rate in enumerate(args.rate)]
+    finally:
+        if workers:
+            stop_expiry_worker()
+            stop_dispatcher()
+            get_listener().stop(timeout=5)
+        pool.close()
+        if not args.keep:
+            drop_database(args.database)
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output",)}
+    report = json.dumps({"config": config, "steps": steps}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+if __name__ == "__main__":
+    main()
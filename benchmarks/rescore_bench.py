@@ -0,0 +1,113 @@
+"""Batch queue re-scoring: timing at hospital scale.
+
+Builds a throwaway database from hospitals_db.sql and queues --queued patients
+(10k by default) with random vitals, ages, triage levels and wait times, then
+times QueueRescorer.run_once() end to end: the first pass (every score
+written), a fresh rescorer loading every patient's inputs, and the steady
+state. The NumPy scoring alone is timed against a loop of
+Patient.calculate_priority(). Parity with calculate_priority() is checked
+by tests/test_rescoring.py.
+
+    python benchmarks/rescore_bench.py --queued 10000 --repeat 20
+"""
+import os, sys, json, time, argparse, statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from census_bench import create_database, drop_database
+
+SEED = """
+INSERT INTO patient_info(patient_name, email, symptoms_duration, vitals)
+    SELECT 'Patient ' || g, 'patient' || g || '@bench.local', '0',
+           jsonb_build_object('heart_rate', 40 + floor(random() * 100)::int,
+                              'blood_pressure', jsonb_build_object('systolic', 70 + floor(random() * 110)::int,
+                                                                   'diastolic', 40 + floor(random() * 80)::int))
+    FROM generate_series(1, %(queued)s) g;
+INSERT INTO queue(patient_id, priority_score, type_of_room, department, bed_priority,
+                  triage_level, age, symptom_hours, queued_at)
+    SELECT patient_id, 0, (ARRAY['Emergency','ICU','Ward','Normal'])[1 + patient_id %% 4]::room_type,
+           (ARRAY['Cardiology','Pediatrics','Neurology','Dentist'])[1 + patient_id %% 4],
+           ARRAY[(ARRAY['Emergency','ICU','Ward','Normal'])[1 + patient_id %% 4]]::room_type[],
+           1 + floor(random() * 5)::int, floor(random() * 95)::int, floor(random() * 72)::int,
+           LOCALTIMESTAMP - random() * interval '6 hours'
+    FROM patient_info;
+ANALYZE;
+"""
+ALL_INPUTS_QUERY = """
+    SELECT q.patient_id, COALESCE(q.triage_level, 0), q.age,
+           q.symptom_hours + EXTRACT(EPOCH FROM LOCALTIMESTAMP - q.queued_at)::float8 / 3600,
+           COALESCE((p.vitals->>'heart_rate')::float8, 80),
+           COALESCE((p.vitals->'blood_pressure'->>'systolic')::float8, 120),
+           COALESCE((p.vitals->'blood_pressure'->>'diastolic')::float8, 80)
+    FROM queue q
+    LEFT JOIN patient_info p ON p.patient_id = q.patient_id;
+    """
+
+def timed(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return {"median_ms": round(statistics.median(timings), 3), "min_ms": round(min(timings), 3),
+            "max_ms": round(max(timings), 3)}
+
+def reference_scores(rows):
+    from agents import Patient
+    scores = []
+    for _, triage_level, age, symptom_hours, heart_rate, systolic, diastolic in rows:
+        patient = Patient("", {"heart_rate": heart_rate,
+                               "blood_pressure": {"systolic": systolic, "diastolic": diastolic}},
+                          "", "", age, [], symptom_hours)
+        patient.triage_level = triage_level
+        patient.calculate_priority()
+        scores.append(patient.priority_score)
+    return scores
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queued", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--database", default="hospital_rescore")
+    parser.add_argument("--keep", action="store_true", help="leave the database behind")
+    args = parser.parse_args()
+
+    os.environ["SHMAS_DB_DATABASE"] = args.database
+    os.environ.setdefault("SHMAS_LOG_LEVEL", "WARNING")
+    from config import configure_logging
+    configure_logging()
+    from db import db_cursor, init_pool
+    from rescoring import QueueRescorer, score_priorities
+
+    conn = create_database(args.database)
+    with conn.cursor() as cur:
+        cur.execute(SEED, {"queued": args.queued})
+    conn.commit()
+    conn.close()
+    pool = init_pool()
+    try:
+        rescorer = QueueRescorer()
+        started = time.perf_counter()
+        scored, changed = rescorer.run_once()
+        first_pass = {"scored": scored, "changed": changed, "ms": round((time.perf_counter() - started) * 1000, 3)}
+        with db_cursor() as cursor:
+            cursor.execute(ALL_INPUTS_QUERY)
+            rows = cursor.fetchall()
+        _, triage_level, age, symptom_hours, heart_rate, systolic, diastolic = zip(*rows)
+        columns = (triage_level, age, heart_rate, systolic, diastolic, symptom_hours)
+        results = {
+            "first_pass": first_pass,
+            "cold_run_once": timed(lambda: QueueRescorer().run_once(), max(1, args.repeat // 4)),
+            "run_once": timed(rescorer.run_once, args.repeat),
+            "score_numpy": timed(lambda: score_priorities(*columns), args.repeat),
+            "score_calculate_priority": timed(lambda: reference_scores(rows), max(1, args.repeat // 4)),
+        }
+    finally:
+        pool.close()
+        if not args.keep:
+            drop_database(args.database)
+
+    print(json.dumps({"config": vars(args), "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import os, atexit, logging, threading
+from collections import namedtuple
+from queue import SimpleQueue
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+HospitalConfig = namedtuple("HospitalConfig", ["allocation_mode", "log_level", "assessment_mode"])
+
+_env_loaded = False
+_env_lock = threading.Lock()
+
+def load_env():
+    # .env is read on first use rather than at import, so importing modules stays side-effect free.
+    global _env_loaded
+    if not _env_loaded:
+        with _env_lock:
+            if not _env_loaded:
+                from dotenv import load_dotenv
+                load_dotenv()
+                _env_loaded = True
+
+def hospital_config_from_env(**overrides):
+    load_env()
+    config = HospitalConfig(
+        allocation_mode=os.getenv("SHMAS_ALLOCATION_MODE", "parallel"),
+        log_level=os.getenv("SHMAS_LOG_LEVEL", "DEBUG"),
+        # split (mood and triage nodes), combined (one assessment call) or ab (per patient, see assessment_arm).
+        assessment_mode=os.getenv("SHMAS_ASSESSMENT_MODE", "split"),
+    )
+    return config._replace(**overrides)
+
+class DeferredQueueHandler(QueueHandler):
+    # The stock handler formats each record on the caller's thread; the queue
+    # never leaves the process, so hand the record over as is and let the
+    # listener thread do the formatting.
+    def prepare(self, record):
+        return record
+
+_log_listener = None
+
+def configure_logging(level=None):
+    # For entry points (dashboard, workers, benchmarks); library modules never touch logging config.
+    # Records are queued and written by a background thread, so logging never blocks an admission on I/O.
+    global _log_listener
+    load_env()
+    root = logging.getLogger()
+    if _log_listener is not None or root.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    queue = SimpleQueue()
+    _log_listener = QueueListener(queue, handler, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    root.addHandler(DeferredQueueHandler(queue))
+    root.setLevel(level or os.getenv("SHMAS_LOG_LEVEL", "DEBUG"))
+    logging.getLogger("shmas.trace").setLevel(os.getenv("SHMAS_TRACE_LEVEL", "WARNING"))
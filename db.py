@@ -0,0 +1,252 @@
+import os, threading, time, asyncio, weakref
+from contextlib import contextmanager, asynccontextmanager
+import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg2.extensions import cursor as pg_cursor
+from logging import debug
+from config import load_env
+from metrics import span, observe, statement_name
+
+# Defaults for a local development database; every key can be overridden with SHMAS_DB_<KEY>.
+# There is no default password: without SHMAS_DB_PASSWORD, libpq reads PGPASSWORD or ~/.pgpass.
+DB_DEFAULTS = {
+    "host": "localhost",
+    "database": "hospital",
+    "user": "postgres",
+    "port": "5432",
+}
+
+def db_config():
+    load_env()
+    config = {key: os.getenv(f"SHMAS_DB_{key.upper()}", default) for key, default in DB_DEFAULTS.items()}
+    password = os.getenv("SHMAS_DB_PASSWORD")
+    if password:
+        config["password"] = password
+    return config
+
+class PoolTimeoutError(Exception):
+    pass
+
+class TracedCursor(pg_cursor):
+    """psycopg2 cursor that times every statement as a ``sql`` span."""
+
+    def execute(self, query, vars=None):
+        with span("sql", statement_name(query)):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with span("sql", statement_name(query)):
+            return super().executemany(query, vars_list)
+
+_async_cursor_class = None
+
+def traced_async_cursor():
+    # Built on first use so psycopg (v3) is only imported by processes that use the async pool.
+    global _async_cursor_class
+    if _async_cursor_class is None:
+        from psycopg import AsyncCursor
+
+        class TracedAsyncCursor(AsyncCursor):
+            async def execute(self, query, params=None, **kwargs):
+                with span("sql", statement_name(query)):
+                    return await super().execute(query, params, **kwargs)
+
+        _async_cursor_class = TracedAsyncCursor
+    return _async_cursor_class
+
+class ConnectionPool:
+    """Thread-safe psycopg2 pool with per-request checkout.
+
+    Callers block (up to ``checkout_timeout`` seconds) when all ``maxconn``
+    connections are in use instead of failing immediately. Idle connections
+    are health-checked before being handed out and broken ones are replaced.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, checkout_timeout=10.0, health_check_interval=30.0, **conn_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.conn_kwargs = conn_kwargs or db_config()
+        conn_kwargs = dict({"cursor_factory": TracedCursor}, **self.conn_kwargs)
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, **conn_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._stats = {
+            "checkouts": 0,
+            "in_use": 0,
+            "peak_in_use": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+            "reconnects": 0,
+            "errors": 0,
+        }
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn), 0.0)
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _acquire(self):
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["waits"] += 1
+            if not self._slots.acquire(timeout=self.checkout_timeout):
+                with self._lock:
+                    self._stats["timeouts"] += 1
+                raise PoolTimeoutError(f"No database connection available after {self.checkout_timeout}s "
+                                       f"({self.maxconn} in use)")
+        waited = time.monotonic() - started
+        observe("shmas_db_checkout_wait_seconds", waited)
+        try:
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                debug("Discarding unhealthy database connection...")
+                with self._lock:
+                    self._stats["health_check_failures"] += 1
+                    self._stats["reconnects"] += 1
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+            self._stats["peak_in_use"] = max(self._stats["peak_in_use"], self._stats["in_use"])
+            self._stats["wait_time_total"] += waited
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+        return conn
+
+    def _release(self, conn, broken=False):
+        try:
+            if broken or conn.closed:
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn)
+        finally:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+        except Exception:
+            with self._lock:
+                self._stats["errors"] += 1
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self._release(conn, broken)
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                yield cur
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["max_size"] = self.maxconn
+        stats["min_size"] = self.minconn
+        stats["saturation"] = stats["in_use"] / self.maxconn
+        return stats
+
+    def close(self):
+        self._pool.closeall()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _create_pool(minconn=None, maxconn=None, **kwargs):
+    load_env()
+    return ConnectionPool(
+        minconn=minconn if minconn is not None else int(os.getenv("SHMAS_DB_POOL_MIN", "1")),
+        maxconn=maxconn if maxconn is not None else int(os.getenv("SHMAS_DB_POOL_MAX", "10")),
+        **kwargs,
+    )
+
+def init_pool(minconn=None, maxconn=None, **kwargs):
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = _create_pool(minconn, maxconn, **kwargs)
+    return _pool
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _create_pool()
+    return _pool
+
+def db_cursor():
+    return get_pool().cursor()
+
+def pool_stats():
+    return get_pool().stats()
+
+# Async pools are bound to the event loop that opened them, so keep one per loop.
+_async_pools = weakref.WeakKeyDictionary()
+
+async def get_async_pool():
+    from psycopg_pool import AsyncConnectionPool
+    loop = asyncio.get_running_loop()
+    apool = _async_pools.get(loop)
+    if apool is None:
+        conn_kwargs = db_config()
+        conn_kwargs["dbname"] = conn_kwargs.pop("database")
+        conn_kwargs["cursor_factory"] = traced_async_cursor()
+        apool = AsyncConnectionPool(
+            kwargs=conn_kwargs,
+            min_size=int(os.getenv("SHMAS_DB_POOL_MIN", "1")),
+            max_size=int(os.getenv("SHMAS_DB_POOL_MAX", "10")),
+            check=AsyncConnectionPool.check_connection,
+            open=False,
+        )
+        _async_pools[loop] = apool
+    # open() is idempotent and serialised, so concurrent first users all wait for it.
+    await apool.open()
+    return apool
+
+@asynccontextmanager
+async def async_db_cursor():
+    apool = await get_async_pool()
+    async with apool.connection() as conn:
+        async with conn.cursor() as cur:
+            yield cur
+
+async def close_async_pool():
+    apool = _async_pools.pop(asyncio.get_running_loop(), None)
+    if apool is not None:
+        await apool.close()
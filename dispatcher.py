@@ -0,0 +1,281 @@
+"""Admits queued patients as doctors and beds free up.
+
+An in-memory mirror of the ``queue`` table is kept as one max-heap per
+department and one per bed type, so a freed Cardiology doctor or ICU bed goes
+straight to the highest-priority patient who can use it. The dispatcher
+listens (through the process-wide listener in listener.py) for the release
+and queue events raised by triggers in hospitals_db.sql and does no polling;
+the mirror is reloaded whenever the listener (re)connects, which is the only
+time notifications can be missed.
+
+With the in-process allocator (allocator.py) the doctor and bed are claimed
+in memory and written together with the queue-to-case move, so the
+dispatcher never claims behind the allocator's back. Run it in the same
+process as the admissions (start_dispatcher()) in that mode; see
+allocator.py for why.
+
+Runs inside the dashboard process via start_dispatcher(), or standalone:
+
+    python -m dispatcher
+"""
+import os, re, time, heapq, itertools, threading, argparse, logging
+from collections import deque, namedtuple
+from datetime import timedelta
+from logging import debug
+from db import db_cursor
+from config import configure_logging
+from listener import get_listener
+from allocator import allocator_enabled, ready_allocator
+
+RELEASE_CHANNEL = "shmas_release"
+QUEUE_CHANNEL = "shmas_queue"
+QUEUE_QUERY = """
+    SELECT patient_id, priority_score, department, bed_priority, type_of_room, block_duration
+    FROM queue;
+    """
+ADMIT_QUERY = "SELECT * FROM admit_from_queue(%s::bigint);"
+# admit_from_queue() for a doctor and bed already claimed in memory; no row back if the entry is gone.
+ADMIT_CLAIMED_QUERY = """
+    WITH admitted AS (
+        DELETE FROM queue
+        WHERE ctid = (SELECT ctid FROM queue WHERE patient_id = %(patient_id)s LIMIT 1 FOR UPDATE SKIP LOCKED)
+        RETURNING queued_at
+    ), admitted_case AS (
+        INSERT INTO ongoing_cases(patient_id, doctor_id, room_number)
+        SELECT %(patient_id)s, %(doctor_id)s, %(room_number)s FROM admitted
+    )
+    SELECT EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - queued_at)::float8 FROM admitted;
+    """
+INTERVAL_TEXT = re.compile(r"(?:(-?\d+) days? ?)?(?:(-?\d+):(\d+):(\d+(?:\.\d+)?))?")
+
+QueueEntry = namedtuple("QueueEntry", ["patient_id", "priority_score", "department", "bed_types", "seq",
+                                       "block_duration"])
+
+def parse_bed_types(value, fallback=None):
+    # psycopg2 hands back enum arrays as their text form, e.g. '{ICU,Emergency}'.
+    if isinstance(value, str):
+        value = [v for v in value.strip("{}").split(",") if v]
+    return list(value or ([fallback] if fallback else []))
+
+def parse_block_duration(value):
+    # Notification rows carry intervals as text, e.g. '00:30:00' or '1 day 02:00:00'.
+    if isinstance(value, str):
+        days, hours, minutes, seconds = INTERVAL_TEXT.fullmatch(value.strip()).groups()
+        value = timedelta(days=int(days or 0), hours=int(hours or 0), minutes=int(minutes or 0),
+                          seconds=float(seconds or 0))
+    # Same default as admit_from_queue().
+    return value or timedelta(minutes=1)
+
+def percentiles(samples, points=(50, 90, 99)):
+    if not samples:
+        return {f"p{p}": None for p in points}
+    ordered = sorted(samples)
+    return {f"p{p}": ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+class QueueDispatcher:
+    def __init__(self, max_attempts=None, listener=None, history=10000):
+        self.max_attempts = max_attempts or int(os.getenv("SHMAS_DISPATCH_MAX_ATTEMPTS", "3"))
+        self.listener = listener or get_listener()
+        self._entries = {}
+        self._by_department = {}
+        self._by_bed_type = {}
+        self._seq = itertools.count()
+        self._lock = threading.RLock()
+        self._waits = deque(maxlen=history)
+        self._stats = {"events": 0, "attempts": 0, "admitted": 0, "resyncs": 0}
+
+    def _add(self, patient_id, priority_score, department, bed_priority, type_of_room=None, block_duration=None):
+        entry = QueueEntry(patient_id, float(priority_score or 0), department,
+                           parse_bed_types(bed_priority, type_of_room), next(self._seq),
+                           parse_block_duration(block_duration))
+        with self._lock:
+            self._entries[patient_id] = entry
+            # Highest priority first, then first come first served.
+            key = (-entry.priority_score, entry.seq, patient_id)
+            if department:
+                heapq.heappush(self._by_department.setdefault(department, []), key)
+            for bed_type in entry.bed_types:
+                heapq.heappush(self._by_bed_type.setdefault(bed_type, []), key)
+        return entry
+
+    def _remove(self, patient_id):
+        # Heap keys are left behind and skipped lazily once the entry is gone.
+        with self._lock:
+            return self._entries.pop(patient_id, None)
+
+    def resync(self):
+        with db_cursor() as cursor:
+            cursor.execute(QUEUE_QUERY)
+            rows = cursor.fetchall()
+        with self._lock:
+            self._entries.clear()
+            self._by_department.clear()
+            self._by_bed_type.clear()
+            for row in rows:
+                self._add(*row)
+            self._stats["resyncs"] += 1
+        debug(f"Dispatcher mirrored {len(rows)} queued patients...")
+
+    def _candidates(self, heap, limit):
+        # The top ``limit`` live entries of one heap, in priority order.
+        found, popped = [], []
+        with self._lock:
+            while heap and len(found) < limit:
+                key = heapq.heappop(heap)
+                entry = self._entries.get(key[2])
+                if entry is None or entry.seq != key[1]:
+                    continue
+                popped.append(key)
+                found.append(entry.patient_id)
+            for key in popped:
+                heapq.heappush(heap, key)
+        return found
+
+    def _admit_in_memory(self, allocator, patient_id):
+        # doctors_dashboard_trigger fires before doctors_release_notify_trigger (likewise for rooms), so
+        # the allocator has applied a release by the time the dispatcher hears of it.
+        with self._lock:
+            entry = self._entries.get(patient_id)
+        if entry is None:
+            return "Gone", None, None, None
+        doctor = allocator.claim_doctor(entry.department, entry.block_duration, patient_id)
+        room = allocator.claim_room(entry.bed_types, patient_id) if doctor else None
+        if room is None:
+            if doctor:
+                allocator.release_doctor(doctor[0])
+            return "Waiting", None, None, None
+        try:
+            with db_cursor() as cursor:
+                # The claims are written with the case, so it can't name a row lost to another writer.
+                held = allocator.confirm(cursor, patient_id, doctor[0], room[0])
+                row = None
+                if all(held):
+                    cursor.execute(ADMIT_CLAIMED_QUERY, {"patient_id": patient_id, "doctor_id": doctor[0],
+                                                         "room_number": room[0]})
+                    row = cursor.fetchone()
+        except Exception:
+            allocator.load()
+            raise
+        if row is None:
+            # A claim was lost, or the entry was admitted or withdrawn elsewhere meanwhile.
+            if held[0]:
+                allocator.release_doctor(doctor[0])
+            if held[1]:
+                allocator.release_room(room[0])
+            return ("Gone" if all(held) else "Waiting"), None, None, None
+        return "Admitted", doctor[0], room[0], row[0]
+
+    def try_admit(self, patient_id):
+        with self._lock:
+            self._stats["attempts"] += 1
+        allocator = ready_allocator()
+        if allocator is not None:
+            outcome, doctor_id, room_number, waited = self._admit_in_memory(allocator, patient_id)
+        else:
+            with db_cursor() as cursor:
+                cursor.execute(ADMIT_QUERY, (patient_id,))
+                outcome, doctor_id, room_number, waited = cursor.fetchone()
+        if outcome == "Waiting":
+            return False
+        self._remove(patient_id)
+        if outcome == "Admitted":
+            with self._lock:
+                self._stats["admitted"] += 1
+                self._waits.append(waited)
+            debug(f"Dispatcher admitted queued patient {patient_id} with doctor {doctor_id}, "
+                  f"room {room_number} after {waited:.1f}s...")
+            return True
+        return False
+
+    def on_release(self, kind, category):
+        with self._lock:
+            heaps = self._by_department if kind == "doctor" else self._by_bed_type
+            heap = heaps.get(category)
+            candidates = self._candidates(heap, self.max_attempts) if heap else []
+        for patient_id in candidates:
+            if self.try_admit(patient_id):
+                return patient_id
+        return None
+
+    def on_queue_change(self, op, row):
+        if op == "RERANK":
+            # rescore_queue() moved scores in bulk; rebuilding the heaps is cheaper than a diff per row.
+            self.resync()
+            return
+        if op == "DELETE":
+            self._remove(row["patient_id"])
+            return
+        self._add(row["patient_id"], row["priority_score"], row["department"],
+                  row["bed_priority"], row["type_of_room"], row.get("block_duration"))
+        # Whatever it was missing may have been freed before this entry committed.
+        self.try_admit(row["patient_id"])
+
+    def handle(self, channel, payload):
+        with self._lock:
+            self._stats["events"] += 1
+        if channel == RELEASE_CHANNEL:
+            self.on_release(payload["kind"], payload["category"])
+        elif channel == QUEUE_CHANNEL:
+            self.on_queue_change(payload["op"], payload.get("row"))
+
+    def start(self):
+        # Admissions run on the listener thread, one event at a time, so they never race each other here.
+        self.listener.subscribe([RELEASE_CHANNEL, QUEUE_CHANNEL], self.handle, on_connect=self.resync)
+        return self
+
+    def stop(self):
+        self.listener.unsubscribe(self.handle, on_connect=self.resync)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["queue_depth"] = len(self._entries)
+            depth = {}
+            for entry in self._entries.values():
+                depth[entry.department] = depth.get(entry.department, 0) + 1
+            stats["depth_by_department"] = depth
+            waits = list(self._waits)
+        stats["time_in_queue"] = percentiles(waits)
+        return stats
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def start_dispatcher(**kwargs):
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = QueueDispatcher(**kwargs)
+        return _dispatcher.start()
+
+def get_dispatcher():
+    return _dispatcher
+
+def stop_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is not None:
+            _dispatcher.stop()
+            _dispatcher = None
+
+def main():
+    parser = argparse.ArgumentParser(description="Admit queued patients as doctors and beds free up.")
+    parser.add_argument("--max-attempts", type=int, default=None, help="queued patients tried per release")
+    parser.add_argument("--stats-every", type=float, default=60.0, help="seconds between stats lines")
+    args = parser.parse_args()
+    if allocator_enabled():
+        parser.error("SHMAS_ALLOCATOR=memory would give this process an allocator of its own; "
+                     "run the dispatcher in the admitting process with start_dispatcher() instead")
+    configure_logging()
+
+    dispatcher = QueueDispatcher(max_attempts=args.max_attempts).start()
+    try:
+        while True:
+            time.sleep(args.stats_every)
+            logging.info(f"Dispatcher stats : {dispatcher.stats()}")
+    except KeyboardInterrupt:
+        dispatcher.stop()
+        dispatcher.listener.stop(timeout=5)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""Background release of doctors whose busy_till has passed.
+
+Keeps a min-heap of upcoming busy_till deadlines and sleeps until the earliest
+one, then releases just the expired doctors in one transaction, along with
+any speculative holds (speculation.py) that lapsed; a held doctor's busy_till
+is its hold's expiry. New deadlines
+written by other processes are picked up by a periodic resync, which runs more
+often than the shortest block (see get_block_duration), so none is missed.
+
+Runs inside the dashboard process via start_expiry_worker(), or standalone:
+
+    python -m expiry
+"""
+import os, time, heapq, threading, argparse
+from logging import debug
+from db import db_cursor
+from config import configure_logging
+
+# Seconds left are computed on the database clock, so server time zone and
+# clock skew between hosts don't matter.
+DEADLINES_QUERY = """
+    SELECT doctor_id, EXTRACT(EPOCH FROM busy_till - CURRENT_TIMESTAMP)::float
+    FROM doctors
+    WHERE is_busy = TRUE AND busy_till IS NOT NULL;
+    """
+EXPIRE_QUERY = "SELECT * FROM expire_doctors();"
+EXPIRE_HOLDS_QUERY = "SELECT * FROM expire_holds();"
+ORPHANED_ROOMS_QUERY = """
+    SELECT room_number FROM rooms r
+    WHERE is_occupied = TRUE
+      AND NOT EXISTS (SELECT 1 FROM ongoing_cases oc WHERE oc.room_number = r.room_number)
+      AND NOT EXISTS (SELECT 1 FROM resource_holds h WHERE h.kind = 'room' AND h.resource_id = r.room_number);
+    """
+RELEASE_ROOMS_QUERY = "SELECT * FROM release_orphaned_rooms(%s::int[]);"
+
+# Deadlines are popped this long after they pass, so the database clock has
+# surely reached busy_till when expire_doctors() runs.
+EXPIRY_SLACK = 0.05
+RETRY_DELAY = 5.0
+
+class ExpiryWorker:
+    def __init__(self, resync_interval=None, orphan_interval=None):
+        self.resync_interval = resync_interval or float(os.getenv("SHMAS_EXPIRY_RESYNC", "30"))
+        self.orphan_interval = orphan_interval or float(os.getenv("SHMAS_EXPIRY_ORPHAN_SWEEP", "60"))
+        self._heap = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._orphan_candidates = set()
+        self._next_resync = 0.0
+        self._next_orphan_sweep = time.monotonic() + self.orphan_interval
+        self._stats = {"passes": 0, "resyncs": 0, "doctors_released": 0, "rooms_released": 0,
+                       "holds_expired": 0, "errors": 0, "last_lag": None, "max_lag": 0.0}
+
+    def schedule(self, doctor_id, seconds):
+        # Lets an in-process caller add a deadline without waiting for the next resync.
+        deadline = time.monotonic() + seconds
+        with self._lock:
+            heapq.heappush(self._heap, (deadline, doctor_id))
+            earliest = self._heap[0][0] == deadline
+        if earliest:
+            self._wake.set()
+
+    def resync(self):
+        with db_cursor() as cursor:
+            cursor.execute(DEADLINES_QUERY)
+            rows = cursor.fetchall()
+        now = time.monotonic()
+        heap = [(now + remaining, doctor_id) for doctor_id, remaining in rows]
+        heapq.heapify(heap)
+        with self._lock:
+            self._heap = heap
+            self._stats["resyncs"] += 1
+        self._next_resync = now + self.resync_interval
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] + EXPIRY_SLACK <= now:
+                due.append(heapq.heappop(self._heap))
+        return due
+
+    def run_once(self):
+        """Releases whatever is due now; returns the released doctor ids and room numbers."""
+        now = time.monotonic()
+        due = self._pop_due(now)
+        sweep = now >= self._next_orphan_sweep
+        if not due and not sweep:
+            return [], []
+        doctors, rooms, holds = [], [], []
+        with db_cursor() as cursor:
+            # Lapsed holds first, so their resources are released as holds rather than as expired blocks.
+            cursor.execute(EXPIRE_HOLDS_QUERY)
+            holds = cursor.fetchall()
+            if due:
+                cursor.execute(EXPIRE_QUERY)
+                doctors = [row[0] for row in cursor.fetchall()]
+            if sweep:
+                # A room is released only if it was already orphaned on the previous sweep.
+                if self._orphan_candidates:
+                    cursor.execute(RELEASE_ROOMS_QUERY, (sorted(self._orphan_candidates),))
+                    rooms = [row[0] for row in cursor.fetchall()]
+                cursor.execute(ORPHANED_ROOMS_QUERY)
+                self._orphan_candidates = {row[0] for row in cursor.fetchall()} - set(rooms)
+        if sweep:
+            self._next_orphan_sweep = now + self.orphan_interval
+        with self._lock:
+            self._stats["passes"] += 1
+            self._stats["doctors_released"] += len(doctors)
+            self._stats["rooms_released"] += len(rooms)
+            self._stats["holds_expired"] += len(holds)
+            if due:
+                lag = time.monotonic() - due[0][0]
+                self._stats["last_lag"] = lag
+                self._stats["max_lag"] = max(self._stats["max_lag"], lag)
+        if doctors or rooms or holds:
+            debug(f"Expiry released doctors {doctors}, rooms {rooms} and lapsed holds {holds}...")
+        return doctors, rooms
+
+    def _timeout(self):
+        with self._lock:
+            next_deadline = self._heap[0][0] + EXPIRY_SLACK if self._heap else float("inf")
+        wake_at = min(next_deadline, self._next_resync, self._next_orphan_sweep)
+        return max(0.0, wake_at - time.monotonic())
+
+    def run(self):
+        debug("Expiry worker started...")
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() >= self._next_resync:
+                    self.resync()
+                self.run_once()
+                timeout = self._timeout()
+            except Exception as e:
+                with self._lock:
+                    self._stats["errors"] += 1
+                debug(f"Expiry pass failed, retrying in {RETRY_DELAY}s...\n{e}")
+                timeout = RETRY_DELAY
+            self._wake.wait(timeout)
+            self._wake.clear()
+        debug("Expiry worker stopped...")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name="shmas-expiry", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending_deadlines"] = len(self._heap)
+        stats["orphan_candidates"] = len(self._orphan_candidates)
+        return stats
+
+_worker = None
+_worker_lock = threading.Lock()
+
+def start_expiry_worker(**kwargs):
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = ExpiryWorker(**kwargs)
+        return _worker.start()
+
+def stop_expiry_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is not None:
+            _worker.stop()
+            _worker = None
+
+def main():
+    parser = argparse.ArgumentParser(description="Release doctors whose busy_till has passed.")
+    parser.add_argument("--resync", type=float, default=None, help="seconds between deadline resyncs")
+    parser.add_argument("--orphan-sweep", type=float, default=None, help="seconds between orphaned-room sweeps")
+    parser.add_argument("--once", action="store_true", help="release what is due now and exit")
+    args = parser.parse_args()
+    configure_logging()
+
+    worker = ExpiryWorker(resync_interval=args.resync, orphan_interval=args.orphan_sweep)
+    if args.once:
+        worker.resync()
+        print(worker.run_once())
+        return
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""Routing patients this hospital can't take to the nearby site with the shortest wait.
+
+The federation is N hospital databases with the hospitals_db.sql schema,
+listed in a JSON file named by SHMAS_FEDERATION_SITES:
+
+    [{"name": "north", "database": "hospital_north", "travel_minutes": 0},
+     {"name": "south", "host": "10.0.0.7", "database": "hospital", "travel_minutes": 12}]
+
+Any key a site leaves out (host, port, user, ...) comes from db_config().
+SHMAS_FEDERATION_LOCAL names this hospital's own entry, if it has one.
+
+Each site's capacity (free and total doctors per department, beds per room
+type, when the busy ones come free, and the waiting queue's priority scores)
+is read with a single statement into an immutable ``SiteCapacity``. A
+background refresher reads every site every SHMAS_FEDERATION_REFRESH
+seconds. When an admission is diverted or queued, ``route()`` ranks the
+sites on those cached snapshots, re-reads the best few
+(SHMAS_FEDERATION_CANDIDATES) in parallel, waits at most
+SHMAS_FEDERATION_DEADLINE seconds for them, and picks the site with the
+shortest projected wait. A site that misses the deadline is judged on its
+cached snapshot while that is younger than SHMAS_FEDERATION_MAX_STALENESS.
+Slow reads are not abandoned; they finish in the background and refresh the
+cache. There is at most one read in flight per site, and a site that just
+failed, or is still working on a read older than the deadline, isn't waited
+for at all.
+
+    python -m federation --department Cardiology --bed ICU
+"""
+import os, json, time, argparse, threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from logging import debug
+from db import ConnectionPool, db_config
+from config import load_env, configure_logging
+from metrics import span, inc
+
+# One round trip per site. Seconds until a busy doctor (or the doctor on an
+# occupied bed's case) is free are computed on that site's clock, soonest
+# first, and the queue's scores highest first; both are cut at %(depth)s.
+CAPACITY_QUERY = """
+    SELECT 'doctor', specialist,
+           COUNT(*) FILTER (WHERE is_busy = FALSE), COUNT(*),
+           (array_agg(GREATEST(EXTRACT(EPOCH FROM busy_till - CURRENT_TIMESTAMP), 0)::float8 ORDER BY busy_till)
+               FILTER (WHERE is_busy = TRUE AND busy_till IS NOT NULL))[1:%(depth)s]
+    FROM doctors
+    GROUP BY specialist
+    UNION ALL
+    SELECT 'room', r.type::text,
+           COUNT(*) FILTER (WHERE r.is_occupied = FALSE), COUNT(*),
+           (array_agg(GREATEST(EXTRACT(EPOCH FROM d.busy_till - CURRENT_TIMESTAMP), 0)::float8 ORDER BY d.busy_till)
+               FILTER (WHERE d.busy_till IS NOT NULL))[1:%(depth)s]
+    FROM rooms r
+    LEFT JOIN LATERAL (
+        SELECT MIN(d.busy_till) busy_till
+        FROM ongoing_cases oc
+        JOIN doctors d ON d.doctor_id = oc.doctor_id AND d.is_busy = TRUE
+        WHERE oc.room_number = r.room_number AND r.is_occupied = TRUE
+    ) d ON TRUE
+    GROUP BY r.type
+    UNION ALL
+    SELECT 'queue_department', department, 0, COUNT(*),
+           (array_agg(priority_score::float8 ORDER BY priority_score DESC))[1:%(depth)s]
+    FROM queue
+    GROUP BY department
+    UNION ALL
+    SELECT 'queue_room', type_of_room::text, 0, COUNT(*),
+           (array_agg(priority_score::float8 ORDER BY priority_score DESC))[1:%(depth)s]
+    FROM queue
+    GROUP BY type_of_room;
+    """
+
+Site = namedtuple("Site", ["name", "conn_kwargs", "travel_minutes"])
+
+# Each kind maps a category to (free, total, seconds): seconds are release times for
+# doctors and rooms, priority scores for the queues (free is unused there).
+SiteCapacity = namedtuple("SiteCapacity", ["site", "taken_at", "doctors", "rooms", "queue_departments",
+                                           "queue_rooms"])
+
+# projected_wait is in seconds, travel included; source is "live" or "cached".
+Referral = namedtuple("Referral", ["site", "projected_wait", "travel_minutes", "source", "considered"])
+
+def federation_sites(path=None):
+    """The configured sites, or [] when no federation is configured."""
+    load_env()
+    path = path or os.getenv("SHMAS_FEDERATION_SITES")
+    if not path:
+        return []
+    with open(path) as f:
+        entries = json.load(f)
+    defaults = db_config()
+    sites = []
+    for entry in entries:
+        entry = dict(entry)
+        name = entry.pop("name")
+        travel_minutes = float(entry.pop("travel_minutes", 0))
+        sites.append(Site(name, dict(defaults, **entry), travel_minutes))
+    return sites
+
+def _capacity_from_rows(site, rows, taken_at):
+    kinds = {"doctor": {}, "room": {}, "queue_department": {}, "queue_room": {}}
+    for kind, category, free, total, seconds in rows:
+        if category is not None:
+            kinds[kind][category] = (free, total, tuple(seconds or ()))
+    return SiteCapacity(site, taken_at, kinds["doctor"], kinds["room"], kinds["queue_department"],
+                        kinds["queue_room"])
+
+def _ahead(queued, priority_score):
+    # Waiting patients who would be admitted first; past the cut, assume the whole queue is.
+    if queued is None:
+        return 0
+    _, total, scores = queued
+    ahead = sum(1 for score in scores if score > priority_score)
+    return total if ahead == len(scores) and total > len(scores) else ahead
+
+def _slot_wait(free, total, releases, ahead, cycle, elapsed):
+    """Seconds until the resource for the (ahead + 1)-th patient in line is free, or None if there is none.
+
+    Once the free ones are taken, resources come free in release order and each
+    then serves one more patient per ``cycle`` seconds.
+    """
+    if total == 0:
+        return None
+    if ahead < free:
+        return 0.0
+    rounds, slot = divmod(ahead - free, total)
+    if slot < len(releases):
+        release = releases[slot]
+    else:
+        release = releases[-1] if releases else cycle
+    return max(0.0, release - elapsed) + rounds * cycle
+
+def projected_wait(capacity, department, room_types, priority_score, block_seconds, now=None):
+    """Seconds until ``capacity.site`` could admit the patient, travel included; None if it never could."""
+    elapsed = (now or time.monotonic()) - capacity.taken_at
+    free, total, releases = capacity.doctors.get(department, (0, 0, ()))
+    doctor_wait = _slot_wait(free, total, releases,
+                             _ahead(capacity.queue_departments.get(department), priority_score),
+                             block_seconds, elapsed)
+    rooms = [capacity.rooms[room_type] for room_type in room_types if room_type in capacity.rooms]
+    queued = [capacity.queue_rooms[room_type] for room_type in room_types if room_type in capacity.queue_rooms]
+    bed_wait = _slot_wait(sum(room[0] for room in rooms), sum(room[1] for room in rooms),
+                          sorted(seconds for room in rooms for seconds in room[2]),
+                          sum(_ahead(queue, priority_score) for queue in queued), block_seconds, elapsed)
+    if doctor_wait is None or bed_wait is None:
+        return None
+    return max(doctor_wait, bed_wait) + capacity.site.travel_minutes * 60
+
+class FederationRouter:
+    def __init__(self, sites, local=None, refresh_interval=None, deadline=None, max_staleness=None,
+                 candidates=None, statement_timeout=None, depth=None):
+        self.sites = {site.name: site for site in sites}
+        self.local = local if local is not None else os.getenv("SHMAS_FEDERATION_LOCAL")
+        self.refresh_interval = refresh_interval or float(os.getenv("SHMAS_FEDERATION_REFRESH", "10"))
+        self.deadline = deadline or float(os.getenv("SHMAS_FEDERATION_DEADLINE", "0.5"))
+        self.max_staleness = max_staleness or float(os.getenv("SHMAS_FEDERATION_MAX_STALENESS", "60"))
+        self.candidates = candidates or int(os.getenv("SHMAS_FEDERATION_CANDIDATES", "8"))
+        # Bounds how long a stuck site can hold one of the reader threads.
+        self.statement_timeout = statement_timeout or float(os.getenv("SHMAS_FEDERATION_STATEMENT_TIMEOUT", "2"))
+        self.depth = depth or int(os.getenv("SHMAS_FEDERATION_DEPTH", "200"))
+        workers = int(os.getenv("SHMAS_FEDERATION_WORKERS", "0")) or min(32, max(1, len(self.sites)))
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shmas-federation")
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._snapshots = {}
+        self._inflight = {}
+        self._failed_at = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"reads": 0, "errors": 0, "late": 0, "routes": 0, "referrals": 0, "unroutable": 0}
+
+    def _pool(self, site):
+        with self._lock:
+            pool = self._pools.get(site.name)
+            if pool is None:
+                conn_kwargs = dict(site.conn_kwargs)
+                conn_kwargs.setdefault("connect_timeout", max(1, round(self.statement_timeout)))
+                conn_kwargs.setdefault("options", f"-c statement_timeout={int(self.statement_timeout * 1000)}")
+                # No connections are opened until the site is first read.
+                pool = self._pools[site.name] = ConnectionPool(
+                    minconn=0, maxconn=int(os.getenv("SHMAS_FEDERATION_POOL_MAX", "2")),
+                    checkout_timeout=self.statement_timeout, **conn_kwargs)
+        return pool
+
+    def read_site(self, site):
+        taken_at = time.monotonic()
+        with span("federation", "read") as fields:
+            fields["site"] = site.name
+            with self._pool(site).cursor() as cursor:
+                cursor.execute(CAPACITY_QUERY, {"depth": self.depth})
+                rows = cursor.fetchall()
+        return _capacity_from_rows(site, rows, taken_at)
+
+    def _read_done(self, name, future):
+        with self._lock:
+            self._inflight.pop(name, None)
+            if future.cancelled():
+                return
+            self._stats["reads"] += 1
+            error = future.exception()
+            if error is None:
+                self._snapshots[name] = future.result()
+                self._failed_at.pop(name, None)
+            else:
+                self._stats["errors"] += 1
+                self._failed_at[name] = time.monotonic()
+        inc("shmas_federation_reads_total", result="error" if error else "ok")
+        if error is not None:
+            debug(f"Reading capacity of site {name} failed...\n{error}")
+
+    def _submit(self, site):
+        with self._lock:
+            future, _ = self._inflight.get(site.name, (None, None))
+            started = future is None
+            if started:
+                future = self._executor.submit(self.read_site, site)
+                self._inflight[site.name] = (future, time.monotonic())
+        if started:
+            # Outside the lock: a read that has already finished runs the callback right here.
+            future.add_done_callback(lambda done, name=site.name: self._read_done(name, done))
+        return future
+
+    def refresh(self, names=None, deadline=None):
+        """Reads the named sites (all by default) in parallel; returns those that answered within ``deadline``."""
+        futures = {name: self._submit(self.sites[name]) for name in (names or self.sites)}
+        done, late = wait(futures.values(), timeout=deadline)
+        if late:
+            with self._lock:
+                self._stats["late"] += len(late)
+            inc("shmas_federation_reads_total", len(late), result="late")
+        return {name: future.result() for name, future in futures.items()
+                if future in done and future.exception() is None}
+
+    def snapshot(self, name):
+        with self._lock:
+            return self._snapshots.get(name)
+
+    def _unresponsive(self, name, now):
+        # Left to the background refresher: a site whose last read failed, or whose read in flight is
+        # already older than a routing deadline, wouldn't answer in time for this one either.
+        with self._lock:
+            failed_at = self._failed_at.get(name)
+            _, started = self._inflight.get(name, (None, None))
+        return ((failed_at is not None and now - failed_at < self.refresh_interval)
+                or (started is not None and now - started > self.deadline))
+
+    def _cached(self, name, now):
+        capacity = self.snapshot(name)
+        if capacity is None or now - capacity.taken_at > self.max_staleness:
+            return None
+        return capacity
+
+    def route(self, department, room_types, priority_score, block_seconds, exclude=()):
+        """The site with the shortest projected wait for this patient, or None if no site could take them.
+
+        ``exclude`` drops sites from consideration, such as this hospital when
+        it has just diverted the patient.
+        """
+        with span("federation", "route") as fields:
+            now = time.monotonic()
+            ranked, unknown = [], []
+            for name in self.sites:
+                if name in exclude:
+                    continue
+                capacity = self._cached(name, now)
+                if capacity is None:
+                    unknown.append(name)
+                    continue
+                wait_seconds = projected_wait(capacity, department, room_types, priority_score, block_seconds, now)
+                if wait_seconds is not None:
+                    ranked.append((wait_seconds, name))
+            # The best sites by the cached numbers are re-read; a site nothing is known about
+            # only gets a slot that's left over.
+            ranked.sort()
+            candidates = ([name for _, name in ranked] + unknown)[:self.candidates]
+            reading = [name for name in candidates if not self._unresponsive(name, now)]
+            fresh = self.refresh(reading, self.deadline) if reading else {}
+            now = time.monotonic()
+            best = None
+            for name in candidates:
+                capacity = fresh.get(name) or self._cached(name, now)
+                if capacity is None:
+                    continue
+                wait_seconds = projected_wait(capacity, department, room_types, priority_score, block_seconds, now)
+                if wait_seconds is not None and (best is None or wait_seconds < best[0]):
+                    best = (wait_seconds, name, "live" if name in fresh else "cached")
+            fields.update(candidates=len(candidates), read=len(reading), answered=len(fresh))
+        with self._lock:
+            self._stats["routes"] += 1
+            self._stats["unroutable" if best is None else "referrals"] += 1
+        if best is None:
+            return None
+        wait_seconds, name, source = best
+        return Referral(name, wait_seconds, self.sites[name].travel_minutes, source, len(candidates))
+
+    def run(self):
+        debug(f"Federation refresher started for {len(self.sites)} sites...")
+        while not self._stop.is_set():
+            try:
+                self.refresh(deadline=self.statement_timeout)
+            except Exception as e:
+                with self._lock:
+                    self._stats["errors"] += 1
+                debug(f"Federation refresh failed...\n{e}")
+            self._stop.wait(self.refresh_interval)
+        debug("Federation refresher stopped...")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name="shmas-federation-refresh", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._inflight)
+            ages = {name: now - capacity.taken_at for name, capacity in self._snapshots.items()}
+        stats["sites"] = len(self.sites)
+        stats["snapshot_age"] = {name: round(ages[name], 3) if name in ages else None for name in self.sites}
+        return stats
+
+_router = None
+_router_started = False
+_router_lock = threading.Lock()
+
+def get_federation_router():
+    """The process-wide router, refreshing in the background; None when no federation is configured."""
+    global _router, _router_started
+    if not _router_started:
+        with _router_lock:
+            if not _router_started:
+                sites = federation_sites()
+                if sites:
+                    _router = FederationRouter(sites).start()
+                _router_started = True
+    return _router
+
+def stop_federation_router():
+    global _router, _router_started
+    with _router_lock:
+        if _router is not None:
+            _router.stop()
+        _router, _router_started = None, False
+
+def main():
+    parser = argparse.ArgumentParser(description="Show each federated site's capacity and route one patient.")
+    parser.add_argument("--sites", help="JSON site list (default: SHMAS_FEDERATION_SITES)")
+    parser.add_argument("--department", default="Cardiology")
+    parser.add_argument("--bed", action="append", help="acceptable bed type, best first (repeatable)")
+    parser.add_argument("--priority-score", type=float, default=0.0)
+    parser.add_argument("--block-minutes", type=float, default=30.0)
+    args = parser.parse_args()
+    configure_logging()
+
+    router = FederationRouter(federation_sites(args.sites))
+    try:
+        router.refresh(deadline=router.statement_timeout)
+        room_types = args.bed or ["Emergency"]
+        sites = {}
+        for name in router.sites:
+            capacity = router.snapshot(name)
+            wait_seconds = capacity and projected_wait(capacity, args.department, room_types, args.priority_score,
+                                                       args.block_minutes * 60)
+            sites[name] = None if capacity is None else {
+                "doctors": {dept: value[:2] for dept, value in capacity.doctors.items()},
+                "rooms": {room_type: value[:2] for room_type, value in capacity.rooms.items()},
+                "queued": sum(value[1] for value in capacity.queue_departments.values()),
+                "projected_wait": wait_seconds,
+            }
+        referral = router.route(args.department, room_types, args.priority_score, args.block_minutes * 60,
+                                exclude=[router.local] if router.local else ())
+        print(json.dumps({"sites": sites, "referral": referral._asdict() if referral else None,
+                          "stats": router.stats()}, indent=2, default=str))
+    finally:
+        router.stop()
+
+if __name__ == "__main__":
+    main()
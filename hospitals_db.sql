@@ -1,102 +1,680 @@
-CREATE TYPE room_type AS ENUM ('Emergency', 'ICU', 'Ward', 'Normal');
-CREATE TYPE comm_type AS ENUM ('Phone','Email');
-
-DROP TABLE IF EXISTS patient_info;
-CREATE TABLE patient_info (
-    patient_id BIGSERIAL PRIMARY KEY,
-    patient_name VARCHAR(100) NOT NULL,
-    email VARCHAR(100) UNIQUE NOT NULL,
-    phone VARCHAR(20),
-	prefered_communication comm_type DEFAULT 'Email',
-    gender VARCHAR(10),
-	symptoms TEXT,
-	symptoms_duration VARCHAR(20),
-	treatment TEXT DEFAULT NULL,
-    vitals JSONB,
-	treatment_completed BOOLEAN DEFAULT FALSE,
-	treatment_completion_time TIMESTAMP,
-	visit_datetime TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
-
-DROP TABLE IF EXISTS rooms;
-CREATE TABLE rooms (
-    room_number INT PRIMARY KEY,
-    type room_type NOT NULL,
-    is_occupied BOOLEAN DEFAULT FALSE
-);
-
-DROP TABLE IF EXISTS doctors;
-CREATE TABLE doctors (
-    doctor_id SERIAL PRIMARY KEY,
-    name VARCHAR(100) NOT NULL,
-    specialist VARCHAR(100),
-	is_busy BOOLEAN DEFAULT FALSE,
-    busy_from TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    busy_till TIMESTAMP
-);
-
-DROP TABLE IF EXISTS ongoing_cases;
-CREATE TABLE ongoing_cases (
-    patient_id INT REFERENCES patient_info(patient_id),
-	doctor_id INT REFERENCES doctors(doctor_id),
-    room_number INT REFERENCES rooms(room_number)
-);
-
-DROP TABLE IF EXISTS queue;
-CREATE TABLE queue (
-	patient_id INT REFERENCES patient_info(patient_id),
-	priority_score NUMERIC,
-	type_of_room room_type 
-);
-
-CREATE OR REPLACE FUNCTION release_room_and_doctor_status()
-RETURNS TRIGGER AS
-	$$
-	BEGIN
-		UPDATE rooms SET is_occupied = FALSE WHERE room_number = OLD.room_number;
-		UPDATE doctors SET is_busy = FALSE WHERE doctor_id = OLD.doctor_id;
-		RETURN OLD;
-	END;
-	$$ LANGUAGE plpgsql;
-
-CREATE OR REPLACE TRIGGER release_case_trigger
-	BEFORE DELETE ON ongoing_cases
-	FOR EACH ROW
-	EXECUTE FUNCTION release_room_and_doctor_status();
-
-CREATE OR REPLACE FUNCTION refresh_data()
-RETURNS void AS
-	$$
-	BEGIN
-		UPDATE doctors SET is_busy = FALSE,busy_till=NULL,busy_from=NULL WHERE busy_till < CURRENT_TIMESTAMP;
-		
-		UPDATE ongoing_cases SET doctor_id = NULL
-		WHERE doctor_id IN (
-			SELECT doctor_id FROM doctors WHERE is_busy=FALSE
-		);
-		
-		UPDATE rooms SET is_occupied = FALSE
-		WHERE room_number IN (
-			SELECT room_number FROM rooms
-			EXCEPT
-			SELECT DISTINCT room_number FROM ongoing_cases
-		);
-	END;
-	$$ LANGUAGE plpgsql;
-
-CREATE OR REPLACE FUNCTION get_available_doctors(spclty VARCHAR)
-	RETURNS SETOF doctors AS
-	$$
-	BEGIN
-		-- SELECT refresh_data();
-		RETURN QUERY SELECT * FROM doctors WHERE specialist = spclty AND is_busy = FALSE;
-	END;
-	$$ LANGUAGE plpgsql;
-
-CREATE OR REPLACE FUNCTION get_available_rooms(ctgry room_type)
-	RETURNS SETOF rooms AS
-	$$
-	BEGIN
-		RETURN QUERY SELECT * FROM rooms WHERE rooms.type = ctgry AND is_occupied = FALSE;
-	END;
-	$$ LANGUAGE plpgsql;
\ No newline at end of file
+CREATE TYPE room_type AS ENUM ('Emergency', 'ICU', 'Ward', 'Normal');
+CREATE TYPE comm_type AS ENUM ('Phone','Email');
+
+DROP TABLE IF EXISTS patient_info;
+CREATE TABLE patient_info (
+    patient_id BIGSERIAL PRIMARY KEY,
+    patient_name VARCHAR(100) NOT NULL,
+    email VARCHAR(100) UNIQUE NOT NULL,
+    phone VARCHAR(20),
+	prefered_communication comm_type DEFAULT 'Email',
+    gender VARCHAR(10),
+	symptoms TEXT,
+	symptoms_duration VARCHAR(20),
+	treatment TEXT DEFAULT NULL,
+    vitals JSONB,
+	treatment_completed BOOLEAN DEFAULT FALSE,
+	treatment_completion_time TIMESTAMP,
+	visit_datetime TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+DROP TABLE IF EXISTS rooms;
+CREATE TABLE rooms (
+    room_number INT PRIMARY KEY,
+    type room_type NOT NULL,
+    is_occupied BOOLEAN DEFAULT FALSE
+);
+
+DROP TABLE IF EXISTS doctors;
+CREATE TABLE doctors (
+    doctor_id SERIAL PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    specialist VARCHAR(100),
+	is_busy BOOLEAN DEFAULT FALSE,
+    busy_from TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    busy_till TIMESTAMP
+);
+
+DROP TABLE IF EXISTS ongoing_cases;
+CREATE TABLE ongoing_cases (
+    patient_id INT REFERENCES patient_info(patient_id),
+	doctor_id INT REFERENCES doctors(doctor_id),
+    room_number INT REFERENCES rooms(room_number)
+);
+
+DROP TABLE IF EXISTS queue;
+CREATE TABLE queue (
+	patient_id INT REFERENCES patient_info(patient_id),
+	priority_score NUMERIC,
+	type_of_room room_type,
+	department VARCHAR(100),
+	bed_priority room_type[],
+	block_duration INTERVAL,
+	queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+	-- calculate_priority() inputs that patient_info doesn't keep, for re-scoring while waiting
+	triage_level SMALLINT,
+	age SMALLINT,
+	symptom_hours DOUBLE PRECISION
+);
+
+DROP TABLE IF EXISTS resource_counters;
+CREATE TABLE resource_counters (
+	kind VARCHAR(10) NOT NULL,
+	category VARCHAR(100) NOT NULL,
+	available INT NOT NULL DEFAULT 0,
+	occupied INT NOT NULL DEFAULT 0,
+	PRIMARY KEY (kind, category)
+);
+
+-- Append-only audit trail of agent events, written in batches by journal.py.
+-- mono_ns is the writing process's monotonic clock, which orders events
+-- within a process; logged_at is the same instant on the wall clock.
+DROP TABLE IF EXISTS agent_events;
+CREATE TABLE agent_events (
+	event_id BIGSERIAL PRIMARY KEY,
+	logged_at TIMESTAMPTZ NOT NULL,
+	mono_ns BIGINT NOT NULL,
+	patient_id BIGINT,
+	agent VARCHAR(40) NOT NULL,
+	outcome VARCHAR(20),
+	kind VARCHAR(40) NOT NULL,
+	payload JSONB
+);
+
+-- Speculative holds (speculation.py): a doctor or bed claimed for a patient
+-- whose triage is still running. The resource is marked busy like any other
+-- claim; the hold row records whose it is and until when.
+DROP TABLE IF EXISTS resource_holds;
+CREATE TABLE resource_holds (
+	kind VARCHAR(10) NOT NULL,
+	resource_id INT NOT NULL,
+	patient_id BIGINT NOT NULL,
+	expires_at TIMESTAMP NOT NULL,
+	PRIMARY KEY (kind, resource_id)
+);
+
+-- Hot-path indexes (see migrations/001_hot_path_indexes.sql for existing databases)
+CREATE INDEX doctors_free_specialist_idx ON doctors (specialist) WHERE is_busy = FALSE;
+CREATE INDEX doctors_busy_till_idx ON doctors (busy_till) WHERE is_busy = TRUE;
+CREATE INDEX rooms_free_type_idx ON rooms (type) WHERE is_occupied = FALSE;
+CREATE INDEX rooms_type_occupied_idx ON rooms (type, is_occupied);
+CREATE INDEX ongoing_cases_doctor_idx ON ongoing_cases (doctor_id);
+CREATE INDEX ongoing_cases_room_idx ON ongoing_cases (room_number);
+CREATE INDEX ongoing_cases_patient_idx ON ongoing_cases (patient_id);
+CREATE INDEX queue_room_priority_idx ON queue (type_of_room, priority_score DESC);
+CREATE INDEX queue_patient_idx ON queue (patient_id);
+
+-- Rows arrive in time order, so a BRIN index covers time-range scans at a
+-- fraction of a btree's size and insert cost.
+CREATE INDEX agent_events_patient_idx ON agent_events (patient_id, logged_at);
+CREATE INDEX agent_events_logged_at_idx ON agent_events USING BRIN (logged_at);
+
+CREATE INDEX resource_holds_patient_idx ON resource_holds (patient_id);
+CREATE INDEX resource_holds_expires_idx ON resource_holds (expires_at);
+
+CREATE OR REPLACE FUNCTION release_room_and_doctor_status()
+RETURNS TRIGGER AS
+	$$
+	BEGIN
+		-- Doctor before room, the same order allocate_case locks them (and their counters) in.
+		UPDATE doctors SET is_busy = FALSE WHERE doctor_id = OLD.doctor_id;
+		UPDATE rooms SET is_occupied = FALSE WHERE room_number = OLD.room_number;
+		RETURN OLD;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER release_case_trigger
+	BEFORE DELETE ON ongoing_cases
+	FOR EACH ROW
+	EXECUTE FUNCTION release_room_and_doctor_status();
+
+CREATE OR REPLACE FUNCTION refresh_data()
+RETURNS void AS
+	$$
+	BEGIN
+		UPDATE doctors SET is_busy = FALSE,busy_till=NULL,busy_from=NULL WHERE busy_till < CURRENT_TIMESTAMP;
+		
+		UPDATE ongoing_cases SET doctor_id = NULL
+		WHERE doctor_id IN (
+			SELECT doctor_id FROM doctors WHERE is_busy=FALSE
+		);
+		
+		UPDATE rooms SET is_occupied = FALSE
+		WHERE room_number IN (
+			SELECT room_number FROM rooms
+			EXCEPT
+			SELECT DISTINCT room_number FROM ongoing_cases
+		);
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION get_available_doctors(spclty VARCHAR)
+	RETURNS SETOF doctors AS
+	$$
+	BEGIN
+		-- SELECT refresh_data();
+		RETURN QUERY SELECT * FROM doctors WHERE specialist = spclty AND is_busy = FALSE;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION get_available_rooms(ctgry room_type)
+	RETURNS SETOF rooms AS
+	$$
+	BEGIN
+		RETURN QUERY SELECT * FROM rooms WHERE rooms.type = ctgry AND is_occupied = FALSE;
+	END;
+	$$ LANGUAGE plpgsql;
+-- Atomic allocation. Each claim locks and takes one free row in a single
+-- statement; SKIP LOCKED lets concurrent admissions pass over rows another
+-- transaction is claiming instead of waiting on (or double-booking) them.
+CREATE OR REPLACE FUNCTION claim_doctor(spclty VARCHAR, block_duration INTERVAL)
+	RETURNS SETOF doctors AS
+	$$
+	BEGIN
+		RETURN QUERY
+		UPDATE doctors d SET is_busy = TRUE,
+							 busy_from = CURRENT_TIMESTAMP,
+							 busy_till = CURRENT_TIMESTAMP + block_duration
+		WHERE d.doctor_id = (
+			SELECT doctor_id FROM doctors
+			WHERE specialist = spclty AND is_busy = FALSE
+			LIMIT 1
+			FOR UPDATE SKIP LOCKED
+		)
+		RETURNING d.*;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION claim_room(bed_priority room_type[])
+	RETURNS SETOF rooms AS
+	$$
+	DECLARE
+		bed room_type;
+	BEGIN
+		FOREACH bed IN ARRAY bed_priority LOOP
+			RETURN QUERY
+			UPDATE rooms r SET is_occupied = TRUE
+			WHERE r.room_number = (
+				SELECT room_number FROM rooms
+				WHERE rooms.type = bed AND is_occupied = FALSE
+				LIMIT 1
+				FOR UPDATE SKIP LOCKED
+			)
+			RETURNING r.*;
+			IF FOUND THEN
+				RETURN;
+			END IF;
+		END LOOP;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Turns the outcome of the two claims into a case or a queue entry, handing
+-- back whichever half was claimed if the other half failed.
+CREATE OR REPLACE FUNCTION resolve_case(p_patient_id BIGINT, p_doctor_id INT, p_room_number INT,
+										p_room_type room_type, p_priority NUMERIC, p_department VARCHAR DEFAULT NULL,
+										p_bed_priority room_type[] DEFAULT NULL, p_block_duration INTERVAL DEFAULT NULL,
+										p_triage_level SMALLINT DEFAULT NULL, p_age SMALLINT DEFAULT NULL,
+										p_symptom_hours DOUBLE PRECISION DEFAULT NULL)
+	RETURNS TEXT AS
+	$$
+	BEGIN
+		PERFORM settle_holds(p_patient_id, p_doctor_id, p_room_number, p_block_duration);
+		IF p_doctor_id IS NOT NULL AND p_room_number IS NOT NULL THEN
+			INSERT INTO ongoing_cases(patient_id, doctor_id, room_number)
+			VALUES (p_patient_id, p_doctor_id, p_room_number);
+			RETURN 'Admitted';
+		ELSIF p_doctor_id IS NULL AND p_room_number IS NULL THEN
+			RETURN 'Diverted';
+		END IF;
+
+		IF p_room_number IS NOT NULL THEN
+			UPDATE rooms SET is_occupied = FALSE WHERE room_number = p_room_number;
+		ELSE
+			UPDATE doctors SET is_busy = FALSE, busy_from = NULL, busy_till = NULL WHERE doctor_id = p_doctor_id;
+		END IF;
+		-- Enough is kept with the entry for the dispatcher to admit it later (admit_from_queue).
+		INSERT INTO queue(patient_id, priority_score, type_of_room, department, bed_priority, block_duration,
+						  triage_level, age, symptom_hours)
+		VALUES (p_patient_id, p_priority, p_room_type, p_department,
+				COALESCE(p_bed_priority, ARRAY[p_room_type]), p_block_duration,
+				p_triage_level, p_age, p_symptom_hours);
+		RETURN 'Queued';
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION allocate_case(p_patient_id BIGINT, p_dept VARCHAR, p_bed_priority room_type[],
+										 p_duration INTERVAL, p_priority NUMERIC, p_triage_level SMALLINT DEFAULT NULL,
+										 p_age SMALLINT DEFAULT NULL, p_symptom_hours DOUBLE PRECISION DEFAULT NULL)
+	RETURNS TABLE(outcome TEXT, doctor_id INT, doctor_name VARCHAR, room_number INT, room_kind room_type,
+				  busy_from TIMESTAMP, busy_till TIMESTAMP) AS
+	$$
+	DECLARE
+		doc doctors%ROWTYPE;
+		room rooms%ROWTYPE;
+		held_doctor BOOLEAN;
+	BEGIN
+		-- A speculative hold is used when it is what this admission wants; the
+		-- hold row is locked so expire_holds() can't release it meanwhile.
+		SELECT d.* INTO doc FROM resource_holds h JOIN doctors d ON d.doctor_id = h.resource_id
+		WHERE h.patient_id = p_patient_id AND h.kind = 'doctor' AND d.specialist = p_dept
+		FOR UPDATE OF h;
+		held_doctor := FOUND;
+		IF NOT held_doctor THEN
+			SELECT * INTO doc FROM claim_doctor(p_dept, p_duration);
+		END IF;
+		SELECT r.* INTO room FROM resource_holds h JOIN rooms r ON r.room_number = h.resource_id
+		WHERE h.patient_id = p_patient_id AND h.kind = 'room' AND r.type = p_bed_priority[1]
+		FOR UPDATE OF h;
+		IF NOT FOUND THEN
+			SELECT * INTO room FROM claim_room(p_bed_priority);
+		END IF;
+		outcome := resolve_case(p_patient_id, doc.doctor_id, room.room_number,
+								COALESCE(room.type, p_bed_priority[1]), p_priority,
+								p_dept, p_bed_priority, p_duration, p_triage_level, p_age, p_symptom_hours);
+		IF held_doctor THEN
+			-- resolve_case() started the held doctor's block just now.
+			SELECT * INTO doc FROM doctors d WHERE d.doctor_id = doc.doctor_id;
+		END IF;
+		-- On 'Queued' the claimed half has already been released again; it is
+		-- still reported so callers can tell which resource was missing.
+		doctor_name := doc.name;
+		doctor_id := doc.doctor_id;
+		room_number := room.room_number;
+		room_kind := room.type;
+		busy_from := doc.busy_from;
+		busy_till := doc.busy_till;
+		RETURN NEXT;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Availability counters per room type ('room') and per specialty ('doctor'),
+-- so census reads touch a handful of rows however large the hospital is.
+-- ongoing_cases changes reach the counters through release_case_trigger,
+-- which flips the room/doctor rows that the triggers below count.
+CREATE OR REPLACE FUNCTION bump_resource_counter(p_kind VARCHAR, p_category VARCHAR, p_in_use BOOLEAN, p_delta INT)
+	RETURNS void AS
+	$$
+	BEGIN
+		IF p_category IS NULL THEN
+			RETURN;
+		END IF;
+		INSERT INTO resource_counters AS rc (kind, category, available, occupied)
+		VALUES (p_kind, p_category,
+				CASE WHEN COALESCE(p_in_use, FALSE) THEN 0 ELSE p_delta END,
+				CASE WHEN COALESCE(p_in_use, FALSE) THEN p_delta ELSE 0 END)
+		ON CONFLICT (kind, category) DO UPDATE
+			SET available = rc.available + EXCLUDED.available,
+				occupied = rc.occupied + EXCLUDED.occupied;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_room_change()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		IF TG_OP IN ('UPDATE', 'DELETE') THEN
+			PERFORM bump_resource_counter('room', OLD.type::VARCHAR, OLD.is_occupied, -1);
+		END IF;
+		IF TG_OP IN ('UPDATE', 'INSERT') THEN
+			PERFORM bump_resource_counter('room', NEW.type::VARCHAR, NEW.is_occupied, 1);
+		END IF;
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_doctor_change()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		IF TG_OP IN ('UPDATE', 'DELETE') THEN
+			PERFORM bump_resource_counter('doctor', OLD.specialist, OLD.is_busy, -1);
+		END IF;
+		IF TG_OP IN ('UPDATE', 'INSERT') THEN
+			PERFORM bump_resource_counter('doctor', NEW.specialist, NEW.is_busy, 1);
+		END IF;
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER rooms_counter_trigger
+	AFTER INSERT OR DELETE ON rooms
+	FOR EACH ROW
+	EXECUTE FUNCTION count_room_change();
+
+CREATE OR REPLACE TRIGGER rooms_counter_update_trigger
+	AFTER UPDATE OF type, is_occupied ON rooms
+	FOR EACH ROW
+	WHEN (OLD.type IS DISTINCT FROM NEW.type OR OLD.is_occupied IS DISTINCT FROM NEW.is_occupied)
+	EXECUTE FUNCTION count_room_change();
+
+CREATE OR REPLACE TRIGGER doctors_counter_trigger
+	AFTER INSERT OR DELETE ON doctors
+	FOR EACH ROW
+	EXECUTE FUNCTION count_doctor_change();
+
+CREATE OR REPLACE TRIGGER doctors_counter_update_trigger
+	AFTER UPDATE OF specialist, is_busy ON doctors
+	FOR EACH ROW
+	WHEN (OLD.specialist IS DISTINCT FROM NEW.specialist OR OLD.is_busy IS DISTINCT FROM NEW.is_busy)
+	EXECUTE FUNCTION count_doctor_change();
+
+-- Consistency check: recounts rooms and doctors from scratch, returns every
+-- counter that had drifted (stored vs counted) and rewrites the table.
+CREATE OR REPLACE FUNCTION rebuild_resource_counters()
+	RETURNS TABLE(kind VARCHAR, category VARCHAR, stored_available INT, stored_occupied INT,
+				  counted_available INT, counted_occupied INT) AS
+	$$
+	#variable_conflict use_column
+	BEGIN
+		-- Writers wait for the few milliseconds the recount takes, so nothing slips between count and swap.
+		LOCK TABLE rooms, doctors IN SHARE MODE;
+		LOCK TABLE resource_counters IN EXCLUSIVE MODE;
+		CREATE TEMP TABLE counted AS
+			SELECT 'room'::VARCHAR kind, r.type::VARCHAR category,
+				   (COUNT(*) FILTER (WHERE NOT COALESCE(r.is_occupied, FALSE)))::INT available,
+				   (COUNT(*) FILTER (WHERE r.is_occupied))::INT occupied
+			FROM rooms r GROUP BY r.type
+			UNION ALL
+			SELECT 'doctor', d.specialist,
+				   (COUNT(*) FILTER (WHERE NOT COALESCE(d.is_busy, FALSE)))::INT,
+				   (COUNT(*) FILTER (WHERE d.is_busy))::INT
+			FROM doctors d WHERE d.specialist IS NOT NULL GROUP BY d.specialist;
+
+		RETURN QUERY
+		SELECT COALESCE(c.kind, rc.kind), COALESCE(c.category, rc.category),
+			   rc.available, rc.occupied, c.available, c.occupied
+		FROM counted c
+		FULL JOIN resource_counters rc ON rc.kind = c.kind AND rc.category = c.category
+		WHERE COALESCE(rc.available, 0) <> COALESCE(c.available, 0)
+		   OR COALESCE(rc.occupied, 0) <> COALESCE(c.occupied, 0);
+
+		DELETE FROM resource_counters;
+		INSERT INTO resource_counters SELECT * FROM counted;
+		DROP TABLE counted;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Targeted expiry, run by the background worker in expiry.py when a busy_till
+-- deadline passes (refresh_data() is the old full-table sweep). Releases only
+-- the doctors whose block has ended and detaches them from their cases.
+CREATE OR REPLACE FUNCTION expire_doctors()
+	RETURNS SETOF INT AS
+	$$
+	BEGIN
+		RETURN QUERY
+		WITH released AS (
+			UPDATE doctors SET is_busy = FALSE, busy_till = NULL, busy_from = NULL
+			WHERE is_busy = TRUE AND busy_till <= CURRENT_TIMESTAMP
+			RETURNING doctors.doctor_id
+		), detached AS (
+			UPDATE ongoing_cases oc SET doctor_id = NULL
+			FROM released r WHERE oc.doctor_id = r.doctor_id
+		)
+		SELECT released.doctor_id FROM released;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Frees occupied rooms that no ongoing case or hold refers to, but only among
+-- the candidates passed in; the worker passes rooms it already saw orphaned on
+-- its previous sweep so a bed claimed by an in-flight admission is left alone.
+CREATE OR REPLACE FUNCTION release_orphaned_rooms(p_candidates INT[])
+	RETURNS SETOF INT AS
+	$$
+	BEGIN
+		RETURN QUERY
+		UPDATE rooms r SET is_occupied = FALSE
+		WHERE r.room_number = ANY(p_candidates) AND r.is_occupied = TRUE
+		  AND NOT EXISTS (SELECT 1 FROM ongoing_cases oc WHERE oc.room_number = r.room_number)
+		  AND NOT EXISTS (SELECT 1 FROM resource_holds h WHERE h.kind = 'room' AND h.resource_id = r.room_number)
+		RETURNING r.room_number;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Release and queue events for the dispatcher (dispatcher.py), delivered on
+-- commit. A release is any doctor/room going from in use to free, whether by
+-- release_case_trigger, expire_doctors() or resolve_case() handing back a claim.
+CREATE OR REPLACE FUNCTION notify_doctor_release()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		PERFORM pg_notify('shmas_release', json_build_object(
+			'kind', 'doctor', 'id', NEW.doctor_id, 'category', NEW.specialist)::TEXT);
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_room_release()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		PERFORM pg_notify('shmas_release', json_build_object(
+			'kind', 'room', 'id', NEW.room_number, 'category', NEW.type)::TEXT);
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_queue_change()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		PERFORM pg_notify('shmas_queue', json_build_object(
+			'op', TG_OP, 'row', row_to_json(CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END))::TEXT);
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER doctors_release_notify_trigger
+	AFTER UPDATE OF is_busy ON doctors
+	FOR EACH ROW
+	WHEN (OLD.is_busy IS TRUE AND NEW.is_busy IS NOT TRUE)
+	EXECUTE FUNCTION notify_doctor_release();
+
+CREATE OR REPLACE TRIGGER rooms_release_notify_trigger
+	AFTER UPDATE OF is_occupied ON rooms
+	FOR EACH ROW
+	WHEN (OLD.is_occupied IS TRUE AND NEW.is_occupied IS NOT TRUE)
+	EXECUTE FUNCTION notify_room_release();
+
+CREATE OR REPLACE TRIGGER queue_notify_trigger
+	AFTER INSERT OR DELETE ON queue
+	FOR EACH ROW
+	EXECUTE FUNCTION notify_queue_change();
+
+-- Admits one queued patient if a doctor and a bed can both be claimed right
+-- now. A partial claim is undone by rolling back to the block's savepoint, so
+-- it neither fires release events nor moves the counters.
+CREATE OR REPLACE FUNCTION admit_from_queue(p_patient_id BIGINT)
+	RETURNS TABLE(outcome TEXT, doctor_id INT, room_number INT, waited DOUBLE PRECISION) AS
+	$$
+	DECLARE
+		q queue%ROWTYPE;
+		doc doctors%ROWTYPE;
+		room rooms%ROWTYPE;
+	BEGIN
+		SELECT * INTO q FROM queue WHERE queue.patient_id = p_patient_id LIMIT 1 FOR UPDATE SKIP LOCKED;
+		IF NOT FOUND THEN
+			outcome := 'Gone';
+			RETURN NEXT;
+			RETURN;
+		END IF;
+		BEGIN
+			SELECT * INTO doc FROM claim_doctor(q.department, COALESCE(q.block_duration, INTERVAL '1 minute'));
+			SELECT * INTO room FROM claim_room(q.bed_priority);
+			IF doc.doctor_id IS NULL OR room.room_number IS NULL THEN
+				RAISE EXCEPTION 'partial claim';
+			END IF;
+		EXCEPTION WHEN raise_exception THEN
+			outcome := 'Waiting';
+			RETURN NEXT;
+			RETURN;
+		END;
+		INSERT INTO ongoing_cases(patient_id, doctor_id, room_number)
+		VALUES (p_patient_id, doc.doctor_id, room.room_number);
+		DELETE FROM queue WHERE queue.patient_id = p_patient_id;
+		outcome := 'Admitted';
+		doctor_id := doc.doctor_id;
+		room_number := room.room_number;
+		waited := EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - q.queued_at);
+		RETURN NEXT;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Row-level change feed for the dashboard's live view (live_status.py). One
+-- listener per server process applies these as diffs, so open dashboards
+-- cost no queries of their own.
+CREATE OR REPLACE FUNCTION notify_dashboard_change()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		PERFORM pg_notify('shmas_dashboard', json_build_object(
+			'table', TG_TABLE_NAME, 'op', TG_OP,
+			'old', CASE WHEN TG_OP <> 'INSERT' THEN row_to_json(OLD) END,
+			'new', CASE WHEN TG_OP <> 'DELETE' THEN row_to_json(NEW) END)::TEXT);
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Cases also carry the patient's name, which the doctor cards show.
+CREATE OR REPLACE FUNCTION notify_dashboard_case_change()
+	RETURNS TRIGGER AS
+	$$
+	DECLARE
+		name VARCHAR;
+	BEGIN
+		IF TG_OP <> 'DELETE' THEN
+			SELECT patient_name INTO name FROM patient_info WHERE patient_id = NEW.patient_id;
+		END IF;
+		PERFORM pg_notify('shmas_dashboard', json_build_object(
+			'table', TG_TABLE_NAME, 'op', TG_OP,
+			'old', CASE WHEN TG_OP <> 'INSERT' THEN row_to_json(OLD) END,
+			'new', CASE WHEN TG_OP <> 'DELETE' THEN row_to_json(NEW) END,
+			'patient_name', name)::TEXT);
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER doctors_dashboard_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON doctors
+	FOR EACH ROW
+	EXECUTE FUNCTION notify_dashboard_change();
+
+CREATE OR REPLACE TRIGGER rooms_dashboard_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON rooms
+	FOR EACH ROW
+	EXECUTE FUNCTION notify_dashboard_change();
+
+-- Score-only updates come from rescore_queue() in bulk and are announced once, not per row.
+CREATE OR REPLACE TRIGGER queue_dashboard_trigger
+	AFTER INSERT OR DELETE OR UPDATE OF patient_id, type_of_room, department, bed_priority ON queue
+	FOR EACH ROW
+	EXECUTE FUNCTION notify_dashboard_change();
+
+CREATE OR REPLACE TRIGGER ongoing_cases_dashboard_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON ongoing_cases
+	FOR EACH ROW
+	EXECUTE FUNCTION notify_dashboard_case_change();
+
+-- Writes back the scores rescoring.py computed for the whole queue in one
+-- statement, touching only rows whose score moved, then tells the dispatcher
+-- and the dashboard once that the order changed.
+CREATE OR REPLACE FUNCTION rescore_queue(p_patient_ids BIGINT[], p_scores NUMERIC[])
+	RETURNS INT AS
+	$$
+	DECLARE
+		changed INT;
+	BEGIN
+		UPDATE queue q SET priority_score = s.score
+		FROM unnest(p_patient_ids, p_scores) AS s(patient_id, score)
+		WHERE q.patient_id = s.patient_id AND q.priority_score IS DISTINCT FROM s.score;
+		GET DIAGNOSTICS changed = ROW_COUNT;
+		IF changed > 0 THEN
+			PERFORM pg_notify('shmas_queue', json_build_object('op', 'RERANK', 'changed', changed)::TEXT);
+			PERFORM pg_notify('shmas_dashboard', json_build_object('table', 'queue', 'op', 'RERANK')::TEXT);
+		END IF;
+		RETURN changed;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Speculative holds. hold_resources() claims a doctor and a bed of the
+-- preferred type the way an admission would, but only for p_ttl; the held
+-- doctor's busy_till is the hold's expiry, so the expiry worker wakes for it
+-- and expire_holds() hands back whatever wasn't settled in time.
+-- settle_holds() runs inside resolve_case(): the held resources the case uses
+-- are kept (the doctor's block starting now), the others are released.
+CREATE OR REPLACE FUNCTION hold_resources(p_patient_id BIGINT, p_dept VARCHAR, p_room_type room_type, p_ttl INTERVAL)
+	RETURNS TABLE(doctor_id INT, doctor_name VARCHAR, specialist VARCHAR, busy_from TIMESTAMP,
+				  room_number INT, room_kind room_type) AS
+	$$
+	DECLARE
+		doc doctors%ROWTYPE;
+		room rooms%ROWTYPE;
+	BEGIN
+		IF p_dept IS NOT NULL THEN
+			SELECT * INTO doc FROM claim_doctor(p_dept, p_ttl);
+		END IF;
+		SELECT * INTO room FROM claim_room(ARRAY[p_room_type]);
+		INSERT INTO resource_holds(kind, resource_id, patient_id, expires_at)
+		SELECT h.kind, h.resource_id, p_patient_id, CURRENT_TIMESTAMP + p_ttl
+		FROM (VALUES ('doctor', doc.doctor_id), ('room', room.room_number)) AS h(kind, resource_id)
+		WHERE h.resource_id IS NOT NULL;
+		doctor_id := doc.doctor_id;
+		doctor_name := doc.name;
+		specialist := doc.specialist;
+		busy_from := doc.busy_from;
+		room_number := room.room_number;
+		room_kind := room.type;
+		RETURN NEXT;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION settle_holds(p_patient_id BIGINT, p_doctor_id INT DEFAULT NULL,
+										p_room_number INT DEFAULT NULL, p_block_duration INTERVAL DEFAULT NULL)
+	RETURNS INT AS
+	$$
+	DECLARE
+		held RECORD;
+		released INT := 0;
+	BEGIN
+		-- Doctor before room, the order everything else locks them in.
+		FOR held IN
+			WITH settled AS (
+				DELETE FROM resource_holds h WHERE h.patient_id = p_patient_id
+				RETURNING h.kind, h.resource_id
+			)
+			SELECT * FROM settled ORDER BY kind
+		LOOP
+			IF held.kind = 'doctor' AND held.resource_id = p_doctor_id THEN
+				UPDATE doctors SET busy_from = CURRENT_TIMESTAMP,
+								   busy_till = CURRENT_TIMESTAMP + COALESCE(p_block_duration, INTERVAL '1 minute')
+				WHERE doctors.doctor_id = held.resource_id;
+			ELSIF held.kind = 'doctor' THEN
+				UPDATE doctors SET is_busy = FALSE, busy_from = NULL, busy_till = NULL
+				WHERE doctors.doctor_id = held.resource_id;
+				released := released + 1;
+			ELSIF held.resource_id IS DISTINCT FROM p_room_number THEN
+				UPDATE rooms SET is_occupied = FALSE WHERE rooms.room_number = held.resource_id;
+				released := released + 1;
+			END IF;
+		END LOOP;
+		RETURN released;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION expire_holds()
+	RETURNS TABLE(kind VARCHAR, resource_id INT) AS
+	$$
+	BEGIN
+		RETURN QUERY
+		WITH expired AS (
+			DELETE FROM resource_holds h WHERE h.expires_at <= CURRENT_TIMESTAMP
+			RETURNING h.kind, h.resource_id
+		), doctors_released AS (
+			UPDATE doctors d SET is_busy = FALSE, busy_from = NULL, busy_till = NULL
+			FROM expired e WHERE e.kind = 'doctor' AND d.doctor_id = e.resource_id
+		), rooms_released AS (
+			UPDATE rooms r SET is_occupied = FALSE
+			FROM expired e WHERE e.kind = 'room' AND r.room_number = e.resource_id
+		)
+		SELECT e.kind, e.resource_id FROM expired e;
+	END;
+	$$ LANGUAGE plpgsql;
@@ -0,0 +1,255 @@
+"""Structured agent events, formatted only when shown and persisted in batches.
+
+Agents append ``Event`` tuples to ``state["logs"]``: a monotonic-clock
+timestamp, the agent, the patient id, the outcome, a message kind and the
+values the message needs. Nothing is formatted on the admission path; the
+dashboard calls ``render_event()`` when it draws the log.
+
+Every graph node hands its events to the journal writer, a background thread
+that writes them in batches to one of (SHMAS_JOURNAL):
+
+- ``postgres`` (default): one COPY into agent_events per batch, queryable by
+  patient or time range with ``query_events()``;
+- ``file:<path>``: one JSON object per line, appended to <path>;
+- ``off``: events stay in the admission's result only.
+"""
+import io, os, json, time, atexit, threading
+from collections import namedtuple
+from datetime import datetime, timezone
+from queue import SimpleQueue, Empty
+from logging import debug
+import pytz
+from db import db_cursor
+from metrics import span, inc
+
+EASTERN = pytz.timezone("US/Eastern")
+
+# The wall clock is read once; events only read time.monotonic_ns() and are
+# placed on the wall clock from this offset when rendered or written.
+_WALL_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+Event = namedtuple("Event", ["ns", "agent", "patient_id", "outcome", "kind", "payload"])
+
+MESSAGES = {
+    "mood": "Detected Mood is {mood} {emoji}",
+    "mood_error": "{error}",
+    "triage": "Level {triage_level} -> {department}",
+    "triage_error": "Error estimating the triage : {error}",
+    "doctor_assigned": "Assigned {doctor} to {patient}",
+    "no_doctor": "No {department} doctor available.",
+    "bed_assigned": "{patient} assigned to {bed_type} bed {bed} (triage {triage_level})",
+    "no_bed": "No beds available for {patient}",
+    "doctor_lost": "{doctor} was taken by another admission meanwhile.",
+    "bed_lost": "Bed {bed} was taken by another admission meanwhile.",
+    "priority": "Calculated priority score : {score}",
+    "admitting": "Assigning available doctor and bed to {patient}",
+    "no_doctor_queued": "No doctors available at this moment. Queuing the application.",
+    "no_bed_queued": "No beds available at this moment. Queuing the application.",
+    "diverted": "No beds and doctors available at this moment. Please try at nearby hospitals.",
+    "referred": "Referred to {site}, projected wait {wait_minutes} min",
+    "no_referral": "No nearby hospital can take {patient} at this moment.",
+}
+
+def event(agent, kind, patient_id=None, outcome=None, **payload):
+    return Event(time.monotonic_ns(), agent, patient_id, outcome, kind, payload)
+
+def wall_time(event):
+    # Only meaningful for events created in this process; stored events carry logged_at.
+    return datetime.fromtimestamp((event.ns + _WALL_OFFSET_NS) / 1e9, tz=timezone.utc)
+
+def describe(event):
+    template = MESSAGES.get(event.kind)
+    try:
+        message = template.format(**event.payload) if template else None
+    except (KeyError, IndexError):
+        message = None
+    return message or f"{event.kind} {json.dumps(event.payload, default=str)}"
+
+def render_event(event, at=None, tz=EASTERN):
+    """(time, "Agent : message") for display; ``at`` is the wall time, for events read back from storage."""
+    at = at or wall_time(event)
+    return at.astimezone(tz).strftime('%H:%M:%S.%f')[:-3], f"{event.agent} : {describe(event)}"
+
+JOURNAL_COLUMNS = ("logged_at", "mono_ns", "patient_id", "agent", "outcome", "kind", "payload")
+COPY_QUERY = f"COPY agent_events ({', '.join(JOURNAL_COLUMNS)}) FROM STDIN"
+
+def _copy_field(value):
+    # COPY text format: \N is NULL, and backslash, tab and newlines must be escaped.
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+class PostgresSink:
+    name = "postgres"
+
+    def write(self, events):
+        buffer = io.StringIO()
+        for e in events:
+            row = (wall_time(e).isoformat(), e.ns, e.patient_id, e.agent, e.outcome, e.kind,
+                   json.dumps(e.payload, ensure_ascii=False, default=str))
+            buffer.write("\t".join(map(_copy_field, row)))
+            buffer.write("\n")
+        buffer.seek(0)
+        with db_cursor() as cursor:
+            cursor.copy_expert(COPY_QUERY, buffer)
+
+    def close(self):
+        pass
+
+class FileSink:
+    name = "file"
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def write(self, events):
+        lines = [json.dumps({"logged_at": wall_time(e).isoformat(), "mono_ns": e.ns, "patient_id": e.patient_id,
+                             "agent": e.agent, "outcome": e.outcome, "kind": e.kind, "payload": e.payload},
+                            ensure_ascii=False, default=str) + "\n" for e in events]
+        self._file.writelines(lines)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def sink_from_env():
+    setting = os.getenv("SHMAS_JOURNAL", "postgres")
+    if setting == "off":
+        return None
+    if setting.startswith("file:"):
+        return FileSink(setting[len("file:"):])
+    return PostgresSink()
+
+class JournalWriter:
+    def __init__(self, sink, batch_size=None, flush_interval=None, max_pending=None):
+        self.sink = sink
+        self.batch_size = batch_size or int(os.getenv("SHMAS_JOURNAL_BATCH", "500"))
+        self.flush_interval = flush_interval or float(os.getenv("SHMAS_JOURNAL_FLUSH_INTERVAL", "1.0"))
+        # Past this many unwritten events (sink down or too slow) new ones are dropped, not buffered.
+        self.max_pending = max_pending or int(os.getenv("SHMAS_JOURNAL_MAX_PENDING", "100000"))
+        self._queue = SimpleQueue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"written": 0, "batches": 0, "dropped": 0, "errors": 0}
+
+    def record(self, events):
+        if not events:
+            return
+        with self._lock:
+            if self._pending + len(events) > self.max_pending:
+                self._stats["dropped"] += len(events)
+                return
+            self._pending += len(events)
+        self._queue.put(events)
+
+    def _flush(self, batch):
+        try:
+            with span("journal", self.sink.name) as fields:
+                fields["events"] = len(batch)
+                self.sink.write(batch)
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+                self._stats["dropped"] += len(batch)
+            debug(f"Journal write of {len(batch)} events failed...\n{e}")
+        else:
+            inc("shmas_journal_events_total", len(batch), sink=self.sink.name)
+            with self._lock:
+                self._stats["written"] += len(batch)
+                self._stats["batches"] += 1
+        finally:
+            with self._lock:
+                self._pending -= len(batch)
+
+    def run(self):
+        debug(f"Journal writer started ({self.sink.name})...")
+        batch = []
+        deadline = None
+        while True:
+            timeout = self.flush_interval if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                batch.extend(self._queue.get(timeout=timeout))
+                deadline = deadline or time.monotonic() + self.flush_interval
+            except Empty:
+                if self._stop.is_set():
+                    break
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline or self._stop.is_set()):
+                self._flush(batch)
+                batch, deadline = [], None
+        if batch:
+            self._flush(batch)
+        debug("Journal writer stopped...")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name="shmas-journal", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        # Whatever is still queued is written before the thread exits.
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.sink.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = self._pending
+        return stats
+
+_journal = None
+_journal_started = False
+_journal_lock = threading.Lock()
+
+def get_journal():
+    """The process-wide writer, started on first use; None when SHMAS_JOURNAL=off."""
+    global _journal, _journal_started
+    if not _journal_started:
+        with _journal_lock:
+            if not _journal_started:
+                sink = sink_from_env()
+                if sink is not None:
+                    _journal = JournalWriter(sink).start()
+                    atexit.register(_journal.stop, 5)
+                _journal_started = True
+    return _journal
+
+def stop_journal():
+    global _journal, _journal_started
+    with _journal_lock:
+        if _journal is not None:
+            atexit.unregister(_journal.stop)
+            _journal.stop()
+        _journal, _journal_started = None, False
+
+def journal_events(events):
+    journal = get_journal()
+    if journal is not None:
+        journal.record(events)
+
+def query_events(patient_id=None, since=None, until=None, agent=None, limit=1000):
+    """Stored events, oldest first, as (logged_at, Event) pairs; pass logged_at to render_event()."""
+    conditions, params = [], []
+    for column, operator, value in (("patient_id", "=", patient_id), ("logged_at", ">=", since),
+                                    ("logged_at", "<", until), ("agent", "=", agent)):
+        if value is not None:
+            conditions.append(f"{column} {operator} %s")
+            params.append(value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with db_cursor() as cursor:
+        cursor.execute(f"""
+            SELECT logged_at, mono_ns, agent, patient_id, outcome, kind, payload
+            FROM agent_events {where}
+            ORDER BY logged_at, event_id
+            LIMIT %s;
+            """, (*params, limit))
+        rows = cursor.fetchall()
+    return [(logged_at, Event(mono_ns, agent, patient_id, outcome, kind, payload or {}))
+            for logged_at, mono_ns, agent, patient_id, outcome, kind, payload in rows]
@@ -0,0 +1,153 @@
+"""One LISTEN connection per process, shared by everything that wants pg_notify events.
+
+Subscribers register a callback per channel and, optionally, an ``on_connect``
+hook that runs once LISTEN is in place on a new (or re-established)
+connection, which is where they load the state the events will then keep up
+to date. Nothing here polls: the thread blocks in select() until Postgres
+delivers a notification.
+"""
+import json, select, socket, threading
+from logging import debug
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from db import db_config
+
+RECONNECT_DELAY = 5.0
+
+class NotificationListener:
+    def __init__(self, reconnect_delay=RECONNECT_DELAY, **conn_kwargs):
+        self.reconnect_delay = reconnect_delay
+        self.conn_kwargs = conn_kwargs or db_config()
+        self._callbacks = {}
+        self._on_connect = []
+        self._pending_connect = []
+        self._listening = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = None
+        # Written to whenever the loop has to wake up: new subscriber or stop().
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._stats = {"notifications": 0, "callback_errors": 0, "reconnects": 0, "errors": 0}
+
+    def subscribe(self, channels, callback, on_connect=None):
+        """``callback(channel, payload)`` gets the decoded JSON payload of every notification."""
+        with self._lock:
+            for channel in channels:
+                self._callbacks.setdefault(channel, []).append(callback)
+            if on_connect:
+                self._on_connect.append(on_connect)
+                self._pending_connect.append(on_connect)
+        self._wake()
+        return self.start()
+
+    def unsubscribe(self, callback, on_connect=None):
+        with self._lock:
+            for callbacks in self._callbacks.values():
+                if callback in callbacks:
+                    callbacks.remove(callback)
+            if on_connect in self._on_connect:
+                self._on_connect.remove(on_connect)
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.conn_kwargs)
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        self._conn = conn
+        self._listening = set()
+        with self._lock:
+            self._pending_connect = list(self._on_connect)
+
+    def _sync(self):
+        with self._lock:
+            channels = set(self._callbacks) - self._listening
+            pending, self._pending_connect = self._pending_connect, []
+        with self._conn.cursor() as cur:
+            for channel in channels:
+                cur.execute(f"LISTEN {channel};")
+        self._listening |= channels
+        # LISTEN is in place before state is loaded, so nothing committed in between is lost.
+        for on_connect in pending:
+            on_connect()
+
+    def _deliver(self, notify):
+        with self._lock:
+            callbacks = list(self._callbacks.get(notify.channel, ()))
+            self._stats["notifications"] += 1
+        payload = json.loads(notify.payload) if notify.payload else None
+        for callback in callbacks:
+            try:
+                callback(notify.channel, payload)
+            except Exception as e:
+                with self._lock:
+                    self._stats["callback_errors"] += 1
+                debug(f"Notification callback failed on {notify.channel}...\n{e}")
+
+    def run(self):
+        debug("Notification listener started...")
+        while not self._stop.is_set():
+            try:
+                if self._conn is None:
+                    self._connect()
+                self._sync()
+                ready = select.select([self._conn, self._wake_r], [], [])[0]
+                if self._wake_r in ready:
+                    self._wake_r.recv(4096)
+                if self._conn in ready:
+                    self._conn.poll()
+                    while self._conn.notifies:
+                        self._deliver(self._conn.notifies.pop(0))
+            except Exception as e:
+                with self._lock:
+                    self._stats["errors"] += 1
+                    self._stats["reconnects"] += 1
+                debug(f"Notification listener error, reconnecting in {self.reconnect_delay}s...\n{e}")
+                self._close()
+                self._stop.wait(self.reconnect_delay)
+        self._close()
+        debug("Notification listener stopped...")
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self.run, name="shmas-listener", daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["channels"] = sorted(self._callbacks)
+        stats["connected"] = self._conn is not None and not self._conn.closed
+        return stats
+
+_listener = None
+_listener_lock = threading.Lock()
+
+def get_listener():
+    global _listener
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = NotificationListener()
+    return _listener
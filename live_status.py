@@ -0,0 +1,252 @@
+"""In-memory doctor/bed/queue view kept current by the dashboard change feed.
+
+The view is loaded once when the process-wide listener connects, then every
+row change on doctors, rooms, ongoing_cases and queue arrives as a
+notification and is applied as a diff. Any number of dashboard sessions can
+render from it without touching the database.
+"""
+import os, threading
+from collections import deque
+from datetime import datetime, timedelta
+from logging import debug
+from db import db_cursor
+from listener import get_listener
+
+DASHBOARD_CHANNEL = "shmas_dashboard"
+SNAPSHOT_QUERIES = {
+    "now": "SELECT CURRENT_TIMESTAMP::timestamp;",
+    "doctors": "SELECT doctor_id, name, specialist, is_busy, busy_from, busy_till FROM doctors;",
+    "rooms": "SELECT room_number, type, is_occupied FROM rooms;",
+    "cases": """
+        SELECT oc.patient_id, oc.doctor_id, oc.room_number, p.patient_name
+        FROM ongoing_cases oc
+        LEFT JOIN patient_info p ON oc.patient_id = p.patient_id;
+        """,
+    "queue": "SELECT patient_id, priority_score, type_of_room, department FROM queue;",
+}
+
+def _timestamp(value):
+    # Rows from notifications are JSON, so timestamps arrive as ISO strings.
+    if isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+class LiveStatus:
+    def __init__(self, listener=None, history=1000):
+        self.listener = listener or get_listener()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._doctors = {}
+        self._rooms = {}
+        self._cases = {}
+        self._patient_by_doctor = {}
+        self._queue = {}
+        self._bed_counts = {}
+        self._doctor_counts = {}
+        self._clock_offset = timedelta(0)
+        self.version = 0
+        self._changes = deque(maxlen=history)
+        self._change_callbacks = []
+        self._stats = {"loads": 0, "events": 0}
+
+    def _count(self, counts, category, in_use, delta):
+        if category is None:
+            return
+        bucket = counts.setdefault(category, [0, 0])
+        bucket[1 if in_use else 0] += delta
+
+    def _put_doctor(self, row):
+        doctor = {"name": row["name"], "specialist": row["specialist"], "is_busy": bool(row["is_busy"]),
+                  "busy_from": _timestamp(row["busy_from"]), "busy_till": _timestamp(row["busy_till"])}
+        self._doctors[row["doctor_id"]] = doctor
+        self._count(self._doctor_counts, doctor["specialist"], doctor["is_busy"], 1)
+
+    def _drop_doctor(self, doctor_id):
+        doctor = self._doctors.pop(doctor_id, None)
+        if doctor:
+            self._count(self._doctor_counts, doctor["specialist"], doctor["is_busy"], -1)
+
+    def _put_room(self, row):
+        room = (row["type"], bool(row["is_occupied"]))
+        self._rooms[row["room_number"]] = room
+        self._count(self._bed_counts, room[0], room[1], 1)
+
+    def _drop_room(self, room_number):
+        room = self._rooms.pop(room_number, None)
+        if room:
+            self._count(self._bed_counts, room[0], room[1], -1)
+
+    def _put_case(self, row, patient_name):
+        # Keyed on the whole row (ongoing_cases has no key), which also makes
+        # replaying an event the snapshot already contains harmless.
+        self._cases[(row["patient_id"], row["doctor_id"], row["room_number"])] = patient_name
+        if row["doctor_id"] is not None:
+            self._patient_by_doctor[row["doctor_id"]] = patient_name
+
+    def _drop_case(self, row):
+        patient_name = self._cases.pop((row["patient_id"], row["doctor_id"], row["room_number"]), None)
+        if row["doctor_id"] is not None and self._patient_by_doctor.get(row["doctor_id"]) == patient_name:
+            self._patient_by_doctor.pop(row["doctor_id"], None)
+        return patient_name
+
+    def load(self):
+        rows = {}
+        with db_cursor() as cursor:
+            for name, query in SNAPSHOT_QUERIES.items():
+                cursor.execute(query)
+                rows[name] = cursor.fetchall()
+        with self._lock:
+            self._doctors, self._rooms, self._cases, self._queue = {}, {}, {}, {}
+            self._patient_by_doctor, self._bed_counts, self._doctor_counts = {}, {}, {}
+            self._clock_offset = rows["now"][0][0] - datetime.now()
+            for doctor_id, name, specialist, is_busy, busy_from, busy_till in rows["doctors"]:
+                self._put_doctor({"doctor_id": doctor_id, "name": name, "specialist": specialist,
+                                  "is_busy": is_busy, "busy_from": busy_from, "busy_till": busy_till})
+            for room_number, kind, is_occupied in rows["rooms"]:
+                self._put_room({"room_number": room_number, "type": kind, "is_occupied": is_occupied})
+            for patient_id, doctor_id, room_number, patient_name in rows["cases"]:
+                self._put_case({"patient_id": patient_id, "doctor_id": doctor_id, "room_number": room_number},
+                               patient_name)
+            for patient_id, priority_score, type_of_room, department in rows["queue"]:
+                self._queue[patient_id] = (priority_score, type_of_room, department)
+            self.version += 1
+            self._changes.append((self.version, "*", None))
+            self._stats["loads"] += 1
+        self._ready.set()
+        self._changed()
+        debug(f"Live status loaded {len(rows['doctors'])} doctors, {len(rows['rooms'])} rooms...")
+
+    def reload_queue(self):
+        # rescore_queue() changes many scores at once and announces it with a single RERANK event.
+        with db_cursor() as cursor:
+            cursor.execute(SNAPSHOT_QUERIES["queue"])
+            rows = cursor.fetchall()
+        with self._lock:
+            self._queue = {patient_id: (priority_score, type_of_room, department)
+                           for patient_id, priority_score, type_of_room, department in rows}
+            self.version += 1
+            self._changes.append((self.version, "queue", None))
+            self._stats["events"] += 1
+        self._changed()
+
+    def apply(self, channel, payload):
+        if payload["op"] == "RERANK":
+            self.reload_queue()
+            return
+        table, old, new = payload["table"], payload["old"], payload["new"]
+        with self._lock:
+            if table == "doctors":
+                if old:
+                    self._drop_doctor(old["doctor_id"])
+                if new:
+                    self._put_doctor(new)
+                key = (new or old)["doctor_id"]
+            elif table == "rooms":
+                if old:
+                    self._drop_room(old["room_number"])
+                if new:
+                    self._put_room(new)
+                key = (new or old)["room_number"]
+            elif table == "ongoing_cases":
+                name = self._drop_case(old) if old else None
+                if new:
+                    self._put_case(new, payload.get("patient_name") or name)
+                key = (new or old)["patient_id"]
+            elif table == "queue":
+                if old:
+                    self._queue.pop(old["patient_id"], None)
+                if new:
+                    self._queue[new["patient_id"]] = (new["priority_score"], new["type_of_room"], new["department"])
+                key = (new or old)["patient_id"]
+            else:
+                return
+            self.version += 1
+            self._changes.append((self.version, table, key))
+            self._stats["events"] += 1
+        self._changed()
+
+    def on_change(self, callback):
+        """Calls ``callback()`` after every load or applied change, on the listener thread."""
+        self._change_callbacks.append(callback)
+
+    def _changed(self):
+        for callback in list(self._change_callbacks):
+            callback()
+
+    def changes_since(self, version):
+        """(table, key) pairs changed after ``version``; None if the history no longer reaches back that far."""
+        with self._lock:
+            if self._changes and self._changes[0][0] > version + 1:
+                return None
+            return [(table, key) for v, table, key in self._changes if v > version]
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def doctor_status(self):
+        """Same rows as agents.get_doctor_status(), from memory."""
+        with self._lock:
+            now = datetime.now() + self._clock_offset
+            output = []
+            for doctor_id in sorted(self._doctors):
+                doctor = self._doctors[doctor_id]
+                busy = doctor["is_busy"]
+                output.append({
+                    "doctor_name": doctor["name"],
+                    "department": doctor["specialist"],
+                    "status": "BUSY" if busy else "AVAILABLE",
+                    "with_patient": self._patient_by_doctor.get(doctor_id) if busy else None,
+                    "time_remaining": round((doctor["busy_till"] - now).total_seconds() / 60, 2)
+                                      if busy and doctor["busy_till"] else None,
+                    "finish_time": doctor["busy_till"] if busy else None,
+                    "start_time": doctor["busy_from"] if busy else None,
+                })
+            return output
+
+    def beds(self):
+        with self._lock:
+            return {kind: tuple(counts) for kind, counts in sorted(self._bed_counts.items()) if sum(counts)}
+
+    def doctor_counts(self):
+        with self._lock:
+            return {kind: tuple(counts) for kind, counts in sorted(self._doctor_counts.items()) if sum(counts)}
+
+    def queue_depth(self):
+        with self._lock:
+            return len(self._queue)
+
+    def queue(self):
+        """Waiting patients as (patient_id, priority_score, type_of_room, department), highest priority first."""
+        with self._lock:
+            rows = [(patient_id,) + entry for patient_id, entry in self._queue.items()]
+        return sorted(rows, key=lambda row: -float(row[1] or 0))
+
+    @property
+    def connected(self):
+        return self._ready.is_set() and self.listener.stats()["connected"]
+
+    def start(self):
+        self.listener.subscribe([DASHBOARD_CHANNEL], self.apply, on_connect=self.load)
+        return self
+
+    def stop(self):
+        self.listener.unsubscribe(self.apply, on_connect=self.load)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["version"] = self.version
+        stats["listener"] = self.listener.stats()
+        return stats
+
+_live_status = None
+_live_status_lock = threading.Lock()
+
+def start_live_status(ready_timeout=None):
+    global _live_status
+    with _live_status_lock:
+        if _live_status is None:
+            _live_status = LiveStatus().start()
+    _live_status.wait_ready(ready_timeout if ready_timeout is not None
+                            else float(os.getenv("SHMAS_LIVE_READY_TIMEOUT", "10")))
+    return _live_status
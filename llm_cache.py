@@ -0,0 +1,133 @@
+import os, json, time, hashlib, sqlite3, threading
+from collections import OrderedDict
+from logging import debug
+from triage_rules import PEDIATRIC_AGE, HEART_RATE_CUTOFFS, SYSTOLIC_CUTOFFS, DIASTOLIC_CUTOFFS
+
+def age_band(age):
+    # Decades, except that the pediatric cut-off splits the decade it falls in.
+    decade = (age // 10) * 10
+    if decade < PEDIATRIC_AGE < decade + 10:
+        return f"{decade}s{'<' if age < PEDIATRIC_AGE else '>='}{PEDIATRIC_AGE}"
+    return f"{decade}s"
+
+def vitals_bucket(value, cutoffs=(), width=10):
+    bucket = int(value // width) * width
+    # A cut-off inside the bucket splits it three ways (below, on, above), whichever side the rule includes.
+    return [bucket] + [(value > cutoff) - (value < cutoff) for cutoff in cutoffs if bucket <= cutoff < bucket + width]
+
+def duration_band(hours):
+    for limit in (6, 24, 72, 168):
+        if hours < limit:
+            return f"<{limit}h"
+    return ">=168h"
+
+def make_cache_key(kind, patient, prompt_version, model, extra=()):
+    bp = patient.vitals.get("blood_pressure", {})
+    parts = [
+        kind,
+        prompt_version,
+        model,
+        sorted({s.strip().lower() for s in patient.symptoms if s.strip()}),
+        age_band(patient.age),
+        vitals_bucket(patient.vitals.get("heart_rate", 80), HEART_RATE_CUTOFFS),
+        vitals_bucket(bp.get("systolic", 120), SYSTOLIC_CUTOFFS),
+        vitals_bucket(bp.get("diastolic", 80), DIASTOLIC_CUTOFFS),
+        duration_band(patient.symptom_duration),
+        list(extra),
+    ]
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+class LLMResultCache:
+    """LRU + TTL cache for parsed LLM answers, optionally backed by SQLite.
+
+    The in-memory LRU is the fast path; when ``persist_path`` is set every
+    entry is also written to SQLite so a restarted process starts warm.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=6 * 3600, persist_path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "disk_hits": 0, "evictions": 0, "expired": 0}
+        self._db = None
+        if persist_path:
+            self._db = sqlite3.connect(persist_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT, created REAL)")
+            self._db.execute("DELETE FROM llm_cache WHERE created < ?", (time.time() - ttl_seconds,))
+            self._db.commit()
+
+    def _load(self, key, now):
+        row = self._db.execute("SELECT value, created FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or now - row[1] > self.ttl_seconds:
+            return None
+        return row
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] > self.ttl_seconds:
+                del self._entries[key]
+                self._stats["expired"] += 1
+                entry = None
+            if entry is None and self._db is not None:
+                entry = self._load(key, now)
+                if entry is not None:
+                    self._stats["disk_hits"] += 1
+                    self._store(key, entry[0], entry[1])
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def _store(self, key, value, created):
+        self._entries[key] = (value, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._store(key, value, now)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)", (key, value, now))
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM llm_cache")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_llm_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LLMResultCache(
+                    max_entries=int(os.getenv("SHMAS_LLM_CACHE_SIZE", "1024")),
+                    ttl_seconds=float(os.getenv("SHMAS_LLM_CACHE_TTL", str(6 * 3600))),
+                    persist_path=os.getenv("SHMAS_LLM_CACHE_PATH") or None,
+                )
+                debug("Initialised LLM result cache...")
+    return _cache
+
+def llm_cache_enabled():
+    return os.getenv("SHMAS_LLM_CACHE", "1") != "0"
@@ -0,0 +1,359 @@
+import os, json, time, random, asyncio, threading, weakref
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from logging import debug
+from config import load_env
+from metrics import span, inc
+from llm_stream import StreamedAnswer, read_answer, aread_answer
+
+class LLMUnavailableError(Exception):
+    pass
+
+class CircuitOpenError(LLMUnavailableError):
+    pass
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures and fails fast
+    until ``reset_timeout`` has passed, then lets one trial call through."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self.state = "closed"
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_in_flight = False
+            self.state = "closed"
+
+    def release(self):
+        # A call that never reached the backend proves nothing either way; it only frees the trial slot.
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                if self.state != "open":
+                    debug("LLM circuit breaker opened...")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Takes a token (possibly going into debt) and returns how long to wait for it.
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def refund(self):
+        # Hands back a token reserved for a call that was never made.
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+class StubChatBackend:
+    """Offline stand-in for ChatGroq. ``responder(prompt) -> str`` decides the
+    reply; ``latency`` is a number of seconds or a callable returning one."""
+    model_name = "stub"
+
+    def __init__(self, responder=None, latency=0.0):
+        self.responder = responder or default_stub_responder
+        self.latency = latency
+
+    def _delay(self):
+        return self.latency() if callable(self.latency) else self.latency
+
+    def invoke(self, messages):
+        from langchain_core.messages import AIMessage
+        time.sleep(self._delay())
+        return AIMessage(content=self.responder(messages[-1].content))
+
+    async def ainvoke(self, messages):
+        from langchain_core.messages import AIMessage
+        await asyncio.sleep(self._delay())
+        return AIMessage(content=self.responder(messages[-1].content))
+
+    def stream(self, messages):
+        from langchain_core.messages import AIMessageChunk
+        time.sleep(self._delay())
+        for piece in stub_tokens(self.responder(messages[-1].content)):
+            yield AIMessageChunk(content=piece)
+
+    async def astream(self, messages):
+        from langchain_core.messages import AIMessageChunk
+        await asyncio.sleep(self._delay())
+        for piece in stub_tokens(self.responder(messages[-1].content)):
+            yield AIMessageChunk(content=piece)
+
+def stub_tokens(text, size=4):
+    # Roughly token-sized pieces, for stubs that stream.
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def default_stub_responder(prompt):
+    # Answers whichever keys the prompt's JSON template asks for; the combined assessment asks for all three.
+    answer = {}
+    if '"mood"' in prompt:
+        answer["mood"] = "anxious"
+    if '"triage_level"' in prompt:
+        answer.update(triage_level=3, department="Cardiology")
+    return f"<think>stub</think>{json.dumps(answer or {'mood': 'anxious'})}"
+
+class LLMGateway:
+    def __init__(self, backend, max_concurrency=8, rate_per_sec=None, burst=None, timeout=60.0,
+                 max_retries=2, backoff_base=0.5, backoff_max=8.0, breaker=None, model=None):
+        self.backend = backend
+        self.model = model or getattr(backend, "model_name", None) or backend.__class__.__name__
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.bucket = TokenBucket(rate_per_sec, burst) if rate_per_sec else None
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._async_semaphores = weakref.WeakKeyDictionary()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="llm")
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "successes": 0, "failures": 0, "retries": 0, "timeouts": 0, "rejected": 0,
+                       "streams": 0, "cancelled": 0, "output_tokens": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            self._count("rejected")
+            raise CircuitOpenError("LLM circuit breaker is open, failing fast")
+
+    def _rate_wait(self, deadline):
+        # How long to wait for the rate limit; gives up now rather than sleep past the deadline.
+        wait = self.bucket.reserve() if self.bucket else 0.0
+        if wait and time.monotonic() + wait >= deadline:
+            self.bucket.refund()
+            self._local_timeout()
+        return wait
+
+    def _local_timeout(self):
+        # Out of time before the call reached the backend (rate limit or our own concurrency limit).
+        # That says nothing about the upstream, so the breaker isn't told.
+        self.breaker.release()
+        self._count("timeouts")
+        raise LLMUnavailableError("LLM call deadline exceeded")
+
+    def _record_usage(self, usage, fields):
+        usage = usage or {}
+        for direction in ("input", "output"):
+            if usage.get(f"{direction}_tokens"):
+                inc("shmas_llm_tokens_total", usage[f"{direction}_tokens"], model=self.model, direction=direction)
+                fields[f"{direction}_tokens"] = usage[f"{direction}_tokens"]
+        with self._lock:
+            self._stats["output_tokens"] += usage.get("output_tokens", 0)
+
+    def _record_stream(self, answer, fields):
+        # A stream cut short never gets the provider's usage chunk, so each chunk counts as one output token.
+        self._record_usage(answer.usage or {"output_tokens": answer.chunks}, fields)
+        fields["chunks"] = answer.chunks
+        fields["cancelled"] = answer.cancelled
+        with self._lock:
+            self._stats["streams"] += 1
+            self._stats["cancelled"] += answer.cancelled
+
+    def invoke(self, messages, timeout=None):
+        with span("llm", self.model) as fields:
+            response = self._invoke(messages, timeout)
+            self._record_usage(getattr(response, "usage_metadata", None), fields)
+        return response
+
+    async def ainvoke(self, messages, timeout=None):
+        with span("llm", self.model) as fields:
+            response = await self._ainvoke(messages, timeout)
+            self._record_usage(getattr(response, "usage_metadata", None), fields)
+        return response
+
+    def stream_answer(self, messages, accepts, timeout=None):
+        """Streams the reply and stops generating at the first JSON object ``accepts(obj)`` takes.
+
+        Same concurrency limit, retries and breaker as invoke(); see llm_stream.
+        Backends that can't stream are invoked normally.
+        """
+        if not hasattr(self.backend, "stream"):
+            response = self.invoke(messages, timeout)
+            return StreamedAnswer(response.content, None, 0, False, getattr(response, "usage_metadata", None))
+        deadline = time.monotonic() + (timeout or self.timeout)
+        with span("llm", self.model) as fields:
+            # The deadline is also checked between chunks, so a worker that was given up on stops reading.
+            answer = self._invoke(messages, timeout,
+                                  call=lambda m: read_answer(self.backend.stream(m), accepts, deadline))
+            self._record_stream(answer, fields)
+        return answer
+
+    async def astream_answer(self, messages, accepts, timeout=None):
+        if not hasattr(self.backend, "astream"):
+            response = await self.ainvoke(messages, timeout)
+            return StreamedAnswer(response.content, None, 0, False, getattr(response, "usage_metadata", None))
+        with span("llm", self.model) as fields:
+            answer = await self._ainvoke(messages, timeout,
+                                         call=lambda m: aread_answer(self.backend.astream(m), accepts))
+            self._record_stream(answer, fields)
+        return answer
+
+    def _invoke(self, messages, timeout=None, call=None):
+        self._count("calls")
+        deadline = time.monotonic() + (timeout or self.timeout)
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            self._check_breaker()
+            time.sleep(self._rate_wait(deadline))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._semaphore.acquire(timeout=remaining):
+                self._local_timeout()
+            future = self._executor.submit(call or self.backend.invoke, messages)
+            # The slot is held until the backend call really finishes, even if we stop waiting.
+            future.add_done_callback(lambda _: self._semaphore.release())
+            try:
+                response = future.result(timeout=max(0.0, deadline - time.monotonic()))
+                self.breaker.record_success()
+                self._count("successes")
+                return response
+            except FutureTimeoutError:
+                self.breaker.record_failure()
+                self._count("timeouts")
+                raise LLMUnavailableError("LLM call deadline exceeded")
+            except Exception as e:
+                self.breaker.record_failure()
+                last_error = e
+                debug(f"LLM call failed (attempt {attempt + 1})...\n{e}")
+            if attempt < self.max_retries:
+                delay = self._backoff(attempt)
+                if time.monotonic() + delay >= deadline:
+                    break
+                self._count("retries")
+                time.sleep(delay)
+        self._count("failures")
+        raise LLMUnavailableError(f"LLM call failed: {last_error}")
+
+    def _async_semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._async_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    async def _ainvoke(self, messages, timeout=None, call=None):
+        self._count("calls")
+        deadline = time.monotonic() + (timeout or self.timeout)
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            self._check_breaker()
+            await asyncio.sleep(self._rate_wait(deadline))
+            semaphore = self._async_semaphore()
+            try:
+                await asyncio.wait_for(semaphore.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                self._local_timeout()
+            try:
+                try:
+                    response = await asyncio.wait_for((call or self.backend.ainvoke)(messages),
+                                                      timeout=max(0.0, deadline - time.monotonic()))
+                finally:
+                    semaphore.release()
+                self.breaker.record_success()
+                self._count("successes")
+                return response
+            except asyncio.TimeoutError:
+                self.breaker.record_failure()
+                self._count("timeouts")
+                raise LLMUnavailableError("LLM call deadline exceeded")
+            except Exception as e:
+                self.breaker.record_failure()
+                last_error = e
+                debug(f"LLM call failed (attempt {attempt + 1})...\n{e}")
+            if attempt < self.max_retries:
+                delay = self._backoff(attempt)
+                if time.monotonic() + delay >= deadline:
+                    break
+                self._count("retries")
+                await asyncio.sleep(delay)
+        self._count("failures")
+        raise LLMUnavailableError(f"LLM call failed: {last_error}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["breaker_state"] = self.breaker.state
+        return stats
+
+def llm_streaming_enabled():
+    return os.getenv("SHMAS_LLM_STREAM", "0") == "1"
+
+def human_message(content):
+    # langchain_core.messages is slow to import, so it is loaded on the first prompt rather than at import.
+    from langchain_core.messages import HumanMessage
+    return HumanMessage(content=content)
+
+def build_groq_backend(model_name, timeout):
+    from langchain_groq import ChatGroq
+    # Retries are the gateway's job; one client (and its HTTP pool) is shared by every agent.
+    return ChatGroq(api_key=os.getenv("GROQ_API_KEY"), model_name=model_name, timeout=timeout, max_retries=0)
+
+_gateway = None
+_gateway_lock = threading.RLock()
+
+def configure_llm_gateway(backend=None, model_name="deepseek-r1-distill-llama-70b", **kwargs):
+    global _gateway
+    load_env()
+    timeout = kwargs.setdefault("timeout", float(os.getenv("SHMAS_LLM_TIMEOUT", "60")))
+    kwargs.setdefault("max_concurrency", int(os.getenv("SHMAS_LLM_MAX_CONCURRENCY", "8")))
+    kwargs.setdefault("max_retries", int(os.getenv("SHMAS_LLM_MAX_RETRIES", "2")))
+    if os.getenv("SHMAS_LLM_RATE"):
+        kwargs.setdefault("rate_per_sec", float(os.getenv("SHMAS_LLM_RATE")))
+    kwargs.setdefault("breaker", CircuitBreaker(
+        failure_threshold=int(os.getenv("SHMAS_LLM_BREAKER_THRESHOLD", "5")),
+        reset_timeout=float(os.getenv("SHMAS_LLM_BREAKER_RESET", "30")),
+    ))
+    if backend is None:
+        if os.getenv("SHMAS_LLM_BACKEND", "groq") == "stub":
+            backend = StubChatBackend()
+        else:
+            backend = build_groq_backend(model_name, timeout)
+    with _gateway_lock:
+        _gateway = LLMGateway(backend, **kwargs)
+    return _gateway
+
+def get_llm_gateway():
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                return configure_llm_gateway()
+    return _gateway
@@ -0,0 +1,136 @@
+"""Reading a streamed LLM reply only until it contains the answer.
+
+The agents ask for one small JSON object, but deepseek-r1 streams a long
+<think> block first and often keeps talking after the object. The extractor
+skips the reasoning, finds complete top-level objects as the tokens arrive,
+and ``read_answer()`` stops consuming (closing the stream, which cancels the
+generation) at the first object the caller accepts.
+"""
+import json, time
+from collections import namedtuple
+
+THINK_OPEN, THINK_CLOSE = "<think>", "</think>"
+
+# ``content`` is the accepted object re-serialised, or the whole reply when nothing was accepted.
+StreamedAnswer = namedtuple("StreamedAnswer", ["content", "answer", "chunks", "cancelled", "usage"])
+
+class StreamDeadlineError(Exception):
+    pass
+
+class JSONObjectExtractor:
+    """Finds complete top-level JSON objects in text that arrives in pieces.
+
+    A leading <think>...</think> block is skipped, since reasoning models quote
+    JSON while thinking. Scanned text outside an object is dropped, so memory
+    stays bounded by the largest object, not the length of the reply.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._thinking = None
+
+    def _past_reasoning(self):
+        if self._thinking is None:
+            head = self._buffer.lstrip()
+            if THINK_OPEN.startswith(head):
+                return False
+            self._thinking = head.startswith(THINK_OPEN)
+        if self._thinking:
+            end = self._buffer.find(THINK_CLOSE)
+            if end < 0:
+                # Keep just enough to recognise a closing tag split across chunks.
+                self._buffer = self._buffer[-(len(THINK_CLOSE) - 1):]
+                return False
+            self._buffer = self._buffer[end + len(THINK_CLOSE):]
+            self._thinking = False
+        return True
+
+    def feed(self, text):
+        """Adds ``text`` and returns the objects completed by it, in order."""
+        self._buffer += text
+        if self._thinking is not False and not self._past_reasoning():
+            return []
+        found = []
+        buffer, i = self._buffer, self._pos
+        while i < len(buffer):
+            ch = buffer[i]
+            if self._start is None:
+                if ch == "{":
+                    self._start, self._depth = i, 1
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        value = json.loads(buffer[self._start:i + 1])
+                    except ValueError:
+                        value = None
+                    # Braces in prose ("{like this}") aren't JSON and are passed over.
+                    if isinstance(value, dict):
+                        found.append(value)
+                    self._start = None
+            i += 1
+        if self._start is None:
+            self._buffer, self._pos = "", 0
+        else:
+            self._buffer, self._pos, self._start = buffer[self._start:], i - self._start, 0
+        return found
+
+def _chunk_text(chunk):
+    content = getattr(chunk, "content", chunk)
+    return content if isinstance(content, str) else ""
+
+def read_answer(chunks, accepts, deadline=None):
+    """Consumes ``chunks`` until ``accepts(obj)`` holds for a parsed object, then closes the stream."""
+    extractor = JSONObjectExtractor()
+    parts, count, usage = [], 0, None
+    try:
+        for chunk in chunks:
+            count += 1
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            text = _chunk_text(chunk)
+            parts.append(text)
+            for value in extractor.feed(text):
+                if accepts(value):
+                    return StreamedAnswer(json.dumps(value), value, count, True, usage)
+            if deadline is not None and time.monotonic() > deadline:
+                raise StreamDeadlineError("LLM stream deadline exceeded")
+    finally:
+        close = getattr(chunks, "close", None)
+        if close:
+            close()
+    return StreamedAnswer("".join(parts), None, count, False, usage)
+
+async def aread_answer(chunks, accepts):
+    """read_answer() for an async stream; the caller bounds it with asyncio.wait_for."""
+    extractor = JSONObjectExtractor()
+    parts, count, usage = [], 0, None
+    try:
+        async for chunk in chunks:
+            count += 1
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            text = _chunk_text(chunk)
+            parts.append(text)
+            for value in extractor.feed(text):
+                if accepts(value):
+                    return StreamedAnswer(json.dumps(value), value, count, True, usage)
+    finally:
+        aclose = getattr(chunks, "aclose", None)
+        if aclose:
+            await aclose()
+    return StreamedAnswer("".join(parts), None, count, False, usage)
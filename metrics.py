@@ -0,0 +1,198 @@
+"""In-process latency spans, outcome counters and a Prometheus text export.
+
+Graph nodes, SQL statements and LLM calls are wrapped in ``span()``, which
+records a duration histogram (``shmas_<kind>_duration_seconds``) and, when
+the ``shmas.trace`` logger is enabled (SHMAS_TRACE_LEVEL=DEBUG), one trace
+line per span. Log records go through the queue handler installed by
+config.configure_logging(), so they are formatted and written on the log
+thread, not the admission's thread.
+
+``render_prometheus()`` returns the text exposition format, and
+``start_metrics_server()`` serves it on /metrics from a stdlib HTTP server:
+
+    SHMAS_METRICS_PORT=9464 streamlit run streamlit_dashboard.py
+    curl localhost:9464/metrics
+"""
+import os, re, time, bisect, logging, threading
+from contextlib import contextmanager
+from functools import lru_cache
+from logging import debug
+
+TRACE = logging.getLogger("shmas.trace")
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+HELP = {
+    "shmas_node_duration_seconds": "Time spent in each admission graph node.",
+    "shmas_sql_duration_seconds": "Time spent executing each SQL statement.",
+    "shmas_llm_duration_seconds": "Time spent in each LLM call, retries included.",
+    "shmas_llm_tokens_total": "LLM tokens used, by model and direction.",
+    "shmas_agent_outcomes_total": "Agent results by status (Success, Failed, Queued).",
+    "shmas_speculation_total": "Speculative holds by resource and result (hit, miss, expired, unheld).",
+    "shmas_speculation_saved_seconds": "Claim time taken off the admission path by speculative holds.",
+    "shmas_assessments_total": "Mood and triage assessments, by path (combined single call or split).",
+    "shmas_db_checkout_wait_seconds": "Time spent waiting for a pooled database connection.",
+    "shmas_rescore_duration_seconds": "Time spent re-scoring the whole waiting queue.",
+    "shmas_journal_duration_seconds": "Time spent writing one batch of agent events.",
+    "shmas_journal_events_total": "Agent events written to the journal, by sink.",
+    "shmas_federation_duration_seconds": "Time spent reading a federated site's capacity, and routing a patient.",
+    "shmas_federation_reads_total": "Federated site capacity reads by result (ok, error, late).",
+    "shmas_referrals_total": "Patients referred to another site, by local outcome and snapshot source.",
+    "shmas_allocator_duration_seconds": "Time spent writing one batch of in-memory claims and releases to the database.",
+    "shmas_allocator_claims_total": "In-memory doctor and bed claims, by resource and result (claimed, none).",
+    "shmas_allocator_conflicts_total": "In-memory claims the database refused because another writer took the resource first.",
+    "shmas_allocator_lost_claims_total": "Claims found at confirm time to have been taken by a writer outside the allocator.",
+}
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_span_listeners = []
+
+def _key(metric, labels):
+    return metric, tuple(sorted(labels.items()))
+
+def inc(metric, value=1, /, **labels):
+    key = _key(metric, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(metric, value, /, **labels):
+    key = _key(metric, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+@contextmanager
+def span(kind, name, **labels):
+    """Times the block as ``shmas_<kind>_duration_seconds{name=...}``.
+
+    Yields a dict; anything the block puts in it (tokens, row counts) is
+    attached to the trace line.
+    """
+    fields = {}
+    outcome = "ok"
+    started = time.perf_counter()
+    try:
+        yield fields
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        observe(f"shmas_{kind}_duration_seconds", elapsed, name=name, outcome=outcome, **labels)
+        for listener in _span_listeners:
+            listener(kind, name, outcome, elapsed)
+        if TRACE.isEnabledFor(logging.DEBUG):
+            # Arguments, not an f-string: formatting happens on the log thread.
+            TRACE.debug("span %s %s %s %.3fms %s", kind, name, outcome, elapsed * 1000, fields)
+
+def add_span_listener(callback):
+    """``callback(kind, name, outcome, seconds)`` runs after every span, on the span's thread.
+
+    For tools that want raw samples (the load benchmark) rather than histogram buckets.
+    """
+    _span_listeners.append(callback)
+
+def remove_span_listener(callback):
+    if callback in _span_listeners:
+        _span_listeners.remove(callback)
+
+_STATEMENT_TARGET = re.compile(r"\b(?:from|into|update)\s+([a-z_][\w.]*)", re.IGNORECASE)
+_STATEMENT_CALL = re.compile(r"^\s*select\s+(?:\*\s+from\s+)?([a-z_]\w*)\s*\(", re.IGNORECASE)
+
+@lru_cache(maxsize=512)
+def statement_name(query):
+    """Short, low-cardinality label for a statement, e.g. ``select claim_doctor`` or ``insert patient_info``."""
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+    if not isinstance(query, str):
+        return "statement"
+    words = query.split(None, 1)
+    if not words:
+        # psycopg_pool's check_connection() runs an empty statement.
+        return "ping"
+    target = _STATEMENT_CALL.search(query) or _STATEMENT_TARGET.search(query)
+    return f"{words[0].lower()} {target.group(1)}" if target else words[0].lower()
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+def render_prometheus():
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (h.buckets, list(h.counts), h.sum, h.count)) for key, h in _histograms.items())
+    lines, seen = [], set()
+
+    def header(name, kind):
+        if name not in seen:
+            seen.add(name)
+            if name in HELP:
+                lines.append(f"# HELP {name} {HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        header(name, "counter")
+        lines.append(f"{name}{_labels(labels)} {value}")
+    for (name, labels), (buckets, counts, total, count) in histograms:
+        header(name, "histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {total}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+def reset_metrics():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_metrics_server(port=None, host="0.0.0.0"):
+    global _server
+    # http.server is a noticeable import, so it is only loaded by processes that serve metrics.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    with _server_lock:
+        if _server is None:
+            port = port if port is not None else int(os.getenv("SHMAS_METRICS_PORT", "9464"))
+            _server = ThreadingHTTPServer((host, port), MetricsHandler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="shmas-metrics", daemon=True).start()
+            debug(f"Serving metrics on {host}:{port}/metrics...")
+    return _server
@@ -0,0 +1,47 @@
+-- Atomic claim functions for existing databases; fresh installs get the same
+-- functions from hospitals_db.sql. allocate_case(), admit_from_queue() and
+-- hold_resources() in the later migrations call these, so this file runs first.
+
+-- Atomic allocation. Each claim locks and takes one free row in a single
+-- statement; SKIP LOCKED lets concurrent admissions pass over rows another
+-- transaction is claiming instead of waiting on (or double-booking) them.
+CREATE OR REPLACE FUNCTION claim_doctor(spclty VARCHAR, block_duration INTERVAL)
+	RETURNS SETOF doctors AS
+	$$
+	BEGIN
+		RETURN QUERY
+		UPDATE doctors d SET is_busy = TRUE,
+							 busy_from = CURRENT_TIMESTAMP,
+							 busy_till = CURRENT_TIMESTAMP + block_duration
+		WHERE d.doctor_id = (
+			SELECT doctor_id FROM doctors
+			WHERE specialist = spclty AND is_busy = FALSE
+			LIMIT 1
+			FOR UPDATE SKIP LOCKED
+		)
+		RETURNING d.*;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION claim_room(bed_priority room_type[])
+	RETURNS SETOF rooms AS
+	$$
+	DECLARE
+		bed room_type;
+	BEGIN
+		FOREACH bed IN ARRAY bed_priority LOOP
+			RETURN QUERY
+			UPDATE rooms r SET is_occupied = TRUE
+			WHERE r.room_number = (
+				SELECT room_number FROM rooms
+				WHERE rooms.type = bed AND is_occupied = FALSE
+				LIMIT 1
+				FOR UPDATE SKIP LOCKED
+			)
+			RETURNING r.*;
+			IF FOUND THEN
+				RETURN;
+			END IF;
+		END LOOP;
+	END;
+	$$ LANGUAGE plpgsql;
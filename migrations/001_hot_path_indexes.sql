@@ -0,0 +1,27 @@
+-- Indexes for the allocation and census hot paths. Safe to re-run on an
+-- existing database; fresh installs get the same indexes from hospitals_db.sql.
+-- CONCURRENTLY keeps the tables writable while the indexes build, so run this
+-- file outside an explicit transaction (plain `psql -f`).
+
+-- claim_doctor / get_available_doctors: free doctors of one specialty
+CREATE INDEX CONCURRENTLY IF NOT EXISTS doctors_free_specialist_idx
+	ON doctors (specialist) WHERE is_busy = FALSE;
+-- expiry of busy doctors (refresh_data: busy_till < now)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS doctors_busy_till_idx
+	ON doctors (busy_till) WHERE is_busy = TRUE;
+
+-- claim_room / get_available_rooms: free beds of one type
+CREATE INDEX CONCURRENTLY IF NOT EXISTS rooms_free_type_idx
+	ON rooms (type) WHERE is_occupied = FALSE;
+-- bed census: GROUP BY type with per-state counts, answerable from the index alone
+CREATE INDEX CONCURRENTLY IF NOT EXISTS rooms_type_occupied_idx
+	ON rooms (type, is_occupied);
+
+-- ongoing_cases is joined on all three keys (status view, release trigger, refresh_data)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ongoing_cases_doctor_idx ON ongoing_cases (doctor_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ongoing_cases_room_idx ON ongoing_cases (room_number);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ongoing_cases_patient_idx ON ongoing_cases (patient_id);
+
+-- queue is drained highest priority first, per room type
+CREATE INDEX CONCURRENTLY IF NOT EXISTS queue_room_priority_idx ON queue (type_of_room, priority_score DESC);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS queue_patient_idx ON queue (patient_id);
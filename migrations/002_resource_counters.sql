@@ -0,0 +1,131 @@
+-- Trigger-maintained availability counters for existing databases; fresh
+-- installs get the same objects from hospitals_db.sql. The final rebuild
+-- backfills the counters from the current rooms and doctors.
+
+CREATE TABLE IF NOT EXISTS resource_counters (
+	kind VARCHAR(10) NOT NULL,
+	category VARCHAR(100) NOT NULL,
+	available INT NOT NULL DEFAULT 0,
+	occupied INT NOT NULL DEFAULT 0,
+	PRIMARY KEY (kind, category)
+);
+
+CREATE OR REPLACE FUNCTION release_room_and_doctor_status()
+RETURNS TRIGGER AS
+	$$
+	BEGIN
+		-- Doctor before room, the same order allocate_case locks them (and their counters) in.
+		UPDATE doctors SET is_busy = FALSE WHERE doctor_id = OLD.doctor_id;
+		UPDATE rooms SET is_occupied = FALSE WHERE room_number = OLD.room_number;
+		RETURN OLD;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Availability counters per room type ('room') and per specialty ('doctor'),
+-- so census reads touch a handful of rows however large the hospital is.
+-- ongoing_cases changes reach the counters through release_case_trigger,
+-- which flips the room/doctor rows that the triggers below count.
+CREATE OR REPLACE FUNCTION bump_resource_counter(p_kind VARCHAR, p_category VARCHAR, p_in_use BOOLEAN, p_delta INT)
+	RETURNS void AS
+	$$
+	BEGIN
+		IF p_category IS NULL THEN
+			RETURN;
+		END IF;
+		INSERT INTO resource_counters AS rc (kind, category, available, occupied)
+		VALUES (p_kind, p_category,
+				CASE WHEN COALESCE(p_in_use, FALSE) THEN 0 ELSE p_delta END,
+				CASE WHEN COALESCE(p_in_use, FALSE) THEN p_delta ELSE 0 END)
+		ON CONFLICT (kind, category) DO UPDATE
+			SET available = rc.available + EXCLUDED.available,
+				occupied = rc.occupied + EXCLUDED.occupied;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_room_change()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		IF TG_OP IN ('UPDATE', 'DELETE') THEN
+			PERFORM bump_resource_counter('room', OLD.type::VARCHAR, OLD.is_occupied, -1);
+		END IF;
+		IF TG_OP IN ('UPDATE', 'INSERT') THEN
+			PERFORM bump_resource_counter('room', NEW.type::VARCHAR, NEW.is_occupied, 1);
+		END IF;
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_doctor_change()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		IF TG_OP IN ('UPDATE', 'DELETE') THEN
+			PERFORM bump_resource_counter('doctor', OLD.specialist, OLD.is_busy, -1);
+		END IF;
+		IF TG_OP IN ('UPDATE', 'INSERT') THEN
+			PERFORM bump_resource_counter('doctor', NEW.specialist, NEW.is_busy, 1);
+		END IF;
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER rooms_counter_trigger
+	AFTER INSERT OR DELETE ON rooms
+	FOR EACH ROW
+	EXECUTE FUNCTION count_room_change();
+
+CREATE OR REPLACE TRIGGER rooms_counter_update_trigger
+	AFTER UPDATE OF type, is_occupied ON rooms
+	FOR EACH ROW
+	WHEN (OLD.type IS DISTINCT FROM NEW.type OR OLD.is_occupied IS DISTINCT FROM NEW.is_occupied)
+	EXECUTE FUNCTION count_room_change();
+
+CREATE OR REPLACE TRIGGER doctors_counter_trigger
+	AFTER INSERT OR DELETE ON doctors
+	FOR EACH ROW
+	EXECUTE FUNCTION count_doctor_change();
+
+CREATE OR REPLACE TRIGGER doctors_counter_update_trigger
+	AFTER UPDATE OF specialist, is_busy ON doctors
+	FOR EACH ROW
+	WHEN (OLD.specialist IS DISTINCT FROM NEW.specialist OR OLD.is_busy IS DISTINCT FROM NEW.is_busy)
+	EXECUTE FUNCTION count_doctor_change();
+
+-- Consistency check: recounts rooms and doctors from scratch, returns every
+-- counter that had drifted (stored vs counted) and rewrites the table.
+CREATE OR REPLACE FUNCTION rebuild_resource_counters()
+	RETURNS TABLE(kind VARCHAR, category VARCHAR, stored_available INT, stored_occupied INT,
+				  counted_available INT, counted_occupied INT) AS
+	$$
+	#variable_conflict use_column
+	BEGIN
+		-- Writers wait for the few milliseconds the recount takes, so nothing slips between count and swap.
+		LOCK TABLE rooms, doctors IN SHARE MODE;
+		LOCK TABLE resource_counters IN EXCLUSIVE MODE;
+		CREATE TEMP TABLE counted AS
+			SELECT 'room'::VARCHAR kind, r.type::VARCHAR category,
+				   (COUNT(*) FILTER (WHERE NOT COALESCE(r.is_occupied, FALSE)))::INT available,
+				   (COUNT(*) FILTER (WHERE r.is_occupied))::INT occupied
+			FROM rooms r GROUP BY r.type
+			UNION ALL
+			SELECT 'doctor', d.specialist,
+				   (COUNT(*) FILTER (WHERE NOT COALESCE(d.is_busy, FALSE)))::INT,
+				   (COUNT(*) FILTER (WHERE d.is_busy))::INT
+			FROM doctors d WHERE d.specialist IS NOT NULL GROUP BY d.specialist;
+
+		RETURN QUERY
+		SELECT COALESCE(c.kind, rc.kind), COALESCE(c.category, rc.category),
+			   rc.available, rc.occupied, c.available, c.occupied
+		FROM counted c
+		FULL JOIN resource_counters rc ON rc.kind = c.kind AND rc.category = c.category
+		WHERE COALESCE(rc.available, 0) <> COALESCE(c.available, 0)
+		   OR COALESCE(rc.occupied, 0) <> COALESCE(c.occupied, 0);
+
+		DELETE FROM resource_counters;
+		INSERT INTO resource_counters SELECT * FROM counted;
+		DROP TABLE counted;
+	END;
+	$$ LANGUAGE plpgsql;
+
+SELECT * FROM rebuild_resource_counters();
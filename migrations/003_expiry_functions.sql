@@ -0,0 +1,36 @@
+-- Expiry functions for existing databases; fresh installs get them from hospitals_db.sql.
+
+-- Targeted expiry, run by the background worker in expiry.py when a busy_till
+-- deadline passes (refresh_data() is the old full-table sweep). Releases only
+-- the doctors whose block has ended and detaches them from their cases.
+CREATE OR REPLACE FUNCTION expire_doctors()
+	RETURNS SETOF INT AS
+	$$
+	BEGIN
+		RETURN QUERY
+		WITH released AS (
+			UPDATE doctors SET is_busy = FALSE, busy_till = NULL, busy_from = NULL
+			WHERE is_busy = TRUE AND busy_till <= CURRENT_TIMESTAMP
+			RETURNING doctors.doctor_id
+		), detached AS (
+			UPDATE ongoing_cases oc SET doctor_id = NULL
+			FROM released r WHERE oc.doctor_id = r.doctor_id
+		)
+		SELECT released.doctor_id FROM released;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Frees occupied rooms that no ongoing case refers to, but only among the
+-- candidates passed in; the worker passes rooms it already saw orphaned on its
+-- previous sweep so a bed claimed by an in-flight admission is left alone.
+CREATE OR REPLACE FUNCTION release_orphaned_rooms(p_candidates INT[])
+	RETURNS SETOF INT AS
+	$$
+	BEGIN
+		RETURN QUERY
+		UPDATE rooms r SET is_occupied = FALSE
+		WHERE r.room_number = ANY(p_candidates) AND r.is_occupied = TRUE
+		  AND NOT EXISTS (SELECT 1 FROM ongoing_cases oc WHERE oc.room_number = r.room_number)
+		RETURNING r.room_number;
+	END;
+	$$ LANGUAGE plpgsql;
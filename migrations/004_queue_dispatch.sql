@@ -0,0 +1,155 @@
+-- Queue dispatch for existing databases; fresh installs get the same objects
+-- from hospitals_db.sql. resolve_case() gains the columns the dispatcher needs
+-- to admit a queued patient later, so the old overload is dropped first.
+
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS department VARCHAR(100);
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS bed_priority room_type[];
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS block_duration INTERVAL;
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+UPDATE queue SET bed_priority = ARRAY[type_of_room] WHERE bed_priority IS NULL;
+
+DROP FUNCTION IF EXISTS resolve_case(BIGINT, INT, INT, room_type, NUMERIC);
+
+-- Turns the outcome of the two claims into a case or a queue entry, handing
+-- back whichever half was claimed if the other half failed.
+CREATE OR REPLACE FUNCTION resolve_case(p_patient_id BIGINT, p_doctor_id INT, p_room_number INT,
+										p_room_type room_type, p_priority NUMERIC, p_department VARCHAR DEFAULT NULL,
+										p_bed_priority room_type[] DEFAULT NULL, p_block_duration INTERVAL DEFAULT NULL)
+	RETURNS TEXT AS
+	$$
+	BEGIN
+		IF p_doctor_id IS NOT NULL AND p_room_number IS NOT NULL THEN
+			INSERT INTO ongoing_cases(patient_id, doctor_id, room_number)
+			VALUES (p_patient_id, p_doctor_id, p_room_number);
+			RETURN 'Admitted';
+		ELSIF p_doctor_id IS NULL AND p_room_number IS NULL THEN
+			RETURN 'Diverted';
+		END IF;
+
+		IF p_room_number IS NOT NULL THEN
+			UPDATE rooms SET is_occupied = FALSE WHERE room_number = p_room_number;
+		ELSE
+			UPDATE doctors SET is_busy = FALSE, busy_from = NULL, busy_till = NULL WHERE doctor_id = p_doctor_id;
+		END IF;
+		-- Enough is kept with the entry for the dispatcher to admit it later (admit_from_queue).
+		INSERT INTO queue(patient_id, priority_score, type_of_room, department, bed_priority, block_duration)
+		VALUES (p_patient_id, p_priority, p_room_type, p_department,
+				COALESCE(p_bed_priority, ARRAY[p_room_type]), p_block_duration);
+		RETURN 'Queued';
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION allocate_case(p_patient_id BIGINT, p_dept VARCHAR, p_bed_priority room_type[],
+										 p_duration INTERVAL, p_priority NUMERIC)
+	RETURNS TABLE(outcome TEXT, doctor_id INT, doctor_name VARCHAR, room_number INT, room_kind room_type,
+				  busy_from TIMESTAMP, busy_till TIMESTAMP) AS
+	$$
+	DECLARE
+		doc doctors%ROWTYPE;
+		room rooms%ROWTYPE;
+	BEGIN
+		SELECT * INTO doc FROM claim_doctor(p_dept, p_duration);
+		SELECT * INTO room FROM claim_room(p_bed_priority);
+		outcome := resolve_case(p_patient_id, doc.doctor_id, room.room_number,
+								COALESCE(room.type, p_bed_priority[1]), p_priority,
+								p_dept, p_bed_priority, p_duration);
+		-- On 'Queued' the claimed half has already been released again; it is
+		-- still reported so callers can tell which resource was missing.
+		doctor_name := doc.name;
+		doctor_id := doc.doctor_id;
+		room_number := room.room_number;
+		room_kind := room.type;
+		busy_from := doc.busy_from;
+		busy_till := doc.busy_till;
+		RETURN NEXT;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Release and queue events for the dispatcher (dispatcher.py), delivered on
+-- commit. A release is any doctor/room going from in use to free, whether by
+-- release_case_trigger, expire_doctors() or resolve_case() handing back a claim.
+CREATE OR REPLACE FUNCTION notify_doctor_release()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		PERFORM pg_notify('shmas_release', json_build_object(
+			'kind', 'doctor', 'id', NEW.doctor_id, 'category', NEW.specialist)::TEXT);
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_room_release()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		PERFORM pg_notify('shmas_release', json_build_object(
+			'kind', 'room', 'id', NEW.room_number, 'category', NEW.type)::TEXT);
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_queue_change()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		PERFORM pg_notify('shmas_queue', json_build_object(
+			'op', TG_OP, 'row', row_to_json(CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END))::TEXT);
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER doctors_release_notify_trigger
+	AFTER UPDATE OF is_busy ON doctors
+	FOR EACH ROW
+	WHEN (OLD.is_busy IS TRUE AND NEW.is_busy IS NOT TRUE)
+	EXECUTE FUNCTION notify_doctor_release();
+
+CREATE OR REPLACE TRIGGER rooms_release_notify_trigger
+	AFTER UPDATE OF is_occupied ON rooms
+	FOR EACH ROW
+	WHEN (OLD.is_occupied IS TRUE AND NEW.is_occupied IS NOT TRUE)
+	EXECUTE FUNCTION notify_room_release();
+
+CREATE OR REPLACE TRIGGER queue_notify_trigger
+	AFTER INSERT OR DELETE ON queue
+	FOR EACH ROW
+	EXECUTE FUNCTION notify_queue_change();
+
+-- Admits one queued patient if a doctor and a bed can both be claimed right
+-- now. A partial claim is undone by rolling back to the block's savepoint, so
+-- it neither fires release events nor moves the counters.
+CREATE OR REPLACE FUNCTION admit_from_queue(p_patient_id BIGINT)
+	RETURNS TABLE(outcome TEXT, doctor_id INT, room_number INT, waited DOUBLE PRECISION) AS
+	$$
+	DECLARE
+		q queue%ROWTYPE;
+		doc doctors%ROWTYPE;
+		room rooms%ROWTYPE;
+	BEGIN
+		SELECT * INTO q FROM queue WHERE queue.patient_id = p_patient_id LIMIT 1 FOR UPDATE SKIP LOCKED;
+		IF NOT FOUND THEN
+			outcome := 'Gone';
+			RETURN NEXT;
+			RETURN;
+		END IF;
+		BEGIN
+			SELECT * INTO doc FROM claim_doctor(q.department, COALESCE(q.block_duration, INTERVAL '1 minute'));
+			SELECT * INTO room FROM claim_room(q.bed_priority);
+			IF doc.doctor_id IS NULL OR room.room_number IS NULL THEN
+				RAISE EXCEPTION 'partial claim';
+			END IF;
+		EXCEPTION WHEN raise_exception THEN
+			outcome := 'Waiting';
+			RETURN NEXT;
+			RETURN;
+		END;
+		INSERT INTO ongoing_cases(patient_id, doctor_id, room_number)
+		VALUES (p_patient_id, doc.doctor_id, room.room_number);
+		DELETE FROM queue WHERE queue.patient_id = p_patient_id;
+		outcome := 'Admitted';
+		doctor_id := doc.doctor_id;
+		room_number := room.room_number;
+		waited := EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - q.queued_at);
+		RETURN NEXT;
+	END;
+	$$ LANGUAGE plpgsql;
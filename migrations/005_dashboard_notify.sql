@@ -0,0 +1,56 @@
+-- Dashboard change feed for existing databases; fresh installs get the same
+-- objects from hospitals_db.sql.
+
+-- Row-level change feed for the dashboard's live view (live_status.py). One
+-- listener per server process applies these as diffs, so open dashboards
+-- cost no queries of their own.
+CREATE OR REPLACE FUNCTION notify_dashboard_change()
+	RETURNS TRIGGER AS
+	$$
+	BEGIN
+		PERFORM pg_notify('shmas_dashboard', json_build_object(
+			'table', TG_TABLE_NAME, 'op', TG_OP,
+			'old', CASE WHEN TG_OP <> 'INSERT' THEN row_to_json(OLD) END,
+			'new', CASE WHEN TG_OP <> 'DELETE' THEN row_to_json(NEW) END)::TEXT);
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Cases also carry the patient's name, which the doctor cards show.
+CREATE OR REPLACE FUNCTION notify_dashboard_case_change()
+	RETURNS TRIGGER AS
+	$$
+	DECLARE
+		name VARCHAR;
+	BEGIN
+		IF TG_OP <> 'DELETE' THEN
+			SELECT patient_name INTO name FROM patient_info WHERE patient_id = NEW.patient_id;
+		END IF;
+		PERFORM pg_notify('shmas_dashboard', json_build_object(
+			'table', TG_TABLE_NAME, 'op', TG_OP,
+			'old', CASE WHEN TG_OP <> 'INSERT' THEN row_to_json(OLD) END,
+			'new', CASE WHEN TG_OP <> 'DELETE' THEN row_to_json(NEW) END,
+			'patient_name', name)::TEXT);
+		RETURN NULL;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER doctors_dashboard_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON doctors
+	FOR EACH ROW
+	EXECUTE FUNCTION notify_dashboard_change();
+
+CREATE OR REPLACE TRIGGER rooms_dashboard_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON rooms
+	FOR EACH ROW
+	EXECUTE FUNCTION notify_dashboard_change();
+
+CREATE OR REPLACE TRIGGER queue_dashboard_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON queue
+	FOR EACH ROW
+	EXECUTE FUNCTION notify_dashboard_change();
+
+CREATE OR REPLACE TRIGGER ongoing_cases_dashboard_trigger
+	AFTER INSERT OR UPDATE OR DELETE ON ongoing_cases
+	FOR EACH ROW
+	EXECUTE FUNCTION notify_dashboard_case_change();
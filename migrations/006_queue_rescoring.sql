@@ -0,0 +1,99 @@
+-- Queue re-scoring for existing databases; fresh installs get the same objects
+-- from hospitals_db.sql. Queue rows keep the calculate_priority() inputs
+-- patient_info lacks, so resolve_case() and allocate_case() gain parameters
+-- and their old overloads are dropped first. Rows queued before this
+-- migration have no inputs and keep their original score.
+
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS triage_level SMALLINT;
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS age SMALLINT;
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS symptom_hours DOUBLE PRECISION;
+
+DROP FUNCTION IF EXISTS allocate_case(BIGINT, VARCHAR, room_type[], INTERVAL, NUMERIC);
+DROP FUNCTION IF EXISTS resolve_case(BIGINT, INT, INT, room_type, NUMERIC, VARCHAR, room_type[], INTERVAL);
+
+-- Turns the outcome of the two claims into a case or a queue entry, handing
+-- back whichever half was claimed if the other half failed.
+CREATE OR REPLACE FUNCTION resolve_case(p_patient_id BIGINT, p_doctor_id INT, p_room_number INT,
+										p_room_type room_type, p_priority NUMERIC, p_department VARCHAR DEFAULT NULL,
+										p_bed_priority room_type[] DEFAULT NULL, p_block_duration INTERVAL DEFAULT NULL,
+										p_triage_level SMALLINT DEFAULT NULL, p_age SMALLINT DEFAULT NULL,
+										p_symptom_hours DOUBLE PRECISION DEFAULT NULL)
+	RETURNS TEXT AS
+	$$
+	BEGIN
+		IF p_doctor_id IS NOT NULL AND p_room_number IS NOT NULL THEN
+			INSERT INTO ongoing_cases(patient_id, doctor_id, room_number)
+			VALUES (p_patient_id, p_doctor_id, p_room_number);
+			RETURN 'Admitted';
+		ELSIF p_doctor_id IS NULL AND p_room_number IS NULL THEN
+			RETURN 'Diverted';
+		END IF;
+
+		IF p_room_number IS NOT NULL THEN
+			UPDATE rooms SET is_occupied = FALSE WHERE room_number = p_room_number;
+		ELSE
+			UPDATE doctors SET is_busy = FALSE, busy_from = NULL, busy_till = NULL WHERE doctor_id = p_doctor_id;
+		END IF;
+		-- Enough is kept with the entry for the dispatcher to admit it later (admit_from_queue).
+		INSERT INTO queue(patient_id, priority_score, type_of_room, department, bed_priority, block_duration,
+						  triage_level, age, symptom_hours)
+		VALUES (p_patient_id, p_priority, p_room_type, p_department,
+				COALESCE(p_bed_priority, ARRAY[p_room_type]), p_block_duration,
+				p_triage_level, p_age, p_symptom_hours);
+		RETURN 'Queued';
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION allocate_case(p_patient_id BIGINT, p_dept VARCHAR, p_bed_priority room_type[],
+										 p_duration INTERVAL, p_priority NUMERIC, p_triage_level SMALLINT DEFAULT NULL,
+										 p_age SMALLINT DEFAULT NULL, p_symptom_hours DOUBLE PRECISION DEFAULT NULL)
+	RETURNS TABLE(outcome TEXT, doctor_id INT, doctor_name VARCHAR, room_number INT, room_kind room_type,
+				  busy_from TIMESTAMP, busy_till TIMESTAMP) AS
+	$$
+	DECLARE
+		doc doctors%ROWTYPE;
+		room rooms%ROWTYPE;
+	BEGIN
+		SELECT * INTO doc FROM claim_doctor(p_dept, p_duration);
+		SELECT * INTO room FROM claim_room(p_bed_priority);
+		outcome := resolve_case(p_patient_id, doc.doctor_id, room.room_number,
+								COALESCE(room.type, p_bed_priority[1]), p_priority,
+								p_dept, p_bed_priority, p_duration, p_triage_level, p_age, p_symptom_hours);
+		-- On 'Queued' the claimed half has already been released again; it is
+		-- still reported so callers can tell which resource was missing.
+		doctor_name := doc.name;
+		doctor_id := doc.doctor_id;
+		room_number := room.room_number;
+		room_kind := room.type;
+		busy_from := doc.busy_from;
+		busy_till := doc.busy_till;
+		RETURN NEXT;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Score-only updates come from rescore_queue() in bulk and are announced once, not per row.
+CREATE OR REPLACE TRIGGER queue_dashboard_trigger
+	AFTER INSERT OR DELETE OR UPDATE OF patient_id, type_of_room, department, bed_priority ON queue
+	FOR EACH ROW
+	EXECUTE FUNCTION notify_dashboard_change();
+
+-- Writes back the scores rescoring.py computed for the whole queue in one
+-- statement, touching only rows whose score moved, then tells the dispatcher
+-- and the dashboard once that the order changed.
+CREATE OR REPLACE FUNCTION rescore_queue(p_patient_ids BIGINT[], p_scores NUMERIC[])
+	RETURNS INT AS
+	$$
+	DECLARE
+		changed INT;
+	BEGIN
+		UPDATE queue q SET priority_score = s.score
+		FROM unnest(p_patient_ids, p_scores) AS s(patient_id, score)
+		WHERE q.patient_id = s.patient_id AND q.priority_score IS DISTINCT FROM s.score;
+		GET DIAGNOSTICS changed = ROW_COUNT;
+		IF changed > 0 THEN
+			PERFORM pg_notify('shmas_queue', json_build_object('op', 'RERANK', 'changed', changed)::TEXT);
+			PERFORM pg_notify('shmas_dashboard', json_build_object('table', 'queue', 'op', 'RERANK')::TEXT);
+		END IF;
+		RETURN changed;
+	END;
+	$$ LANGUAGE plpgsql;
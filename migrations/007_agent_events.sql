@@ -0,0 +1,21 @@
+-- Agent event journal for existing databases; fresh installs get the same
+-- objects from hospitals_db.sql.
+
+-- Append-only audit trail of agent events, written in batches by journal.py.
+-- mono_ns is the writing process's monotonic clock, which orders events
+-- within a process; logged_at is the same instant on the wall clock.
+CREATE TABLE IF NOT EXISTS agent_events (
+	event_id BIGSERIAL PRIMARY KEY,
+	logged_at TIMESTAMPTZ NOT NULL,
+	mono_ns BIGINT NOT NULL,
+	patient_id BIGINT,
+	agent VARCHAR(40) NOT NULL,
+	outcome VARCHAR(20),
+	kind VARCHAR(40) NOT NULL,
+	payload JSONB
+);
+
+-- Rows arrive in time order, so a BRIN index covers time-range scans at a
+-- fraction of a btree's size and insert cost.
+CREATE INDEX IF NOT EXISTS agent_events_patient_idx ON agent_events (patient_id, logged_at);
+CREATE INDEX IF NOT EXISTS agent_events_logged_at_idx ON agent_events USING BRIN (logged_at);
@@ -0,0 +1,195 @@
+-- Speculative holds for existing databases; fresh installs get the same
+-- objects from hospitals_db.sql. resolve_case() settles a patient's holds,
+-- allocate_case() uses them, and the orphaned-room sweep leaves held beds alone.
+
+-- Speculative holds (speculation.py): a doctor or bed claimed for a patient
+-- whose triage is still running. The resource is marked busy like any other
+-- claim; the hold row records whose it is and until when.
+CREATE TABLE IF NOT EXISTS resource_holds (
+	kind VARCHAR(10) NOT NULL,
+	resource_id INT NOT NULL,
+	patient_id BIGINT NOT NULL,
+	expires_at TIMESTAMP NOT NULL,
+	PRIMARY KEY (kind, resource_id)
+);
+CREATE INDEX IF NOT EXISTS resource_holds_patient_idx ON resource_holds (patient_id);
+CREATE INDEX IF NOT EXISTS resource_holds_expires_idx ON resource_holds (expires_at);
+
+-- Speculative holds. hold_resources() claims a doctor and a bed of the
+-- preferred type the way an admission would, but only for p_ttl; the held
+-- doctor's busy_till is the hold's expiry, so the expiry worker wakes for it
+-- and expire_holds() hands back whatever wasn't settled in time.
+-- settle_holds() runs inside resolve_case(): the held resources the case uses
+-- are kept (the doctor's block starting now), the others are released.
+CREATE OR REPLACE FUNCTION hold_resources(p_patient_id BIGINT, p_dept VARCHAR, p_room_type room_type, p_ttl INTERVAL)
+	RETURNS TABLE(doctor_id INT, doctor_name VARCHAR, specialist VARCHAR, busy_from TIMESTAMP,
+				  room_number INT, room_kind room_type) AS
+	$$
+	DECLARE
+		doc doctors%ROWTYPE;
+		room rooms%ROWTYPE;
+	BEGIN
+		IF p_dept IS NOT NULL THEN
+			SELECT * INTO doc FROM claim_doctor(p_dept, p_ttl);
+		END IF;
+		SELECT * INTO room FROM claim_room(ARRAY[p_room_type]);
+		INSERT INTO resource_holds(kind, resource_id, patient_id, expires_at)
+		SELECT h.kind, h.resource_id, p_patient_id, CURRENT_TIMESTAMP + p_ttl
+		FROM (VALUES ('doctor', doc.doctor_id), ('room', room.room_number)) AS h(kind, resource_id)
+		WHERE h.resource_id IS NOT NULL;
+		doctor_id := doc.doctor_id;
+		doctor_name := doc.name;
+		specialist := doc.specialist;
+		busy_from := doc.busy_from;
+		room_number := room.room_number;
+		room_kind := room.type;
+		RETURN NEXT;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION settle_holds(p_patient_id BIGINT, p_doctor_id INT DEFAULT NULL,
+										p_room_number INT DEFAULT NULL, p_block_duration INTERVAL DEFAULT NULL)
+	RETURNS INT AS
+	$$
+	DECLARE
+		held RECORD;
+		released INT := 0;
+	BEGIN
+		-- Doctor before room, the order everything else locks them in.
+		FOR held IN
+			WITH settled AS (
+				DELETE FROM resource_holds h WHERE h.patient_id = p_patient_id
+				RETURNING h.kind, h.resource_id
+			)
+			SELECT * FROM settled ORDER BY kind
+		LOOP
+			IF held.kind = 'doctor' AND held.resource_id = p_doctor_id THEN
+				UPDATE doctors SET busy_from = CURRENT_TIMESTAMP,
+								   busy_till = CURRENT_TIMESTAMP + COALESCE(p_block_duration, INTERVAL '1 minute')
+				WHERE doctors.doctor_id = held.resource_id;
+			ELSIF held.kind = 'doctor' THEN
+				UPDATE doctors SET is_busy = FALSE, busy_from = NULL, busy_till = NULL
+				WHERE doctors.doctor_id = held.resource_id;
+				released := released + 1;
+			ELSIF held.resource_id IS DISTINCT FROM p_room_number THEN
+				UPDATE rooms SET is_occupied = FALSE WHERE rooms.room_number = held.resource_id;
+				released := released + 1;
+			END IF;
+		END LOOP;
+		RETURN released;
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION expire_holds()
+	RETURNS TABLE(kind VARCHAR, resource_id INT) AS
+	$$
+	BEGIN
+		RETURN QUERY
+		WITH expired AS (
+			DELETE FROM resource_holds h WHERE h.expires_at <= CURRENT_TIMESTAMP
+			RETURNING h.kind, h.resource_id
+		), doctors_released AS (
+			UPDATE doctors d SET is_busy = FALSE, busy_from = NULL, busy_till = NULL
+			FROM expired e WHERE e.kind = 'doctor' AND d.doctor_id = e.resource_id
+		), rooms_released AS (
+			UPDATE rooms r SET is_occupied = FALSE
+			FROM expired e WHERE e.kind = 'room' AND r.room_number = e.resource_id
+		)
+		SELECT e.kind, e.resource_id FROM expired e;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Turns the outcome of the two claims into a case or a queue entry, handing
+-- back whichever half was claimed if the other half failed.
+CREATE OR REPLACE FUNCTION resolve_case(p_patient_id BIGINT, p_doctor_id INT, p_room_number INT,
+										p_room_type room_type, p_priority NUMERIC, p_department VARCHAR DEFAULT NULL,
+										p_bed_priority room_type[] DEFAULT NULL, p_block_duration INTERVAL DEFAULT NULL,
+										p_triage_level SMALLINT DEFAULT NULL, p_age SMALLINT DEFAULT NULL,
+										p_symptom_hours DOUBLE PRECISION DEFAULT NULL)
+	RETURNS TEXT AS
+	$$
+	BEGIN
+		PERFORM settle_holds(p_patient_id, p_doctor_id, p_room_number, p_block_duration);
+		IF p_doctor_id IS NOT NULL AND p_room_number IS NOT NULL THEN
+			INSERT INTO ongoing_cases(patient_id, doctor_id, room_number)
+			VALUES (p_patient_id, p_doctor_id, p_room_number);
+			RETURN 'Admitted';
+		ELSIF p_doctor_id IS NULL AND p_room_number IS NULL THEN
+			RETURN 'Diverted';
+		END IF;
+
+		IF p_room_number IS NOT NULL THEN
+			UPDATE rooms SET is_occupied = FALSE WHERE room_number = p_room_number;
+		ELSE
+			UPDATE doctors SET is_busy = FALSE, busy_from = NULL, busy_till = NULL WHERE doctor_id = p_doctor_id;
+		END IF;
+		-- Enough is kept with the entry for the dispatcher to admit it later (admit_from_queue).
+		INSERT INTO queue(patient_id, priority_score, type_of_room, department, bed_priority, block_duration,
+						  triage_level, age, symptom_hours)
+		VALUES (p_patient_id, p_priority, p_room_type, p_department,
+				COALESCE(p_bed_priority, ARRAY[p_room_type]), p_block_duration,
+				p_triage_level, p_age, p_symptom_hours);
+		RETURN 'Queued';
+	END;
+	$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION allocate_case(p_patient_id BIGINT, p_dept VARCHAR, p_bed_priority room_type[],
+										 p_duration INTERVAL, p_priority NUMERIC, p_triage_level SMALLINT DEFAULT NULL,
+										 p_age SMALLINT DEFAULT NULL, p_symptom_hours DOUBLE PRECISION DEFAULT NULL)
+	RETURNS TABLE(outcome TEXT, doctor_id INT, doctor_name VARCHAR, room_number INT, room_kind room_type,
+				  busy_from TIMESTAMP, busy_till TIMESTAMP) AS
+	$$
+	DECLARE
+		doc doctors%ROWTYPE;
+		room rooms%ROWTYPE;
+		held_doctor BOOLEAN;
+	BEGIN
+		-- A speculative hold is used when it is what this admission wants; the
+		-- hold row is locked so expire_holds() can't release it meanwhile.
+		SELECT d.* INTO doc FROM resource_holds h JOIN doctors d ON d.doctor_id = h.resource_id
+		WHERE h.patient_id = p_patient_id AND h.kind = 'doctor' AND d.specialist = p_dept
+		FOR UPDATE OF h;
+		held_doctor := FOUND;
+		IF NOT held_doctor THEN
+			SELECT * INTO doc FROM claim_doctor(p_dept, p_duration);
+		END IF;
+		SELECT r.* INTO room FROM resource_holds h JOIN rooms r ON r.room_number = h.resource_id
+		WHERE h.patient_id = p_patient_id AND h.kind = 'room' AND r.type = p_bed_priority[1]
+		FOR UPDATE OF h;
+		IF NOT FOUND THEN
+			SELECT * INTO room FROM claim_room(p_bed_priority);
+		END IF;
+		outcome := resolve_case(p_patient_id, doc.doctor_id, room.room_number,
+								COALESCE(room.type, p_bed_priority[1]), p_priority,
+								p_dept, p_bed_priority, p_duration, p_triage_level, p_age, p_symptom_hours);
+		IF held_doctor THEN
+			-- resolve_case() started the held doctor's block just now.
+			SELECT * INTO doc FROM doctors d WHERE d.doctor_id = doc.doctor_id;
+		END IF;
+		-- On 'Queued' the claimed half has already been released again; it is
+		-- still reported so callers can tell which resource was missing.
+		doctor_name := doc.name;
+		doctor_id := doc.doctor_id;
+		room_number := room.room_number;
+		room_kind := room.type;
+		busy_from := doc.busy_from;
+		busy_till := doc.busy_till;
+		RETURN NEXT;
+	END;
+	$$ LANGUAGE plpgsql;
+
+-- Frees occupied rooms that no ongoing case or hold refers to, but only among
+-- the candidates passed in; the worker passes rooms it already saw orphaned on
+-- its previous sweep so a bed claimed by an in-flight admission is left alone.
+CREATE OR REPLACE FUNCTION release_orphaned_rooms(p_candidates INT[])
+	RETURNS SETOF INT AS
+	$$
+	BEGIN
+		RETURN QUERY
+		UPDATE rooms r SET is_occupied = FALSE
+		WHERE r.room_number = ANY(p_candidates) AND r.is_occupied = TRUE
+		  AND NOT EXISTS (SELECT 1 FROM ongoing_cases oc WHERE oc.room_number = r.room_number)
+		  AND NOT EXISTS (SELECT 1 FROM resource_holds h WHERE h.kind = 'room' AND h.resource_id = r.room_number)
+		RETURNING r.room_number;
+	END;
+	$$ LANGUAGE plpgsql;
@@ -0,0 +1,229 @@
+"""Batch re-scoring of the waiting queue.
+
+A queue entry's priority_score is calculate_priority() at the moment the
+patient was queued, but symptom_duration keeps growing while they wait. The
+rescorer recomputes the same formula over the whole queue as NumPy arrays and
+writes back only the scores that moved, with one rescore_queue() call. That
+raises a single RERANK event, on which the dispatcher and the dashboard view
+reload the queue.
+
+Everything but the time waited is fixed once a patient is queued, so the
+triage/age/vitals part of the score is computed once per patient and kept
+as columns; a pass only reads which patients are still waiting, as one
+packed binary column, and the database clock.
+
+Runs inside the dashboard process via start_queue_rescorer(), or standalone:
+
+    python -m rescoring
+    python -m rescoring --once
+"""
+import os, time, threading, argparse
+from logging import debug
+from db import db_cursor
+from config import configure_logging
+from metrics import span
+
+# Only rows queued with their inputs (see priority_inputs in agents.py) are
+# re-scored. Ids come back packed as one big-endian int8 string, which NumPy
+# reads without a Python object per row; times are on the database clock.
+QUEUED_QUERY = """
+    SELECT EXTRACT(EPOCH FROM LOCALTIMESTAMP)::float8, string_agg(int8send(patient_id), '')
+    FROM queue
+    WHERE symptom_hours IS NOT NULL AND age IS NOT NULL;
+    """
+INPUTS_QUERY = """
+    SELECT q.patient_id, q.priority_score::float8, q.symptom_hours, EXTRACT(EPOCH FROM q.queued_at)::float8,
+           COALESCE(q.triage_level, 0), q.age,
+           COALESCE((p.vitals->>'heart_rate')::float8, 80),
+           COALESCE((p.vitals->'blood_pressure'->>'systolic')::float8, 120),
+           COALESCE((p.vitals->'blood_pressure'->>'diastolic')::float8, 80)
+    FROM queue q
+    LEFT JOIN patient_info p ON p.patient_id = q.patient_id
+    WHERE q.patient_id = ANY(%s::bigint[]);
+    """
+RESCORE_QUERY = "SELECT rescore_queue(%s::bigint[], %s::numeric[]);"
+RETRY_DELAY = 5.0
+
+def base_scores(triage_level, age, heart_rate, systolic, diastolic):
+    """The part of Patient.calculate_priority that doesn't change while waiting, over arrays."""
+    import numpy as np
+    triage_level, age, heart_rate, systolic, diastolic = (
+        np.asarray(column, dtype=np.float64) for column in (triage_level, age, heart_rate, systolic, diastolic))
+    age_score = np.where(age >= 50, 8.0, np.where(age < 15, 5.0, 0.0))
+    hr_dev = np.maximum(np.maximum(heart_rate - 100, 60 - heart_rate), 0)
+    bp_sys_dev = np.where((systolic > 140) | (systolic < 90), np.abs(systolic - 120), 0)
+    bp_dia_dev = np.where((diastolic > 90) | (diastolic < 60), np.abs(diastolic - 80), 0)
+    vital_score = (hr_dev + bp_sys_dev + bp_dia_dev) * 0.7
+    return triage_level * 10 + age_score + vital_score
+
+def finish_scores(base, symptom_hours):
+    import numpy as np
+    scores = base + np.asarray(symptom_hours, dtype=np.float64) * 0.2
+    # np.round() rounds the scaled binary value and disagrees with round() on some ties.
+    return [round(score, 1) for score in scores.tolist()]
+
+def score_priorities(triage_level, age, heart_rate, systolic, diastolic, symptom_hours):
+    """Patient.calculate_priority over arrays; returns a list of floats.
+
+    Operations are done in the same order and in float64, and the final
+    rounding is Python's round(), so every score equals what
+    calculate_priority() gives for the same inputs.
+    """
+    return finish_scores(base_scores(triage_level, age, heart_rate, systolic, diastolic), symptom_hours)
+
+def _array_literal(values):
+    # Much cheaper than letting psycopg2 adapt a long list element by element.
+    return "{" + ",".join(map(str, values)) + "}"
+
+class QueueRescorer:
+    def __init__(self, interval=None):
+        self.interval = interval or float(os.getenv("SHMAS_RESCORE_INTERVAL", "60"))
+        self._lock = threading.Lock()
+        self._pass_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        # One entry per waiting patient, sorted by patient_id: the fixed part
+        # of the score, symptom hours and queue time, and the score last seen.
+        self._columns = None
+        self._stats = {"passes": 0, "rescored": 0, "changed": 0, "loaded": 0, "errors": 0,
+                       "last_seconds": None, "max_seconds": 0.0}
+
+    def _load_inputs(self, cursor, patient_ids):
+        import numpy as np
+        cursor.execute(INPUTS_QUERY, (_array_literal(patient_ids.tolist()),))
+        rows = sorted(cursor.fetchall())
+        if not rows:
+            return {"patient_id": np.empty(0, dtype=np.int64), "base": np.empty(0), "symptom_hours": np.empty(0),
+                    "queued_at": np.empty(0), "score": np.empty(0)}
+        patient_id, score, symptom_hours, queued_at, triage_level, age, heart_rate, systolic, diastolic = zip(*rows)
+        return {"patient_id": np.array(patient_id, dtype=np.int64),
+                "base": base_scores(triage_level, age, heart_rate, systolic, diastolic),
+                "symptom_hours": np.array(symptom_hours, dtype=np.float64),
+                "queued_at": np.array(queued_at, dtype=np.float64),
+                "score": np.array(score, dtype=np.float64)}
+
+    def _refresh(self, cursor, patient_ids):
+        # Keeps the cached rows of patients still waiting and loads the inputs of newly queued ones.
+        import numpy as np
+        columns = self._columns
+        if columns is None or not len(columns["patient_id"]):
+            loaded = self._load_inputs(cursor, patient_ids)
+            self._columns = loaded
+            return len(loaded["patient_id"])
+        position = np.minimum(np.searchsorted(columns["patient_id"], patient_ids), len(columns["patient_id"]) - 1)
+        known = columns["patient_id"][position] == patient_ids
+        kept = {name: column[position[known]] for name, column in columns.items()}
+        loaded = self._load_inputs(cursor, patient_ids[~known]) if not known.all() else None
+        if loaded is not None and len(loaded["patient_id"]):
+            merged = {name: np.concatenate((kept[name], loaded[name])) for name in kept}
+            order = np.argsort(merged["patient_id"], kind="stable")
+            kept = {name: column[order] for name, column in merged.items()}
+        self._columns = kept
+        return len(loaded["patient_id"]) if loaded is not None else 0
+
+    def run_once(self):
+        """Re-scores the whole queue now; returns (patients scored, scores changed)."""
+        import numpy as np
+        started = time.perf_counter()
+        with self._pass_lock, span("rescore", "queue") as fields:
+            with db_cursor() as cursor:
+                cursor.execute(QUEUED_QUERY)
+                now, packed = cursor.fetchone()
+                patient_ids = np.sort(np.frombuffer(packed or b"", dtype=">i8")).astype(np.int64)
+                loaded = self._refresh(cursor, patient_ids)
+                columns = self._columns
+                symptom_hours = columns["symptom_hours"] + (now - columns["queued_at"]) / 3600
+                scores = np.array(finish_scores(columns["base"], symptom_hours))
+                moved = scores != columns["score"]
+                changed = 0
+                if moved.any():
+                    cursor.execute(RESCORE_QUERY, (_array_literal(columns["patient_id"][moved].tolist()),
+                                                   _array_literal(scores[moved].tolist())))
+                    changed = cursor.fetchone()[0]
+                    columns["score"] = scores
+            rows = len(scores)
+            fields.update(rows=rows, loaded=loaded, changed=changed)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._stats["passes"] += 1
+            self._stats["rescored"] += rows
+            self._stats["loaded"] += loaded
+            self._stats["changed"] += changed
+            self._stats["last_seconds"] = elapsed
+            self._stats["max_seconds"] = max(self._stats["max_seconds"], elapsed)
+        if changed:
+            debug(f"Rescorer updated {changed} of {rows} queued patients in {elapsed * 1000:.1f}ms...")
+        return rows, changed
+
+    def request(self):
+        # Re-rank now instead of at the next tick, e.g. after a bulk import into the queue.
+        self._wake.set()
+
+    def run(self):
+        debug("Queue rescorer started...")
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+                timeout = self.interval
+            except Exception as e:
+                with self._lock:
+                    self._stats["errors"] += 1
+                debug(f"Queue re-scoring failed, retrying in {RETRY_DELAY}s...\n{e}")
+                timeout = RETRY_DELAY
+            self._wake.wait(timeout)
+            self._wake.clear()
+        debug("Queue rescorer stopped...")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name="shmas-rescorer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+_rescorer = None
+_rescorer_lock = threading.Lock()
+
+def start_queue_rescorer(**kwargs):
+    global _rescorer
+    with _rescorer_lock:
+        if _rescorer is None:
+            _rescorer = QueueRescorer(**kwargs)
+        return _rescorer.start()
+
+def stop_queue_rescorer():
+    global _rescorer
+    with _rescorer_lock:
+        if _rescorer is not None:
+            _rescorer.stop()
+            _rescorer = None
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score waiting patients as their symptom duration grows.")
+    parser.add_argument("--interval", type=float, default=None, help="seconds between re-rankings")
+    parser.add_argument("--once", action="store_true", help="re-rank the queue now and exit")
+    args = parser.parse_args()
+    configure_logging()
+
+    rescorer = QueueRescorer(interval=args.interval)
+    if args.once:
+        print(rescorer.run_once())
+        return
+    try:
+        rescorer.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
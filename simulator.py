@@ -0,0 +1,296 @@
+"""Offline discrete-event simulation of admissions for capacity planning.
+
+Replays patient arrivals (synthetic, or a JSONL file of real ones) against a
+staffing configuration without a database or LLM, using the same policy
+pieces the live system runs:
+
+- Patient.calculate_priority scores every arrival;
+- get_block_duration is how long a doctor stays blocked;
+- get_bed_priority gives the bed fallback order claim_room walks;
+- resolve_case's outcomes: both claimed -> admitted, one claimed -> the
+  other is handed back and the patient queued, neither -> diverted ("try
+  nearby hospitals");
+- the dispatcher's queue: a released doctor or bed goes to the
+  highest-priority queued patient who can use it, trying at most
+  ``max_attempts`` of them and admitting at most one per release.
+
+Doctors and beds are interchangeable within a specialty / room type, so the
+state is just free counts, and the core is one heap of timestamped events.
+Beds stay occupied for a log-normal length of stay, since in the live system
+that ends with discharge rather than with the doctor's block.
+
+    python -m simulator --days 30 --per-hour 2000 --doctors 400 --rooms 1500
+    python -m simulator --arrivals arrivals.jsonl --doctors Cardiology=20,Neurology=12 --rooms ICU=30,Ward=200
+"""
+import json, heapq, random, argparse, itertools
+from collections import namedtuple
+from agents import Patient, get_block_duration, get_bed_priority
+
+DEPARTMENTS = ["Cardiology", "Pediatrics", "Neurology", "Dentist"]
+ROOM_TYPES = ["Emergency", "ICU", "Ward", "Normal"]
+TRIAGE_MIX = {1: 0.25, 2: 0.3, 3: 0.25, 4: 0.12, 5: 0.08}
+WAIT_BUCKETS = (0, 1, 5, 15, 30, 60, 120, 240, 480, 1440)
+
+DOCTOR_FREE, BED_FREE = 0, 1
+
+class SimPatient:
+    """Just the fields Patient.calculate_priority reads, without Patient's per-instance setup."""
+    __slots__ = ("arrival", "triage_level", "department", "age", "vitals", "symptom_duration", "priority_score")
+
+    def __init__(self, arrival, triage_level, department, age, vitals, symptom_duration):
+        self.arrival = arrival
+        self.triage_level = triage_level
+        self.department = department
+        self.age = age
+        self.vitals = vitals
+        self.symptom_duration = symptom_duration
+        self.priority_score = 0.0
+
+    calculate_priority = Patient.calculate_priority
+
+Waiting = namedtuple("Waiting", ["patient", "bed_types", "seq"])
+
+def parse_staffing(value, categories):
+    """``"40"`` spreads 40 evenly over ``categories``; ``"ICU=10,Ward=30"`` is explicit."""
+    if "=" not in value:
+        total = int(value)
+        return {c: total // len(categories) + (i < total % len(categories)) for i, c in enumerate(categories)}
+    staffing = {c: 0 for c in categories}
+    for part in value.split(","):
+        name, count = part.split("=")
+        staffing[name.strip()] = int(count)
+    return staffing
+
+def synthetic_arrivals(hours, per_hour, diurnal=0.0, triage_mix=None, department_mix=None, seed=1, chunk=65536):
+    """Poisson arrivals (minutes from the start), optionally swinging by ±``diurnal`` over the day, peak at 14:00.
+
+    Drawn with NumPy a chunk at a time; a month of arrivals is millions of patients.
+    """
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    levels, level_weights = zip(*sorted((triage_mix or TRIAGE_MIX).items()))
+    departments, department_weights = zip(*(department_mix or {d: 1 for d in DEPARTMENTS}).items())
+    level_p = np.array(level_weights, dtype=float) / sum(level_weights)
+    department_p = np.array(department_weights, dtype=float) / sum(department_weights)
+    peak_rate = per_hour * (1 + diurnal) / 60.0
+    t, horizon = 0.0, hours * 60.0
+    while t < horizon:
+        times = t + np.cumsum(rng.exponential(1 / peak_rate, chunk))
+        t = times[-1]
+        times = times[times < horizon]
+        if diurnal:
+            # Thinning: keep an arrival with probability rate(t) / peak rate.
+            rate = 1 + diurnal * np.cos(2 * np.pi * (times / 1440.0 - 14 / 24))
+            times = times[rng.random(len(times)) * (1 + diurnal) <= rate]
+        n = len(times)
+        columns = zip(times.tolist(), rng.choice(levels, n, p=level_p).tolist(),
+                      rng.choice(len(departments), n, p=department_p).tolist(), rng.integers(1, 91, n).tolist(),
+                      rng.normal(88, 18, n).astype(int).tolist(), rng.normal(125, 20, n).astype(int).tolist(),
+                      rng.normal(80, 12, n).astype(int).tolist(), rng.integers(1, 73, n).tolist())
+        for minute, level, department, age, heart_rate, systolic, diastolic, duration in columns:
+            yield SimPatient(minute, level, departments[department], age,
+                             {"heart_rate": heart_rate, "blood_pressure": {"systolic": systolic, "diastolic": diastolic}},
+                             duration)
+
+def load_arrivals(path):
+    """JSONL, one patient per line: ``{"minute": 12.5, "triage_level": 3, "department": "Cardiology",
+    "age": 40, "vitals": {...}, "symptom_duration": 5}``, in arrival order."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                yield SimPatient(float(row["minute"]), int(row["triage_level"]), row["department"],
+                                 row.get("age", 40), row.get("vitals", {}), row.get("symptom_duration", 1))
+
+def distribution(samples, points=(50, 90, 95, 99)):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    result = {"count": len(ordered), "mean": round(sum(ordered) / len(ordered), 2), "max": round(ordered[-1], 2)}
+    for p in points:
+        result[f"p{p}"] = round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))], 2)
+    counts, i = [], 0
+    for bound in WAIT_BUCKETS:
+        j = i
+        while j < len(ordered) and ordered[j] <= bound:
+            j += 1
+        counts.append(j - i)
+        i = j
+    result["histogram_minutes"] = dict(zip([f"<={b}" for b in WAIT_BUCKETS] + [f">{WAIT_BUCKETS[-1]}"],
+                                           counts + [len(ordered) - i]))
+    return result
+
+class HospitalSimulator:
+    def __init__(self, doctors, rooms, max_attempts=3, bed_stay_hours=4.0, bed_stay_sigma=0.8, seed=1):
+        self.doctors = dict(doctors)
+        self.rooms = dict(rooms)
+        self.max_attempts = max_attempts
+        self.bed_stay_minutes = bed_stay_hours * 60.0
+        self.bed_stay_sigma = bed_stay_sigma
+        self.rng = random.Random(seed)
+        # The live policy, looked up once per triage level rather than once per patient.
+        self.block_minutes = {level: get_block_duration(level).total_seconds() / 60.0 for level in range(0, 6)}
+        self.bed_priority = {level: get_bed_priority(level) for level in range(0, 6)}
+
+    def run(self, arrivals, horizon=None):
+        free_doctors = dict(self.doctors)
+        free_beds = dict(self.rooms)
+        busy_doctor_minutes = {d: 0.0 for d in free_doctors}
+        busy_bed_minutes = {r: 0.0 for r in free_beds}
+        events, seq = [], itertools.count()
+        waiting, by_department, by_bed_type = {}, {}, {}
+        waits, queued_waits, waits_by_level = [], [], {}
+        counts = {"arrivals": 0, "admitted_on_arrival": 0, "queued": 0, "admitted_from_queue": 0, "diverted": 0}
+        queue_area, queue_peak, last_t = 0.0, 0, 0.0
+        heappush, heappop = heapq.heappush, heapq.heappop
+        block_minutes, bed_priority = self.block_minutes, self.bed_priority
+        stay_minutes, stay_sigma, lognormvariate = self.bed_stay_minutes, self.bed_stay_sigma, self.rng.lognormvariate
+        limit = float("inf") if horizon is None else horizon
+
+        def admit(patient, bed_type, now):
+            # Both claims succeed together, as in resolve_case / admit_from_queue.
+            free_doctors[patient.department] -= 1
+            free_beds[bed_type] -= 1
+            block = block_minutes[patient.triage_level or 0]
+            stay = max(block, lognormvariate(0, stay_sigma) * stay_minutes)
+            heappush(events, (now + block, next(seq), DOCTOR_FREE, patient.department))
+            heappush(events, (now + stay, next(seq), BED_FREE, bed_type))
+            busy_doctor_minutes[patient.department] += block
+            busy_bed_minutes[bed_type] += stay
+            wait = now - patient.arrival
+            waits.append(wait)
+            waits_by_level.setdefault(patient.triage_level, []).append(wait)
+
+        def free_bed(bed_types):
+            # claim_room's fallback order.
+            for bed_type in bed_types:
+                if free_beds.get(bed_type, 0) > 0:
+                    return bed_type
+            return None
+
+        def dispatch(heap, now):
+            # Top max_attempts live entries, highest priority first; keys of patients already
+            # admitted through another heap are dropped as they surface.
+            tried = []
+            admitted = False
+            while heap and len(tried) < self.max_attempts:
+                key = heappop(heap)
+                entry = waiting.get(key[1])
+                if entry is None:
+                    continue
+                if free_doctors.get(entry.patient.department, 0) > 0:
+                    bed_type = free_bed(entry.bed_types)
+                    if bed_type is not None:
+                        del waiting[key[1]]
+                        admit(entry.patient, bed_type, now)
+                        counts["admitted_from_queue"] += 1
+                        queued_waits.append(now - entry.patient.arrival)
+                        admitted = True
+                        break
+                tried.append(key)
+            for key in tried:
+                heappush(heap, key)
+            return admitted
+
+        # Arrivals come in time order, so they are merged with the event heap rather than pushed through it.
+        arrivals = iter(arrivals)
+        patient = next(arrivals, None)
+        while True:
+            if patient is not None and patient.arrival > limit:
+                patient = None
+            if patient is not None and (not events or patient.arrival <= events[0][0]):
+                now = patient.arrival
+                queue_area += len(waiting) * (now - last_t)
+                last_t = now
+                counts["arrivals"] += 1
+                patient.calculate_priority()
+                bed_types = bed_priority[patient.triage_level or 0]
+                has_doctor = free_doctors.get(patient.department, 0) > 0
+                bed_type = free_bed(bed_types)
+                if has_doctor and bed_type is not None:
+                    admit(patient, bed_type, now)
+                    counts["admitted_on_arrival"] += 1
+                elif has_doctor or bed_type is not None:
+                    entry = Waiting(patient, bed_types, next(seq))
+                    waiting[entry.seq] = entry
+                    key = (-patient.priority_score, entry.seq)
+                    heappush(by_department.setdefault(patient.department, []), key)
+                    for bed_type in bed_types:
+                        heappush(by_bed_type.setdefault(bed_type, []), key)
+                    counts["queued"] += 1
+                    queue_peak = max(queue_peak, len(waiting))
+                else:
+                    counts["diverted"] += 1
+                patient = next(arrivals, None)
+            elif events and events[0][0] <= limit:
+                now, _, kind, category = heappop(events)
+                queue_area += len(waiting) * (now - last_t)
+                last_t = now
+                # Every candidate also needs the other resource; with none free at all the
+                # attempts would all fail, so they are skipped without changing the outcome.
+                if kind == DOCTOR_FREE:
+                    free_doctors[category] += 1
+                    heap = by_department.get(category) if any(free_beds.values()) else None
+                else:
+                    free_beds[category] += 1
+                    heap = by_bed_type.get(category) if any(free_doctors.values()) else None
+                if heap:
+                    dispatch(heap, now)
+            else:
+                break
+
+        end = horizon if horizon is not None else last_t
+        # Busy time was booked whole at admission; take back whatever runs past the end.
+        for t, _, kind, category in events:
+            if t > end:
+                if kind == DOCTOR_FREE:
+                    busy_doctor_minutes[category] -= t - end
+                else:
+                    busy_bed_minutes[category] -= t - end
+        utilization = lambda busy, staff: {k: round(busy[k] / (staff[k] * end), 4) if staff[k] and end else None
+                                           for k in staff}
+        return {
+            "simulated_hours": round(end / 60.0, 2),
+            "counts": dict(counts, still_queued=len(waiting)),
+            "divert_rate": round(counts["diverted"] / counts["arrivals"], 4) if counts["arrivals"] else None,
+            "queue_rate": round(counts["queued"] / counts["arrivals"], 4) if counts["arrivals"] else None,
+            "wait_minutes": distribution(waits),
+            "queued_wait_minutes": distribution(queued_waits),
+            "wait_minutes_by_triage": {level: distribution(samples, points=(50, 95))
+                                       for level, samples in sorted(waits_by_level.items())},
+            "queue_length": {"mean": round(queue_area / end, 2) if end else 0.0, "peak": queue_peak},
+            "doctor_utilization": utilization(busy_doctor_minutes, self.doctors),
+            "bed_utilization": utilization(busy_bed_minutes, self.rooms),
+        }
+
+def main():
+    import time
+    parser = argparse.ArgumentParser(description="Replay patient arrivals against a staffing configuration.")
+    parser.add_argument("--doctors", default="40", help='total, spread evenly, or "Cardiology=12,Neurology=8,..."')
+    parser.add_argument("--rooms", default="80", help='total, spread evenly, or "ICU=10,Ward=40,..."')
+    parser.add_argument("--days", type=float, default=7.0)
+    parser.add_argument("--per-hour", type=float, default=20.0, help="mean arrivals per hour")
+    parser.add_argument("--diurnal", type=float, default=0.0, help="daily swing of the arrival rate, 0-1")
+    parser.add_argument("--arrivals", help="JSONL of arrivals to replay instead of synthetic ones")
+    parser.add_argument("--bed-stay-hours", type=float, default=4.0, help="median bed occupancy")
+    parser.add_argument("--bed-stay-sigma", type=float, default=0.8, help="log-normal shape of bed occupancy")
+    parser.add_argument("--max-attempts", type=int, default=3, help="queued patients tried per release")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    simulator = HospitalSimulator(parse_staffing(args.doctors, DEPARTMENTS), parse_staffing(args.rooms, ROOM_TYPES),
+                                  max_attempts=args.max_attempts, bed_stay_hours=args.bed_stay_hours,
+                                  bed_stay_sigma=args.bed_stay_sigma, seed=args.seed)
+    if args.arrivals:
+        arrivals, horizon = load_arrivals(args.arrivals), None
+    else:
+        arrivals = synthetic_arrivals(args.days * 24, args.per_hour, args.diurnal, seed=args.seed)
+        horizon = args.days * 24 * 60.0
+    started = time.perf_counter()
+    report = simulator.run(arrivals, horizon)
+    report["wall_seconds"] = round(time.perf_counter() - started, 2)
+    report["staffing"] = {"doctors": simulator.doctors, "rooms": simulator.rooms}
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,225 @@
-from langgraph.graph import StateGraph, END
-from agents import *
-import logging
-from logging import debug
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-
-queued_patients = []
-
-# GRAPH DEFINITION
-graph = StateGraph(AgentState)
-graph.add_node("mood", MentalHealthAnalyzerAgent())
-graph.add_node("triage", EmergencyTriageAgent())
-graph.add_node("doctor", DoctorSchedulerAgent())
-graph.add_node("bed", BedManagerAgent())
-graph.add_node("checker", ConflictResolverAgent())
-
-graph.set_entry_point("mood")
-graph.add_edge("mood", "triage")
-graph.add_edge("triage", "doctor")
-graph.add_edge("doctor", "bed")
-graph.add_edge("bed", "checker")
-graph.add_edge("checker", END)
-
-smart_hospital_graph = graph.compile()
-
-# Patient flow simulation
-def run_patient_flow(name, vitals, email, gender, age, symptoms, symptom_duration):
-    patient = Patient(name, vitals, email, gender, age, symptoms, symptom_duration)
-    state = {"patient": patient,
-             "logs": [],
-             "status": {"MoodAnalyzer":"Pending",
-                        "EmergencyTriage":"Pending",
-                        "DoctorScheduler":"Pending",
-                        "BedManager":"Pending",
-                        "ConflictResolver":"Pending"},
-            "cache":{}}
-    result = smart_hospital_graph.invoke(state)
-    return result
\ No newline at end of file
+import psycopg2
+from psycopg2.extras import execute_values
+from concurrent.futures import ThreadPoolExecutor
+from agents import *
+from config import hospital_config_from_env
+from metrics import span
+from journal import journal_events
+from snapshot import invalidate_snapshot
+import threading, time
+from logging import debug
+
+queued_patients = []
+
+# GRAPH DEFINITION
+def run_node(agent, state):
+    with span("node", agent.__class__.__name__):
+        update = agent(state)
+    record_outcomes(update)
+    journal_events(update["logs"])
+    return update
+
+async def arun_node(agent, state):
+    with span("node", agent.__class__.__name__):
+        update = await agent.acall(state)
+    record_outcomes(update)
+    journal_events(update["logs"])
+    return update
+
+def as_node(agent):
+    from langchain_core.runnables import RunnableLambda
+    # Same agent serves graph.invoke (sync __call__) and graph.ainvoke (async acall).
+    def call(state):
+        return run_node(agent, state)
+
+    async def acall(state):
+        return await arun_node(agent, state)
+    return RunnableLambda(call, afunc=acall, name=agent.__class__.__name__)
+
+mood_agent = MentalHealthAnalyzerAgent()
+triage_agent = EmergencyTriageAgent()
+doctor_agent = DoctorSchedulerAgent()
+bed_agent = BedManagerAgent()
+checker_agent = ConflictResolverAgent()
+allocator_agent = CaseAllocatorAgent()
+
+def assessment_agent(config):
+    # None when mood and triage run as separate nodes.
+    if config.assessment_mode == "split":
+        return None
+    return PatientAssessmentAgent(mood_agent, triage_agent, mode=config.assessment_mode)
+
+def triaged(state):
+    # Without a triage level and department there is nothing to claim or queue for; run_patient_flow_batch
+    # skips these patients the same way.
+    return state["status"]["EmergencyTriage"] == "Success"
+
+def build_hospital_graph(config=None):
+    # langgraph is by far the slowest import here, so it is only loaded when a graph is built.
+    from langgraph.graph import StateGraph, END
+    config = config or hospital_config_from_env()
+    graph = StateGraph(AgentState)
+    assessor = assessment_agent(config)
+    if assessor is None:
+        graph.add_node("mood", as_node(mood_agent))
+        graph.add_node("triage", as_node(triage_agent))
+        graph.set_entry_point("mood")
+        graph.add_edge("mood", "triage")
+        assessed = "triage"
+    else:
+        # Mood, triage level and department from one LLM call.
+        graph.add_node("assessment", as_node(assessor))
+        graph.set_entry_point("assessment")
+        assessed = "assessment"
+    if config.allocation_mode == "atomic":
+        # Doctor, bed and case/queue in a single allocate_case() statement.
+        graph.add_node("allocate", as_node(allocator_agent))
+        graph.add_conditional_edges(assessed, lambda state: "allocate" if triaged(state) else END, ["allocate", END])
+        graph.add_edge("allocate", END)
+    else:
+        # Doctor and bed claims only depend on triage, so they run in the same step
+        # and the checker waits for both.
+        graph.add_node("doctor", as_node(doctor_agent))
+        graph.add_node("bed", as_node(bed_agent))
+        graph.add_node("checker", as_node(checker_agent))
+        graph.add_conditional_edges(assessed, lambda state: ["doctor", "bed"] if triaged(state) else END,
+                                    ["doctor", "bed", END])
+        graph.add_edge(["doctor", "bed"], "checker")
+        graph.add_edge("checker", END)
+    debug(f"Built hospital graph in {config.allocation_mode} mode, {config.assessment_mode} assessment...")
+    return graph.compile()
+
+_hospital_graph = None
+_hospital_graph_lock = threading.Lock()
+
+def get_hospital_graph():
+    global _hospital_graph
+    if _hospital_graph is None:
+        with _hospital_graph_lock:
+            if _hospital_graph is None:
+                _hospital_graph = build_hospital_graph()
+    return _hospital_graph
+
+def __getattr__(name):
+    # Keeps ``from smart_hospital import smart_hospital_graph`` working without compiling at import.
+    if name == "smart_hospital_graph":
+        return get_hospital_graph()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Patient flow simulation
+def initial_state(name, vitals, email, gender, age, symptoms, symptom_duration):
+    patient = Patient(name, vitals, email, gender, age, symptoms, symptom_duration)
+    return {"patient": patient,
+            "logs": [],
+            "status": {"MoodAnalyzer":"Pending",
+                       "EmergencyTriage":"Pending",
+                       "DoctorScheduler":"Pending",
+                       "BedManager":"Pending",
+                       "ConflictResolver":"Pending"},
+            "cache":{}}
+
+def run_patient_flow(name, vitals, email, gender, age, symptoms, symptom_duration):
+    state = initial_state(name, vitals, email, gender, age, symptoms, symptom_duration)
+    result = get_hospital_graph().invoke(state)
+    invalidate_snapshot()
+    return result
+
+async def arun_patient_flow(name, vitals, email, gender, age, symptoms, symptom_duration):
+    state = initial_state(name, vitals, email, gender, age, symptoms, symptom_duration)
+    result = await get_hospital_graph().ainvoke(state)
+    invalidate_snapshot()
+    return result
+
+# Bulk admission (mass-casualty intake)
+def register_patients(states):
+    """Registers the batch in one upsert; returns {index: error} for the patients that couldn't be registered."""
+    errors, first = {}, {}
+    for idx, state in enumerate(states):
+        email = state["patient"].email
+        if email in first:
+            # One row can't be upserted twice in a statement, and two patients can't share a record.
+            errors[idx] = f"Duplicate email {email} in batch (same as patient {first[email]})"
+        else:
+            first[email] = idx
+    rows = [patient_insert_row(states[idx]["patient"]) for idx in first.values()]
+    try:
+        with db_cursor() as cursor:
+            inserted = execute_values(cursor, PATIENT_UPSERT_QUERY, rows, template=PATIENT_ROW_TEMPLATE,
+                                      page_size=len(rows), fetch=True)
+        patient_ids = {email: patient_id for patient_id, email in inserted}
+    except psycopg2.Error as e:
+        # One bad row aborts the whole insert; register one by one so only that patient fails.
+        debug(f"Batch registration failed, registering patients one by one...\n{e}")
+        patient_ids = {}
+        for email, idx in first.items():
+            try:
+                with db_cursor() as cursor:
+                    cursor.execute(PATIENT_UPSERT_QUERY % PATIENT_ROW_TEMPLATE, patient_insert_row(states[idx]["patient"]))
+                    patient_ids[email] = cursor.fetchone()[0]
+            except psycopg2.Error as e:
+                errors[idx] = str(e).strip()
+    for email, idx in first.items():
+        if email in patient_ids:
+            states[idx]["cache"]["patient_id"] = patient_ids[email]
+    return errors
+
+def run_patient_flow_batch(patients, max_concurrency=8):
+    started = time.perf_counter()
+    states = [initial_state(**patient) for patient in patients]
+    for state in states:
+        # Beds and doctors go out sickest first once everyone is triaged, so nothing is held early.
+        state["cache"]["speculate"] = False
+    timings = [{} for _ in states]
+    batch_timing = {"patients": len(states)}
+    if not states:
+        batch_timing["total_s"] = 0.0
+        return {"results": [], "timing": batch_timing}
+
+    for idx, error in register_patients(states).items():
+        timings[idx]["error"] = error
+    batch_timing["register_s"] = time.perf_counter() - started
+    registered = [idx for idx, state in enumerate(states) if "patient_id" in state["cache"]]
+    debug(f"Registered {len(registered)} patients in one insert...")
+    assessor = assessment_agent(hospital_config_from_env())
+
+    def assess(idx):
+        state = states[idx]
+        assess_started = time.perf_counter()
+        try:
+            if assessor is None:
+                apply_update(state, run_node(mood_agent, state))
+                apply_update(state, run_node(triage_agent, state))
+            else:
+                apply_update(state, run_node(assessor, state))
+        except Exception as e:
+            debug(f"Error assessing {state['patient'].name}...\n{e}")
+            timings[idx]["error"] = str(e)
+        timings[idx]["assessment_s"] = time.perf_counter() - assess_started
+
+    assessment_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        list(executor.map(assess, registered))
+    batch_timing["assessment_s"] = time.perf_counter() - assessment_started
+
+    # Allocate in a single pass, sickest first, so scarce doctors and beds go to
+    # the highest priority scores. Patients without a triage result can't be scored.
+    allocation_started = time.perf_counter()
+    ready = [idx for idx, state in enumerate(states) if triaged(state)]
+    for idx in ready:
+        states[idx]["patient"].calculate_priority()
+    ready.sort(key=lambda idx: states[idx]["patient"].priority_score, reverse=True)
+    # With the in-process allocator the two claims are memory operations, so only resolve_case() is a round trip.
+    allocation_nodes = (doctor_agent, bed_agent, checker_agent) if allocator_enabled() else (allocator_agent,)
+    for rank, idx in enumerate(ready):
+        state = states[idx]
+        patient_started = time.perf_counter()
+        for agent in allocation_nodes:
+            apply_update(state, run_node(agent, state))
+        timings[idx]["allocation_rank"] = rank
+        timings[idx]["allocation_s"] = time.perf_counter() - patient_started
+    batch_timing["allocation_s"] = time.perf_counter() - allocation_started
+    batch_timing["total_s"] = time.perf_counter() - started
+    invalidate_snapshot()
+
+    results = [dict(state, timing=timings[idx]) for idx, state in enumerate(states)]
+    return {"results": results, "timing": batch_timing}
@@ -0,0 +1,130 @@
+"""Process-wide, immutable doctor/bed/queue snapshot shared by every dashboard session.
+
+A background refresher rebuilds the snapshot whenever the live view reports a
+change or an admission calls invalidate_snapshot(), and at least every
+``max_staleness`` seconds regardless. Sessions only ever read ``current()``,
+which is a single reference read. While the change feed is connected a
+rebuild comes from live_status memory; if it is down, the refresher falls
+back to querying the database, so the staleness bound still holds.
+"""
+import os, threading
+from collections import namedtuple
+from datetime import datetime
+from types import MappingProxyType
+from logging import debug
+from db import db_cursor
+from agents import get_doctor_status, get_beds, get_doctor_counts
+
+StatusSnapshot = namedtuple("StatusSnapshot", [
+    "version", "taken_at", "source", "doctors", "beds", "doctor_counts", "queue"])
+QUEUE_QUERY = """
+    SELECT patient_id, priority_score, type_of_room, department
+    FROM queue
+    ORDER BY priority_score DESC;
+    """
+
+def _freeze(doctors, beds, doctor_counts, queue):
+    return (tuple(MappingProxyType(dict(row)) for row in doctors),
+            MappingProxyType(dict(beds)),
+            MappingProxyType(dict(doctor_counts)),
+            tuple(tuple(row) for row in queue))
+
+class SnapshotService:
+    def __init__(self, live=None, max_staleness=None, min_interval=None):
+        self.live = live
+        self.max_staleness = max_staleness or float(os.getenv("SHMAS_SNAPSHOT_MAX_STALENESS", "5"))
+        # Bursts of changes (a mass-casualty batch) coalesce into one rebuild per interval.
+        self.min_interval = min_interval if min_interval is not None else float(
+            os.getenv("SHMAS_SNAPSHOT_MIN_INTERVAL", "0.25"))
+        self._snapshot = None
+        self._version = 0
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._ready = threading.Event()
+        self._thread = None
+        self._stats = {"rebuilds": 0, "from_live": 0, "from_db": 0, "invalidations": 0, "errors": 0}
+        if live is not None:
+            live.on_change(self.invalidate)
+
+    def current(self):
+        return self._snapshot
+
+    def invalidate(self):
+        self._stats["invalidations"] += 1
+        self._dirty.set()
+
+    def _read_live(self):
+        return _freeze(self.live.doctor_status(), self.live.beds(), self.live.doctor_counts(), self.live.queue())
+
+    def _read_db(self):
+        with db_cursor() as cursor:
+            cursor.execute(QUEUE_QUERY)
+            queue = cursor.fetchall()
+        return _freeze(get_doctor_status(), get_beds(), get_doctor_counts(), queue)
+
+    def rebuild(self):
+        from_live = self.live is not None and self.live.connected
+        parts = self._read_live() if from_live else self._read_db()
+        self._version += 1
+        # Built completely before being published, so readers never see a half-updated snapshot.
+        self._snapshot = StatusSnapshot(self._version, datetime.now(), "live" if from_live else "db", *parts)
+        self._stats["rebuilds"] += 1
+        self._stats["from_live" if from_live else "from_db"] += 1
+        self._ready.set()
+        return self._snapshot
+
+    def run(self):
+        debug("Snapshot refresher started...")
+        while not self._stop.is_set():
+            self._dirty.wait(max(0.0, self.max_staleness - self.min_interval))
+            if self._stop.is_set():
+                break
+            self._dirty.clear()
+            try:
+                self.rebuild()
+            except Exception as e:
+                self._stats["errors"] += 1
+                debug(f"Snapshot rebuild failed...\n{e}")
+            self._stop.wait(self.min_interval)
+        debug("Snapshot refresher stopped...")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._dirty.set()
+            self._thread = threading.Thread(target=self.run, name="shmas-snapshot", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._dirty.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def stats(self):
+        stats = dict(self._stats)
+        snapshot = self._snapshot
+        stats["version"] = snapshot.version if snapshot else None
+        stats["age"] = (datetime.now() - snapshot.taken_at).total_seconds() if snapshot else None
+        stats["max_staleness"] = self.max_staleness
+        return stats
+
+_service = None
+_service_lock = threading.Lock()
+
+def start_snapshot_service(live=None, **kwargs):
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = SnapshotService(live=live, **kwargs).start()
+    _service.wait_ready(float(os.getenv("SHMAS_SNAPSHOT_READY_TIMEOUT", "10")))
+    return _service
+
+def invalidate_snapshot():
+    # Admission paths call this after writing; a no-op in processes without a snapshot service.
+    if _service is not None:
+        _service.invalidate()
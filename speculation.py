@@ -0,0 +1,180 @@
+"""Speculative doctor and bed holds while the LLM triage is running.
+
+Allocation can't start until triage answers, so the claims used to follow
+the slowest step of an admission. With SHMAS_SPECULATION=1 the triage agent
+predicts the department and bed type with the rule engine and, while its
+LLM call is in flight, places short holds (hold_resources()) on a doctor
+and a bed of the preferred type. Once triage is known the doctor and bed
+agents take the held resource if it is the one they want and claim as usual
+if not; resolve_case() then keeps the holds the case uses and releases the
+rest. Holds that are never settled lapse after SHMAS_SPECULATION_TTL
+seconds (expire_holds(), run by the expiry worker).
+
+A hold is only taken while less than half its TTL has passed, so it can't
+lapse between being taken and the case being written.
+"""
+import os, time, threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from logging import debug
+from db import db_cursor, async_db_cursor
+from metrics import inc, observe
+
+HOLD_QUERY = "SELECT * FROM hold_resources(%s::bigint, %s::varchar, %s::room_type, %s::interval);"
+RELEASE_QUERY = "SELECT settle_holds(%s::bigint);"
+
+# doctor is (doctor_id, name, specialist, busy_from) and room (room_number, type), or None if nothing was free.
+Hold = namedtuple("Hold", ["patient_id", "department", "room_type", "doctor", "room", "started", "seconds"])
+
+def speculation_enabled():
+    return os.getenv("SHMAS_SPECULATION", "0") == "1"
+
+def hold_ttl():
+    return float(os.getenv("SHMAS_SPECULATION_TTL", "30"))
+
+def _hold_from_row(patient_id, department, room_type, row, started):
+    doctor_id, doctor_name, specialist, busy_from, room_number, room_kind = row
+    return Hold(patient_id, department, room_type,
+                (doctor_id, doctor_name, specialist, busy_from) if doctor_id is not None else None,
+                (room_number, room_kind) if room_number is not None else None,
+                started, time.monotonic() - started)
+
+def place_hold(patient_id, department, room_type):
+    started = time.monotonic()
+    with db_cursor() as cursor:
+        cursor.execute(HOLD_QUERY, (patient_id, department, room_type, timedelta(seconds=hold_ttl())))
+        row = cursor.fetchone()
+    return _hold_from_row(patient_id, department, room_type, row, started)
+
+async def aplace_hold(patient_id, department, room_type):
+    started = time.monotonic()
+    async with async_db_cursor() as cursor:
+        await cursor.execute(HOLD_QUERY, (patient_id, department, room_type, timedelta(seconds=hold_ttl())))
+        row = await cursor.fetchone()
+    return _hold_from_row(patient_id, department, room_type, row, started)
+
+def release_holds(patient_id):
+    with db_cursor() as cursor:
+        cursor.execute(RELEASE_QUERY, (patient_id,))
+        released = cursor.fetchone()[0]
+    speculation_stats.record_release(released)
+
+async def arelease_holds(patient_id):
+    async with async_db_cursor() as cursor:
+        await cursor.execute(RELEASE_QUERY, (patient_id,))
+        released = (await cursor.fetchone())[0]
+    speculation_stats.record_release(released)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=int(os.getenv("SHMAS_SPECULATION_WORKERS", "4")),
+                                               thread_name_prefix="shmas-speculation")
+    return _executor
+
+def start_hold(patient_id, department, room_type):
+    """place_hold() on a background thread, so the caller can make its LLM call meanwhile."""
+    return _get_executor().submit(place_hold, patient_id, department, room_type)
+
+def finish_hold(pending):
+    # A failed hold only means no speculation for this patient.
+    try:
+        hold = pending.result()
+    except Exception as e:
+        speculation_stats.record_error()
+        debug(f"Speculative hold failed...\n{e}")
+        return None
+    speculation_stats.record_hold(hold)
+    return hold
+
+async def afinish_hold(pending):
+    try:
+        hold = await pending
+    except Exception as e:
+        speculation_stats.record_error()
+        debug(f"Speculative hold failed...\n{e}")
+        return None
+    speculation_stats.record_hold(hold)
+    return hold
+
+def take(hold, kind, wanted):
+    """The held doctor or room if it is what the admission wants (a department or bed type), else None."""
+    if hold is None:
+        return None
+    held = hold.doctor if kind == "doctor" else hold.room
+    if held is None:
+        result = "unheld"
+    elif time.monotonic() - hold.started >= hold_ttl() / 2:
+        result = "expired"
+    elif held[2 if kind == "doctor" else 1] != wanted:
+        result = "miss"
+    else:
+        result = "hit"
+    speculation_stats.record(kind, result)
+    return held if result == "hit" else None
+
+def record_used(hold, kind, used_id):
+    """For allocate_case(), which takes fitting holds itself: was the resource it used the held one?"""
+    held = hold.doctor if kind == "doctor" else hold.room
+    result = "unheld" if held is None else "hit" if held[0] == used_id else "miss"
+    speculation_stats.record(kind, result)
+    return result == "hit"
+
+def record_saved(hold, doctor_hit, room_hit):
+    # Both claims happened inside the hold, during the LLM call; with a partial hit one still runs after triage.
+    saved = hold.seconds if doctor_hit and room_hit else 0.0
+    speculation_stats.record_saved(saved)
+    return saved
+
+class SpeculationStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._results = {}
+            self._totals = {"holds": 0, "errors": 0, "released": 0, "settled": 0, "saved_seconds": 0.0}
+
+    def record_hold(self, hold):
+        with self._lock:
+            self._totals["holds"] += 1
+
+    def record_error(self):
+        with self._lock:
+            self._totals["errors"] += 1
+
+    def record_release(self, released):
+        with self._lock:
+            self._totals["released"] += released
+
+    def record(self, kind, result):
+        inc("shmas_speculation_total", kind=kind, result=result)
+        with self._lock:
+            bucket = self._results.setdefault(kind, {"hit": 0, "miss": 0, "expired": 0, "unheld": 0})
+            bucket[result] += 1
+
+    def record_saved(self, seconds):
+        observe("shmas_speculation_saved_seconds", seconds)
+        with self._lock:
+            self._totals["settled"] += 1
+            self._totals["saved_seconds"] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            output = dict(self._totals)
+            for kind, bucket in self._results.items():
+                stats = dict(bucket)
+                total = sum(bucket.values())
+                stats["hit_rate"] = bucket["hit"] / total if total else None
+                output[kind] = stats
+        output["mean_saved_seconds"] = output["saved_seconds"] / output["settled"] if output["settled"] else None
+        return output
+
+speculation_stats = SpeculationStats()
@@ -1,8 +1,16 @@
 import streamlit as st
-from smart_hospital import run_patient_flow, get_doctor_status, get_beds
-import logging
+from smart_hospital import run_patient_flow
+from expiry import start_expiry_worker
+from dispatcher import start_dispatcher
+from rescoring import start_queue_rescorer
+from live_status import start_live_status
+from snapshot import start_snapshot_service
+from metrics import start_metrics_server
+from journal import render_event
+from config import configure_logging
+import os
 from logging import debug
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+configure_logging()
 
 
 st.set_page_config(page_title="SHMAS : Smart Hospital Multi-Agent System", layout="wide")
@@ -198,15 +206,20 @@ def display_status_buttons():
         if st.button("🛏️ Toggle Bed Status", key="bed_btn"):
             st.session_state['show_beds'] = not st.session_state.get('show_beds', True)
 
-def display_doctor_status():
+def display_doctor_status(snapshot):
     if st.session_state.get('show_doctors', True):
         st.subheader("👨‍⚕️ Doctor Status")
         
-        # Add auto-refresh
+        # Reads the shared in-memory snapshot, so refreshing costs no database queries
         if st.button("🔄 Refresh Status"):
             st.rerun()
         
-        status = get_doctor_status()
+        counts = snapshot.doctor_counts
+        if counts:
+            for col, (department, (available, busy)) in zip(st.columns(len(counts)), counts.items()):
+                col.metric(department, f"{available}/{available + busy}", help="available / total")
+
+        status = snapshot.doctors
         
         for doc in status:
             if doc['status'] == "BUSY":
@@ -253,10 +266,10 @@ def display_doctor_status():
                 </div>
                 """, unsafe_allow_html=True)
 
-def display_bed_status():
+def display_bed_status(snapshot):
     if st.session_state.get('show_beds', True):
         st.subheader("🛏️ Bed Status")
-        beds = get_beds()
+        beds = snapshot.beds
         for bed_type, bed_data in beds.items():
             total_beds = bed_data[0] + bed_data[1]
             available_beds = bed_data[0]
@@ -299,16 +312,11 @@ def display_patient_results():
         col3.metric("Priority Score", patient['priority_score'])
         
         st.subheader("📜 System Execution Log")
-        for log in logs:
-            if ']' in log:
-                timestamp, message = log.split(']', 1)
-                timestamp = timestamp[1:]  # Remove the opening bracket
-                message = message.strip()
-            else:
-                timestamp = ""
-                message = log
+        for event in logs:
+            # Events are formatted here, when shown, not while the admission runs.
+            timestamp, message = render_event(event)
             
-            if "error" in message.lower():
+            if event.outcome == "Error":
                 st.markdown(f"""
                 <div class="log-entry">
                     <span style="color: #e74c3c; margin-right: 10px;">❌</span>
@@ -325,7 +333,66 @@ def display_patient_results():
                 </div>
                 """, unsafe_allow_html=True)
 
+@st.cache_resource
+def expiry_worker():
+    # One worker per server process releases doctors as their busy_till passes.
+    return start_expiry_worker()
+
+@st.cache_resource
+def live_status():
+    # One listener per server process keeps this current from the change feed; every tab reads it.
+    return start_live_status()
+
+@st.cache_resource
+def status_snapshot():
+    # Rebuilt in the background on change/admission and at least every SHMAS_SNAPSHOT_MAX_STALENESS seconds.
+    return start_snapshot_service(live=live_status())
+
+@st.fragment(run_every=float(os.getenv("SHMAS_DASHBOARD_REFRESH", "2")))
+def display_live_status():
+    # One snapshot per render, so all three panels agree with each other.
+    snapshot = status_snapshot().current()
+    if snapshot is None:
+        st.info("Loading hospital status...")
+        return
+    display_doctor_status(snapshot)
+    display_bed_status(snapshot)
+    display_queue_status(snapshot)
+    st.caption(f"Status v{snapshot.version} as of {snapshot.taken_at:%H:%M:%S} ({snapshot.source})")
+
+@st.cache_resource
+def queue_dispatcher():
+    # Admits queued patients as soon as a matching doctor or bed is released.
+    return start_dispatcher()
+
+@st.cache_resource
+def queue_rescorer():
+    # Re-scores the waiting queue every SHMAS_RESCORE_INTERVAL seconds as symptom durations grow.
+    return start_queue_rescorer()
+
+@st.cache_resource
+def metrics_server():
+    # Prometheus text on :SHMAS_METRICS_PORT/metrics; off unless the port is set.
+    return start_metrics_server() if os.getenv("SHMAS_METRICS_PORT") else None
+
+def format_wait(seconds):
+    return f"{seconds:.0f}s" if seconds is not None else "-"
+
+def display_queue_status(snapshot):
+    stats = queue_dispatcher().stats()
+    st.subheader("⏳ Waiting Queue")
+    waits = stats["time_in_queue"]
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Waiting", len(snapshot.queue))
+    col2.metric("Admitted from queue", stats["admitted"])
+    col3.metric("Median wait", format_wait(waits["p50"]),
+                help=f"p90 {format_wait(waits['p90'])}, p99 {format_wait(waits['p99'])}")
+
 def main():
+    expiry_worker()
+    queue_dispatcher()
+    queue_rescorer()
+    metrics_server()
     # Initialize all necessary session state variables
     if 'last_patient' not in st.session_state:
         st.session_state.last_patient = None
@@ -350,8 +417,7 @@ def main():
     
     with col2:
         display_status_buttons()
-        display_doctor_status()
-        display_bed_status()
+        display_live_status()
         # display_patient_queues()
 
 if __name__ == "__main__":
@@ -0,0 +1,4 @@
+import os, sys
+
+# The modules live flat in the repository root, as the benchmarks assume too.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
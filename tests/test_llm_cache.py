@@ -0,0 +1,82 @@
+import itertools
+from types import SimpleNamespace
+import pytest
+import llm_cache
+from llm_cache import LLMResultCache, age_band, make_cache_key
+from triage_rules import DIASTOLIC_CUTOFFS, HEART_RATE_CUTOFFS, PEDIATRIC_AGE, SYSTOLIC_CUTOFFS, assess_with_rules
+
+def patient(age=40, heart_rate=80, systolic=120, diastolic=85, symptoms=("back pain",), duration=3):
+    return SimpleNamespace(age=age, symptoms=list(symptoms), symptom_duration=duration,
+                           vitals={"heart_rate": heart_rate, "blood_pressure": {"systolic": systolic, "diastolic": diastolic}})
+
+def key(**fields):
+    return make_cache_key("triage", patient(**fields), "v1", "model")
+
+def rules(**fields):
+    assessed = assess_with_rules(patient(**fields))
+    return assessed.triage_level, assessed.department, assessed.mood, assessed.triage_confidence, assessed.mood_confidence
+
+CUTOFFS = ([("heart_rate", c) for c in HEART_RATE_CUTOFFS] + [("systolic", c) for c in SYSTOLIC_CUTOFFS]
+           + [("diastolic", c) for c in DIASTOLIC_CUTOFFS])
+
+@pytest.mark.parametrize("field,cutoff", CUTOFFS)
+def test_vitals_cutoffs_split_keys(field, cutoff):
+    # Below, on and above a cut-off are three different keys, however close together.
+    keys = {key(**{field: value}) for value in (cutoff - 0.5, cutoff, cutoff + 0.5)}
+    assert len(keys) == 3
+
+def test_pediatric_age_splits_its_decade():
+    assert age_band(PEDIATRIC_AGE - 1) != age_band(PEDIATRIC_AGE)
+    assert age_band(PEDIATRIC_AGE) == age_band(19)
+    assert age_band(20) == age_band(29)
+    assert key(age=PEDIATRIC_AGE - 1) != key(age=PEDIATRIC_AGE)
+
+def test_nearby_values_share_a_key():
+    assert key(heart_rate=81) == key(heart_rate=89)
+    assert key(age=41, duration=1) == key(age=49, duration=5)
+    assert key(symptoms=["Back Pain ", "back pain"]) == key(symptoms=["back pain"])
+
+@pytest.mark.parametrize("field,values", [
+    ("heart_rate", range(20, 200)), ("systolic", range(60, 240)), ("diastolic", range(30, 140)), ("age", range(0, 100)),
+])
+@pytest.mark.parametrize("symptoms", [["back pain"], ["mild cough"], ["chest pain"]])
+def test_same_key_same_rule_outcome(field, values, symptoms):
+    # The rules never tell apart two patients the cache treats as one.
+    outcomes = {}
+    for value in itertools.chain(values, (v + 0.5 for v in values)):
+        fields = {field: value, "symptoms": symptoms}
+        outcomes.setdefault(key(**fields), set()).add(rules(**fields))
+    assert all(len(seen) == 1 for seen in outcomes.values())
+
+def test_lru_eviction():
+    cache = LLMResultCache(max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1" and cache.get("c") == "3"
+    assert cache.stats()["evictions"] == 1
+
+def test_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now[0])
+    cache = LLMResultCache(ttl_seconds=60)
+    cache.put("a", "1")
+    now[0] += 59
+    assert cache.get("a") == "1"
+    now[0] += 2
+    assert cache.get("a") is None
+    assert cache.stats()["expired"] == 1
+
+def test_sqlite_round_trip(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.db")
+    writer = LLMResultCache(persist_path=path)
+    writer.put("a", '{"mood": "calm"}')
+    reader = LLMResultCache(persist_path=path)
+    assert reader.get("a") == '{"mood": "calm"}'
+    assert reader.stats()["disk_hits"] == 1
+    # Rows past the TTL are ignored, and dropped when the next process opens the file.
+    now = llm_cache.time.time() + 7 * 3600
+    monkeypatch.setattr(llm_cache.time, "time", lambda: now)
+    assert LLMResultCache(persist_path=path).get("a") is None
@@ -0,0 +1,145 @@
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+import pytest
+from llm_gateway import CircuitBreaker, CircuitOpenError, LLMGateway, LLMUnavailableError, StubChatBackend
+
+PROMPT = [SimpleNamespace(content='Return JSON: {"mood": "chosen_mood"}')]
+
+class Flaky:
+    """A responder that raises for the first ``failures`` calls, then answers."""
+
+    def __init__(self, failures):
+        self.failures, self.calls = failures, 0
+
+    def __call__(self, prompt):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ConnectionError("upstream hiccup")
+        return '{"mood": "calm"}'
+
+def gateway(responder=None, latency=0.0, **kwargs):
+    kwargs = dict(dict(backoff_base=0.001, backoff_max=0.01, timeout=2.0), **kwargs)
+    return LLMGateway(StubChatBackend(responder, latency), **kwargs)
+
+def test_retries_until_success():
+    responder = Flaky(2)
+    llm = gateway(responder, max_retries=2)
+    assert llm.invoke(PROMPT).content == '{"mood": "calm"}'
+    assert responder.calls == 3
+    assert llm.stats()["retries"] == 2 and llm.stats()["successes"] == 1
+    assert llm.breaker.state == "closed"
+
+def test_gives_up_after_max_retries():
+    responder = Flaky(10)
+    llm = gateway(responder, max_retries=2)
+    with pytest.raises(LLMUnavailableError, match="upstream hiccup"):
+        llm.invoke(PROMPT)
+    assert responder.calls == 3
+    assert llm.stats()["failures"] == 1
+
+def test_backoff_is_capped_full_jitter():
+    llm = gateway(backoff_base=0.5, backoff_max=8.0)
+    for attempt in range(10):
+        delays = [llm._backoff(attempt) for _ in range(50)]
+        assert all(0 <= delay <= min(8.0, 0.5 * 2 ** attempt) for delay in delays)
+
+def test_no_retry_that_would_pass_the_deadline():
+    responder = Flaky(10)
+    llm = gateway(responder, max_retries=5, backoff_base=10, backoff_max=10, timeout=0.5)
+    started = time.monotonic()
+    with pytest.raises(LLMUnavailableError):
+        llm.invoke(PROMPT)
+    assert time.monotonic() - started < 0.5
+
+def test_upstream_timeout_counts_against_the_breaker():
+    llm = gateway(latency=1.0, breaker=CircuitBreaker(failure_threshold=1))
+    started = time.monotonic()
+    with pytest.raises(LLMUnavailableError, match="deadline"):
+        llm.invoke(PROMPT, timeout=0.1)
+    assert time.monotonic() - started < 0.5
+    assert llm.stats()["timeouts"] == 1
+    assert llm.breaker.state == "open"
+
+def test_local_saturation_does_not_open_the_breaker():
+    llm = gateway(latency=0.5, max_concurrency=1, breaker=CircuitBreaker(failure_threshold=1))
+    busy = threading.Thread(target=llm.invoke, args=(PROMPT,))
+    busy.start()
+    time.sleep(0.05)
+    with pytest.raises(LLMUnavailableError, match="deadline"):
+        llm.invoke(PROMPT, timeout=0.1)
+    assert llm.breaker.state == "closed"
+    busy.join()
+    assert llm.stats()["timeouts"] == 1
+
+def test_rate_limit_fails_fast_instead_of_sleeping_past_the_deadline():
+    llm = gateway(rate_per_sec=0.5, burst=1, breaker=CircuitBreaker(failure_threshold=1))
+    llm.invoke(PROMPT)
+    started = time.monotonic()
+    with pytest.raises(LLMUnavailableError, match="deadline"):
+        llm.invoke(PROMPT, timeout=0.5)
+    assert time.monotonic() - started < 0.1
+    assert llm.breaker.state == "closed"
+    # The token reserved for the call that wasn't made is handed back.
+    assert llm.bucket._tokens > -0.5
+
+def test_async_local_saturation_does_not_open_the_breaker():
+    llm = gateway(latency=0.5, max_concurrency=1, breaker=CircuitBreaker(failure_threshold=1))
+
+    async def run():
+        busy = asyncio.ensure_future(llm.ainvoke(PROMPT))
+        await asyncio.sleep(0.05)
+        with pytest.raises(LLMUnavailableError, match="deadline"):
+            await llm.ainvoke(PROMPT, timeout=0.1)
+        assert llm.breaker.state == "closed"
+        await busy
+
+    asyncio.run(run())
+    assert llm.breaker.state == "closed"
+
+def test_breaker_opens_half_opens_and_closes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    responder = Flaky(2)
+    llm = gateway(responder, max_retries=0, breaker=breaker)
+    for _ in range(2):
+        with pytest.raises(LLMUnavailableError):
+            llm.invoke(PROMPT)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        llm.invoke(PROMPT)
+    assert responder.calls == 2 and llm.stats()["rejected"] == 1
+    time.sleep(0.1)
+    # One trial goes through; while it is in flight everyone else is still turned away.
+    assert breaker.allow() and breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert llm.invoke(PROMPT).content == '{"mood": "calm"}'
+
+def test_failed_trial_reopens_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    llm = gateway(Flaky(10), max_retries=0, breaker=breaker)
+    with pytest.raises(LLMUnavailableError):
+        llm.invoke(PROMPT)
+    time.sleep(0.1)
+    with pytest.raises(LLMUnavailableError):
+        llm.invoke(PROMPT)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        llm.invoke(PROMPT)
+
+def test_trial_given_up_locally_frees_the_trial_slot():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    llm = gateway(max_concurrency=1, breaker=breaker)
+    breaker.record_failure()
+    time.sleep(0.1)
+    # The trial can't get a concurrency slot; the next caller gets to try instead.
+    llm._semaphore.acquire()
+    try:
+        with pytest.raises(LLMUnavailableError, match="deadline"):
+            llm.invoke(PROMPT, timeout=0.05)
+    finally:
+        llm._semaphore.release()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
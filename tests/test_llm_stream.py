@@ -0,0 +1,124 @@
+import asyncio
+import pytest
+import agents
+from agents import MentalHealthAnalyzerAgent, Patient, is_triage_answer, new_update
+from llm_cache import LLMResultCache
+from llm_stream import JSONObjectExtractor, StreamDeadlineError, aread_answer, read_answer
+
+ANSWER = {"triage_level": 3, "department": "Cardiology"}
+
+def feed_all(pieces):
+    extractor = JSONObjectExtractor()
+    return [value for piece in pieces for value in extractor.feed(piece)]
+
+def split_every(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+class Stream:
+    """A token stream that records how far it was read and whether it was closed."""
+
+    def __init__(self, pieces):
+        self.pieces, self.read, self.closed = list(pieces), 0, False
+
+    def __iter__(self):
+        for piece in self.pieces:
+            if self.closed:
+                return
+            self.read += 1
+            yield piece
+
+    async def __aiter__(self):
+        for piece in self:
+            yield piece
+
+    def close(self):
+        self.closed = True
+
+    async def aclose(self):
+        self.closed = True
+
+REPLY = '<think>It could be {"triage_level": 1, "department": "Dentist"}, but no.</think>\n' \
+        'Answer: {"triage_level": 3, "department": "Cardiology", "note": "pain } and { \\" quote"} Hope this helps.'
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, len(REPLY)])
+def test_split_tokens(size):
+    # However the reply is cut up, the objects quoted while thinking are skipped and strings may hold braces.
+    assert feed_all(split_every(REPLY, size)) == [dict(ANSWER, note='pain } and { " quote')]
+
+@pytest.mark.parametrize("pieces", [["<thi", "nk>{\"a\": 1}</th", "ink>{\"b\": 2}"], ["  <think>", "{}", "</think>", "{\"b\": 2}"]])
+def test_think_preamble(pieces):
+    assert feed_all(pieces) == [{"b": 2}]
+
+def test_no_think_block():
+    assert feed_all(['{"a": "<think>"}', ' {"b": 2}']) == [{"a": "<think>"}, {"b": 2}]
+
+def test_braces_in_strings():
+    assert feed_all(['{"a": "}{", "b": "\\\\"}', '{"c": "\\"}"}']) == [{"a": "}{", "b": "\\"}, {"c": '"}'}]
+
+def test_prose_braces_are_skipped():
+    assert feed_all(["Use {like this} or {", "not: json} then ", '{"a": 1}']) == [{"a": 1}]
+
+def test_invalid_first_object():
+    # The first object is JSON but not an answer; the second one is taken.
+    stream = Stream(['{"mood": "calm"}', '{"triage_level": 3, ', '"department": "Cardiology"}', '{"late": 1}'])
+    result = read_answer(stream, is_triage_answer)
+    assert result.answer == ANSWER
+    assert result.chunks == 3
+
+@pytest.mark.parametrize("strict,expected", [("1", ANSWER), ("0", {"triage_level": 3, "department": "Oncology"})])
+def test_strict_department_rejection(monkeypatch, strict, expected):
+    monkeypatch.setenv("SHMAS_LLM_STRICT", strict)
+    stream = Stream(['{"triage_level": 3, "department": "Oncology"}', '{"triage_level": 3, "department": "Cardiology"}'])
+    assert read_answer(stream, is_triage_answer).answer == expected
+
+def test_strict_rejects_everything(monkeypatch):
+    monkeypatch.setenv("SHMAS_LLM_STRICT", "1")
+    pieces = ['{"triage_level": "3", "department": "Cardiology"}', ' {"triage_level": 6, "department": "Cardiology"}']
+    result = read_answer(Stream(pieces), is_triage_answer)
+    assert result.answer is None and not result.cancelled
+    assert result.content == "".join(pieces)
+
+def test_stream_cancelled_after_answer():
+    stream = Stream(['<think>hmm</think>', '{"triage_level": 3, "department": "Cardiology"}', " more", " text"])
+    result = read_answer(stream, is_triage_answer)
+    assert result.cancelled and result.chunks == 2
+    assert stream.read == 2 and stream.closed
+
+def test_stream_closed_on_deadline():
+    stream = Stream(["<think>", "still thinking"])
+    with pytest.raises(StreamDeadlineError):
+        read_answer(stream, is_triage_answer, deadline=0)
+    assert stream.read == 1 and stream.closed
+
+def test_async_stream_cancelled_after_answer():
+    stream = Stream(['{"triage_level": 3, "department": "Cardiology"}', " more"])
+    result = asyncio.run(aread_answer(stream, is_triage_answer))
+    assert result.answer == ANSWER and result.cancelled
+    assert stream.read == 1 and stream.closed
+
+@pytest.mark.parametrize("strict", ["0", "1"])
+def test_cache_hit_returns_the_accepted_answer(monkeypatch, strict):
+    # A cached reply is the object that was accepted, not the text around it, which quotes another one.
+    monkeypatch.setenv("SHMAS_LLM_STRICT", strict)
+    monkeypatch.setenv("SHMAS_LLM_CACHE", "1")
+    monkeypatch.setenv("SHMAS_RULES_FASTPATH", "0")
+    cache = LLMResultCache()
+    monkeypatch.setattr(agents, "get_llm_cache", lambda: cache)
+    agent = MentalHealthAnalyzerAgent()
+    moods = []
+    for _ in range(2):
+        patient = Patient("a", {"heart_rate": 90, "blood_pressure": {"systolic": 120, "diastolic": 85}},
+                          "a@b.c", "F", 40, ["back pain"], 3)
+        state = {"patient": patient, "logs": [], "status": {}, "cache": {"patient_id": 1}}
+        update = new_update(patient)
+        rules, answered = agent._answer_locally(state, update)
+        if answered is None:
+            agent._apply_llm_response(state, update, rules, '<think>maybe {"mood": "calm"}?</think>{"mood": "stressed"}')
+        moods.append(patient.mood)
+    if strict == "1":
+        assert moods == ["stressed", "stressed"]
+        assert cache.stats()["hits"] == 1
+    else:
+        # The outermost braces don't parse, so nothing is taken and nothing is cached.
+        assert moods == [None, None]
+        assert cache.stats()["size"] == 0
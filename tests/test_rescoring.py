@@ -0,0 +1,40 @@
+import random
+import pytest
+from agents import Patient
+from rescoring import base_scores, finish_scores, score_priorities
+
+def calculate_priority(triage_level, age, symptom_hours, heart_rate, systolic, diastolic):
+    patient = Patient("", {"heart_rate": heart_rate, "blood_pressure": {"systolic": systolic, "diastolic": diastolic}},
+                      "", "", age, [], symptom_hours)
+    patient.triage_level = triage_level
+    patient.calculate_priority()
+    return patient.priority_score
+
+def random_rows(count, seed):
+    # Inputs like the ones queued in practice: whole vitals, ages and hours.
+    rng = random.Random(seed)
+    return [(rng.randint(1, 5), rng.randint(0, 95), rng.randint(0, 72) + rng.random() * 6,
+             rng.randint(40, 139), rng.randint(70, 179), rng.randint(40, 119)) for _ in range(count)]
+
+def edge_rows(count, seed):
+    # Fractional hours and vitals that put scores on .x5 rounding ties, which np.round gets wrong.
+    rng = random.Random(seed)
+    return [(rng.randint(0, 5), rng.randint(0, 100), rng.randint(0, 400) / 8 + rng.choice((0, 0.25, 0.75)),
+             rng.choice((59.5, 60, 100, 100.5, 130)), rng.choice((89.5, 120, 140.5, 200)),
+             rng.choice((59.5, 80, 90.5, 110))) for _ in range(count)]
+
+# Each side of every cut-off in calculate_priority.
+BOUNDARY_ROWS = [(level, age, hours, heart_rate, systolic, diastolic)
+                 for level in (0, 3) for age in (14, 15, 49, 50) for hours in (0, 2.25)
+                 for heart_rate in (59, 60, 100, 101) for systolic in (89, 90, 140, 141)
+                 for diastolic in (59, 60, 90, 91)]
+
+@pytest.mark.parametrize("rows", [random_rows(5000, 1), edge_rows(5000, 2), BOUNDARY_ROWS],
+                         ids=["random", "rounding-ties", "cut-offs"])
+def test_batch_scores_match_calculate_priority(rows):
+    triage_level, age, symptom_hours, heart_rate, systolic, diastolic = zip(*rows)
+    expected = [calculate_priority(*row) for row in rows]
+    assert score_priorities(triage_level, age, heart_rate, systolic, diastolic, symptom_hours) == expected
+    # The rescorer keeps base_scores() between passes and only re-runs finish_scores() as hours go by.
+    base = base_scores(triage_level, age, heart_rate, systolic, diastolic)
+    assert finish_scores(base, symptom_hours) == expected
@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+import pytest
+from triage_rules import assess_with_rules, fast_path_threshold
+
+NORMAL = {"heart_rate": 80, "blood_pressure": {"systolic": 120, "diastolic": 80}}
+
+def patient(symptoms, age=40, duration=3, vitals=NORMAL):
+    return SimpleNamespace(symptoms=symptoms, age=age, symptom_duration=duration, vitals=vitals)
+
+# symptoms, expected triage level (None: anything but mild), expected department, fast path allowed
+CASES = [
+    (["cold sweat", "chest pain"], None, "Cardiology", False),
+    (["cough", "shortness of breath"], None, "Cardiology", False),
+    (["mild headache", "slurred speech"], None, "Neurology", False),
+    (["mild cough", "palpitations"], None, "Cardiology", False),
+    (["heartburn", "cough"], 1, None, False),
+    (["runny nose", "sore throat"], 1, None, False),
+    (["toothache"], 1, "Dentist", True),
+    (["chest pain"], None, "Cardiology", False),
+    (["seizures"], 5, "Neurology", True),
+]
+
+@pytest.mark.parametrize("symptoms,level,department,fast", CASES)
+def test_mild_and_acute_keywords(symptoms, level, department, fast):
+    rules = assess_with_rules(patient(symptoms))
+    if level is None:
+        assert rules.triage_level > 1
+    else:
+        assert rules.triage_level == level
+    assert rules.department == department
+    assert (rules.triage_confidence >= fast_path_threshold()) == fast
+
+@pytest.mark.parametrize("symptoms", [["heartburn"], ["toothpaste allergy"], ["gumboil"]])
+def test_keywords_match_whole_words(symptoms):
+    assert assess_with_rules(patient(symptoms)).department is None
+
+def test_cold_sweat_is_not_a_cold():
+    rules = assess_with_rules(patient(["cold sweat"]))
+    assert "mild symptoms with normal vitals" not in rules.reasons
+    assert rules.department == "Cardiology"
+
+def test_phrases_do_not_span_symptoms():
+    rules = assess_with_rules(patient(["chest", "pain in the knee"]))
+    assert rules.department is None
+
+def test_mild_keyword_next_to_critical_one_is_capped():
+    rules = assess_with_rules(patient(["mild cough", "seizure"]))
+    assert rules.triage_level == 5
+    assert rules.triage_confidence < fast_path_threshold()
+    assert "mild and acute keywords together" in rules.reasons
+
+@pytest.mark.parametrize("vitals", [{}, {"blood_pressure": {"systolic": 120, "diastolic": 85}}, {"heart_rate": 80}])
+def test_missing_vitals_use_the_defaults(vitals):
+    # Same defaults as the prompts: heart rate 80, blood pressure 120/80.
+    rules = assess_with_rules(patient(["mild cough"], vitals=vitals))
+    assert rules.triage_level == 1
+    assert rules.mood == "calm"
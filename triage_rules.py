@@ -0,0 +1,151 @@
+import os, re, threading
+from collections import namedtuple
+
+DEPARTMENTS = ["Cardiology", "Pediatrics", "Neurology", "Dentist"]
+
+DEPARTMENT_KEYWORDS = {
+    "Cardiology": ["chest pain", "chest tightness", "palpitation", "cardiac", "heart", "shortness of breath",
+                   "arrhythmia", "hypertension", "cold sweat"],
+    "Neurology": ["headache", "migraine", "seizure", "stroke", "numbness", "dizziness", "dizzy", "faint",
+                  "paralysis", "slurred speech", "tremor", "memory loss"],
+    "Dentist": ["tooth", "teeth", "toothache", "gum", "dental", "jaw pain", "cavity"],
+}
+CRITICAL_KEYWORDS = ["cardiac arrest", "unconscious", "unresponsive", "not breathing", "stroke", "seizure",
+                     "severe bleeding"]
+MILD_KEYWORDS = ["mild", "cough", "cold", "runny nose", "sore throat", "toothache", "rash"]
+LEVEL_MOOD = {5: "panicked", 4: "stressed", 3: "anxious", 2: "anxious", 1: "calm"}
+PEDIATRIC_AGE = 15
+# Every vitals cut-off the rules below (and mood_override) compare against; llm_cache keys never straddle one.
+HEART_RATE_CUTOFFS = (40, 60, 100, 120, 140)
+SYSTOLIC_CUTOFFS = (80, 90, 140, 180, 200)
+DIASTOLIC_CUTOFFS = (60, 80, 90, 120)
+
+RuleAssessment = namedtuple("RuleAssessment", [
+    "triage_level", "department", "mood", "triage_confidence", "mood_confidence", "reasons"])
+
+def _keyword_pattern(keywords):
+    # Whole words and phrases (plurals and -ed/-ing forms too), so "heart" doesn't match "heartburn".
+    alternatives = "|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True))
+    return re.compile(rf"\b(?:{alternatives})(?:s|es|ed|ing)?\b")
+
+CRITICAL_PATTERN = _keyword_pattern(CRITICAL_KEYWORDS)
+MILD_PATTERN = _keyword_pattern(MILD_KEYWORDS)
+DEPARTMENT_PATTERNS = {dept: _keyword_pattern(keywords) for dept, keywords in DEPARTMENT_KEYWORDS.items()}
+# Department keywords that are mild in themselves ("toothache") don't count against a mild level.
+ACUTE_PATTERN = _keyword_pattern([keyword for keywords in DEPARTMENT_KEYWORDS.values() for keyword in keywords
+                                  if keyword not in MILD_KEYWORDS] + CRITICAL_KEYWORDS)
+
+def _symptom_text(patient):
+    # Symptoms are kept apart so a phrase can't be made of the end of one and the start of the next.
+    return "; ".join(patient.symptoms).lower()
+
+def mood_override(patient):
+    # The deterministic overrides that adjust_mood_based_on_vitals applies on top of the LLM.
+    symptoms_str = _symptom_text(patient)
+    hr = patient.vitals.get("heart_rate", 80)
+    if hr > 120 or patient.vitals.get("blood_pressure", {}).get("diastolic", 80) < 80:
+        return "panicked"
+    elif "cardiac arrest" in symptoms_str:
+        return "panicked"
+    elif "mild cough" in symptoms_str and hr < 100:
+        return "calm"
+    return None
+
+def _triage_level(patient, symptoms_str, reasons):
+    bp = patient.vitals.get("blood_pressure", {})
+    hr = patient.vitals.get("heart_rate", 80)
+    systolic = bp.get("systolic", 120)
+    diastolic = bp.get("diastolic", 80)
+    if CRITICAL_PATTERN.search(symptoms_str):
+        reasons.append("critical symptom keyword")
+        return 5, 0.95
+    if hr > 140 or hr < 40 or systolic > 200 or systolic < 80:
+        reasons.append("critical vitals")
+        return 5, 0.9
+    if hr > 120 or systolic > 180 or diastolic > 120:
+        reasons.append("severely abnormal vitals")
+        return 4, 0.7
+    vitals_normal = 60 <= hr <= 100 and 90 <= systolic <= 140 and 60 <= diastolic <= 90
+    if vitals_normal and MILD_PATTERN.search(symptoms_str) and not ACUTE_PATTERN.search(symptoms_str):
+        reasons.append("mild symptoms with normal vitals")
+        return (1 if patient.symptom_duration < 24 else 2), 0.9
+    reasons.append("no decisive vitals or keywords")
+    return (3 if not vitals_normal else 2), 0.4
+
+def _department(patient, symptoms_str, reasons):
+    if patient.age < PEDIATRIC_AGE:
+        reasons.append("pediatric age")
+        return "Pediatrics", 0.95
+    matches = [dept for dept, pattern in DEPARTMENT_PATTERNS.items() if pattern.search(symptoms_str)]
+    if len(matches) == 1:
+        reasons.append(f"{matches[0]} keyword")
+        return matches[0], 0.9
+    if matches:
+        reasons.append(f"ambiguous keywords {matches}")
+        return matches[0], 0.4
+    reasons.append("no department keyword")
+    return None, 0.0
+
+def assess_with_rules(patient):
+    symptoms_str = _symptom_text(patient)
+    reasons = []
+    level, level_confidence = _triage_level(patient, symptoms_str, reasons)
+    if MILD_PATTERN.search(symptoms_str) and ACUTE_PATTERN.search(symptoms_str):
+        # "Mild" next to an acute complaint is for the LLM to weigh, whatever the level came out as.
+        reasons.append("mild and acute keywords together")
+        level_confidence = min(level_confidence, fast_path_threshold() - 0.05)
+    department, department_confidence = _department(patient, symptoms_str, reasons)
+    mood = mood_override(patient)
+    # An override would replace whatever the LLM says, so it is as good as certain.
+    mood_confidence = 1.0 if mood else 0.3
+    return RuleAssessment(
+        triage_level=level,
+        department=department,
+        mood=mood or LEVEL_MOOD[level],
+        triage_confidence=min(level_confidence, department_confidence),
+        mood_confidence=mood_confidence,
+        reasons=reasons,
+    )
+
+def fast_path_enabled():
+    return os.getenv("SHMAS_RULES_FASTPATH", "1") != "0"
+
+def fast_path_threshold():
+    return float(os.getenv("SHMAS_RULES_THRESHOLD", "0.85"))
+
+class RuleStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def _bucket(self, kind):
+        return self._counts.setdefault(kind, {"fast_path": 0, "fallback": 0, "compared": 0, "agreed": 0})
+
+    def record_fast_path(self, kind):
+        with self._lock:
+            self._bucket(kind)["fast_path"] += 1
+
+    def record_fallback(self, kind, rule_answer, llm_answer):
+        with self._lock:
+            bucket = self._bucket(kind)
+            bucket["fallback"] += 1
+            if llm_answer is not None:
+                bucket["compared"] += 1
+                bucket["agreed"] += int(rule_answer == llm_answer)
+
+    def snapshot(self):
+        with self._lock:
+            output = {}
+            for kind, bucket in self._counts.items():
+                stats = dict(bucket)
+                total = stats["fast_path"] + stats["fallback"]
+                stats["fast_path_rate"] = stats["fast_path"] / total if total else 0.0
+                stats["agreement_rate"] = stats["agreed"] / stats["compared"] if stats["compared"] else None
+                output[kind] = stats
+            return output
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+rule_stats = RuleStats()